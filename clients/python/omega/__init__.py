@@ -9,7 +9,7 @@
 
 """Omega core library."""
 
-__all__ = ['client', 'dbg', 'browser', 'box_factory', 'error', 'util', 'shell']
+__all__ = ['client', 'async_client', 'pool', 'resolver', 'cache', 'jsonstream', 'compression', 'codec', 'prepared', 'transport', 'http2', 'cookies', 'retry', 'hedge', 'balancer', 'metrics', 'timing', 'limiter', 'coalesce', 'dbg', 'browser', 'box_factory', 'error', 'util', 'shell']
 
 import dbg
 from util import *
@@ -0,0 +1,763 @@
+#!/usr/bin/python -tt
+
+# omega - python client
+# https://github.com/jfillmore/Omega-API-Engine
+#
+# Copyright 2011, Jonathon Fillmore
+# Licensed under the MIT license. See LICENSE file.
+# http://www.opensource.org/licenses/mit-license.php
+
+
+"""Event loop driven Omega client for running many API calls at once from a single thread."""
+
+import errno
+import heapq
+import itertools
+import os
+import select
+import socket
+import ssl
+import sys
+import time
+
+from error import Exception
+from client import OmegaClient
+from resolver import Resolver
+import compression
+
+READ = 0x1
+WRITE = 0x4
+
+_BLOCKING = '%s() blocks, so AsyncOmegaClient has no use for it; use request() and wait(), or an OmegaClient.'
+
+
+class Future:
+    """The eventual result of an API call."""
+
+    def __init__(self):
+        self._done = False
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        '''Returns the result of the call, raising its exception if it failed.'''
+        if not self._done:
+            raise Exception('Result requested before the request finished.')
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self):
+        return self._exception
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._finish()
+
+    def add_done_callback(self, callback):
+        '''Calls 'callback(future)' once the future is done (right away if it already is).'''
+        if self._done:
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    def _finish(self):
+        self._done = True
+        callbacks = self._callbacks
+        self._callbacks = []
+        for callback in callbacks:
+            callback(self)
+
+
+class EventLoop:
+    """Minimal poll()-based (select() where poll is missing) event loop."""
+
+    def __init__(self):
+        self._handlers = {}
+        self._timers = [] # heap of (when, seq, callback)
+        self._seq = itertools.count()
+        if hasattr(select, 'poll'):
+            self._poll = select.poll()
+        else:
+            self._poll = None
+            self._events = {}
+
+    def register(self, handler, events):
+        fd = handler.fileno()
+        self._handlers[fd] = handler
+        if self._poll is not None:
+            self._poll.register(fd, self._poll_mask(events))
+        else:
+            self._events[fd] = events
+
+    def modify(self, handler, events):
+        fd = handler.fileno()
+        if self._poll is not None:
+            self._poll.modify(fd, self._poll_mask(events))
+        else:
+            self._events[fd] = events
+
+    def unregister(self, handler):
+        fd = handler.fileno()
+        if fd in self._handlers:
+            del self._handlers[fd]
+            if self._poll is not None:
+                self._poll.unregister(fd)
+            else:
+                del self._events[fd]
+
+    def call_later(self, delay, callback):
+        '''Calls 'callback()' from the loop once 'delay' seconds have passed.'''
+        heapq.heappush(self._timers, (time.time() + delay, self._seq.next(), callback))
+
+    def _poll_mask(self, events):
+        mask = 0
+        if events & READ:
+            mask |= select.POLLIN
+        if events & WRITE:
+            mask |= select.POLLOUT
+        return mask
+
+    def run_once(self, timeout = None):
+        '''Waits for socket activity (or the nearest deadline) and dispatches it.'''
+        now = time.time()
+        deadlines = [h.deadline for h in self._handlers.values() if h.deadline is not None]
+        if self._timers:
+            deadlines.append(self._timers[0][0])
+        if deadlines:
+            wait = max(0, min(deadlines) - now)
+            if timeout is None or wait < timeout:
+                timeout = wait
+        if self._poll is not None:
+            if timeout is None:
+                ready = self._poll.poll()
+            else:
+                ready = self._poll.poll(timeout * 1000)
+            ready = [(fd,
+                mask & (select.POLLIN | select.POLLHUP | select.POLLERR) != 0,
+                mask & select.POLLOUT != 0) for (fd, mask) in ready]
+        else:
+            readers = [fd for fd in self._events if self._events[fd] & READ]
+            writers = [fd for fd in self._events if self._events[fd] & WRITE]
+            (readable, writable, errored) = select.select(readers, writers, [], timeout)
+            ready = [(fd, fd in readable, fd in writable) for fd in set(readable + writable)]
+        for (fd, readable, writable) in ready:
+            handler = self._handlers.get(fd)
+            if handler is not None:
+                handler.handle_event(readable, writable)
+        now = time.time()
+        for handler in self._handlers.values():
+            if handler.deadline is not None and handler.deadline <= now:
+                handler.handle_timeout()
+        while self._timers and self._timers[0][0] <= now:
+            heapq.heappop(self._timers)[2]()
+
+    def run_until_complete(self, futures):
+        '''Runs the loop until the future (or list of futures) given is done.'''
+        if isinstance(futures, Future):
+            futures = [futures]
+        while [f for f in futures if not f.done()]:
+            self._run_pending()
+
+    def run_until_any(self, futures):
+        '''Runs the loop until at least one of the futures given is done.'''
+        while not [f for f in futures if f.done()]:
+            self._run_pending()
+
+    def _run_pending(self):
+        if not self._handlers and not self._timers:
+            raise Exception('Event loop stopped with requests still pending.')
+        self.run_once()
+
+
+class _Response:
+    """Incremental HTTP/1.1 response parser."""
+
+    def __init__(self, method):
+        self.method = method
+        self.status = None
+        self.reason = None
+        self.header_lines = []
+        self.headers = {}
+        self.cookies = []
+        self.will_close = False
+        self.done = False
+        self._buffer = ''
+        self._body = []
+        self._have_headers = False
+        self._length = None
+        self._chunked = False
+        self._chunk_left = None
+
+    def getheader(self, name, default = None):
+        return self.headers.get(name.lower(), default)
+
+    def body(self):
+        return ''.join(self._body)
+
+    def feed(self, data):
+        self._buffer += data
+        while not self.done:
+            if not self._have_headers:
+                if not self._parse_headers():
+                    return
+            elif self._chunked:
+                if not self._parse_chunk():
+                    return
+            elif self._length is not None:
+                take = self._buffer[:self._length]
+                self._buffer = self._buffer[len(take):]
+                self._body.append(take)
+                self._length -= len(take)
+                if self._length == 0:
+                    self.done = True
+                return
+            else:
+                # no framing, so the body runs until the server closes
+                self._body.append(self._buffer)
+                self._buffer = ''
+                return
+
+    def eof(self):
+        '''Notes the server closed the connection; returns whether the response is complete.'''
+        if self._have_headers and not self._chunked and self._length is None:
+            self.done = True
+        return self.done
+
+    def _parse_headers(self):
+        end = self._buffer.find('\r\n\r\n')
+        if end == -1:
+            return False
+        lines = self._buffer[:end].split('\r\n')
+        self._buffer = self._buffer[end + 4:]
+        status_line = lines[0].split(' ', 2)
+        if len(status_line) < 2 or not status_line[0].startswith('HTTP/'):
+            raise Exception('Invalid HTTP status line: %s' % lines[0])
+        status = int(status_line[1])
+        if status == 100:
+            # interim response, the real one follows
+            return True
+        self.status = status
+        if len(status_line) == 3:
+            self.reason = status_line[2]
+        else:
+            self.reason = ''
+        self.header_lines = lines[1:]
+        for line in self.header_lines:
+            (name, value) = line.split(':', 1)
+            name = name.strip().lower()
+            value = value.strip()
+            if name == 'set-cookie':
+                self.cookies.append(value)
+            if name in self.headers:
+                self.headers[name] = ', '.join((self.headers[name], value))
+            else:
+                self.headers[name] = value
+        self._have_headers = True
+        connection = self.getheader('connection', '').lower()
+        if status_line[0] == 'HTTP/1.0':
+            self.will_close = connection != 'keep-alive'
+        else:
+            self.will_close = connection == 'close'
+        if self.method == 'HEAD' or status in (204, 304) or status < 200:
+            self.done = True
+        elif self.getheader('transfer-encoding', '').lower() == 'chunked':
+            self._chunked = True
+        elif self.getheader('content-length') is not None:
+            self._length = int(self.getheader('content-length'))
+            if self._length == 0:
+                self.done = True
+        else:
+            self.will_close = True
+        return True
+
+    def _parse_chunk(self):
+        if self._chunk_left is None:
+            end = self._buffer.find('\r\n')
+            if end == -1:
+                return False
+            size = int(self._buffer[:end].split(';', 1)[0], 16)
+            self._buffer = self._buffer[end + 2:]
+            if size == 0:
+                self._chunk_left = -1
+            else:
+                self._chunk_left = size
+        if self._chunk_left == -1:
+            # skip any trailers
+            if self._buffer.startswith('\r\n'):
+                self.done = True
+                return True
+            end = self._buffer.find('\r\n\r\n')
+            if end == -1:
+                return False
+            self.done = True
+            return True
+        if self._chunk_left > 0:
+            take = self._buffer[:self._chunk_left]
+            self._buffer = self._buffer[len(take):]
+            self._body.append(take)
+            self._chunk_left -= len(take)
+            if self._chunk_left:
+                return False
+        if len(self._buffer) < 2:
+            return False
+        self._buffer = self._buffer[2:]
+        self._chunk_left = None
+        return True
+
+
+class _Request:
+    def __init__(self, method, api, url, data, headers, future, opts):
+        self.method = method
+        self.api = api
+        self.url = url
+        self.data = data
+        self.headers = headers
+        self.future = future
+        self.opts = opts
+        self.attempt = None
+        self.deadline = None
+
+
+class _Connection:
+    """Non-blocking keep-alive HTTP(S) connection driven by an EventLoop."""
+
+    def __init__(self, client, key):
+        self.client = client
+        self.loop = client.loop
+        self.key = key
+        self.sock = None
+        self.state = 'new'
+        self.request = None
+        self.response = None
+        self.deadline = None
+        self.address = None
+        self._out = ''
+
+    def fileno(self):
+        return self._fd
+
+    def open(self):
+        (scheme, host, port) = self.key
+        # looking up a name blocks the whole loop, so only the first connection to a host does it
+        resolver = self.client.resolver
+        (family, socktype, proto, addr) = resolver.resolve(host, port)[0]
+        sock = socket.socket(family, socktype, proto)
+        sock.setblocking(0)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        error = sock.connect_ex(addr)
+        if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            sock.close()
+            # so the next connection tries another address, if there is one
+            resolver.failed(addr)
+            raise socket.error(error, os.strerror(error))
+        self.address = addr
+        self.sock = sock
+        self._fd = sock.fileno()
+        self.state = 'connecting'
+        self.loop.register(self, WRITE)
+
+    def send(self, request):
+        '''Starts sending a request; the connection must be idle or still connecting.'''
+        self.request = request
+        self.response = _Response(request.method)
+        self.deadline = request.deadline
+        lines = ['%s %s HTTP/1.1' % (request.method, request.url)]
+        lines.append('Host: %s:%s' % (self.key[1], self.key[2]))
+        for (name, value) in request.headers.iteritems():
+            lines.append('%s: %s' % (name, value))
+        cookie = self.client._cookie_jar.get_header(self.client._cookie_url(request.url))
+        if cookie:
+            lines.append('Cookie: %s' % cookie)
+        if request.data:
+            lines.append('Content-Length: %d' % len(request.data))
+        self._out = '\r\n'.join(lines) + '\r\n\r\n'
+        if request.data:
+            self._out += request.data
+        if self.state == 'idle':
+            self.state = 'sending'
+            self.loop.modify(self, WRITE)
+
+    def handle_event(self, readable, writable):
+        try:
+            if self.state == 'connecting':
+                self._connected()
+            elif self.state == 'handshaking':
+                self._handshake()
+            elif self.state == 'sending':
+                self._write()
+            elif self.state == 'receiving':
+                self._read()
+            elif self.state == 'idle':
+                # the server closed our keep-alive connection
+                self.close()
+                self.client._connection_closed(self)
+        except (socket.error, ssl.SSLError, ValueError, Exception), e:
+            self._fail(e)
+
+    def handle_timeout(self):
+        request = self.request
+        self.request = None
+        self.close()
+        self.client._connection_closed(self)
+        if request is not None:
+            request.future.set_exception(
+                Exception('API "%s" timed out.' % request.api))
+
+    def _connected(self):
+        error = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            self.client.resolver.failed(self.address)
+            raise socket.error(error, os.strerror(error))
+        self.client.resolver.succeeded(self.address)
+        if self.key[0] == 'https':
+            self.sock = self.client._wrap_ssl(self.sock, self.key[1])
+            self.state = 'handshaking'
+            self._handshake()
+        else:
+            self.state = 'sending'
+            self._write()
+
+    def _handshake(self):
+        try:
+            self.sock.do_handshake()
+        except ssl.SSLError, e:
+            if e.args[0] == ssl.SSL_ERROR_WANT_READ:
+                self.loop.modify(self, READ)
+                return
+            if e.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                self.loop.modify(self, WRITE)
+                return
+            raise
+        self.state = 'sending'
+        self.loop.modify(self, WRITE)
+
+    def _write(self):
+        if self.request is None:
+            # connected ahead of time; wait for work
+            self.state = 'idle'
+            self.loop.modify(self, READ)
+            return
+        while self._out:
+            try:
+                sent = self.sock.send(self._out[:65536])
+            except ssl.SSLError, e:
+                if e.args[0] in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE):
+                    return
+                raise
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            self._out = self._out[sent:]
+        self.state = 'receiving'
+        self.loop.modify(self, READ)
+
+    def _read(self):
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except ssl.SSLError, e:
+                if e.args[0] in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE):
+                    return
+                raise
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            if not data:
+                if self.response.eof():
+                    self.response.will_close = True
+                    break
+                raise Exception('Server closed the connection mid-response.')
+            self.response.feed(data)
+            if self.response.done:
+                break
+        request = self.request
+        response = self.response
+        self.request = None
+        self.response = None
+        self.deadline = None
+        if response.will_close:
+            self.close()
+            self.client._connection_closed(self)
+        else:
+            self.state = 'idle'
+            self.client._connection_idle(self)
+        self.client._finish(request, response)
+
+    def _fail(self, error):
+        request = self.request
+        # once connected, the request may have reached the server
+        sent = self.state in ('sending', 'receiving')
+        self.request = None
+        self.close()
+        self.client._connection_closed(self)
+        if request is not None:
+            self.client._retry(request, error, sent)
+
+    def close(self):
+        if self.sock is not None:
+            self.loop.unregister(self)
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+            self.sock = None
+        self.state = 'closed'
+        self.deadline = None
+
+
+class AsyncOmegaClient(OmegaClient):
+    """Omega client whose API calls return futures, all driven by a single event loop.
+
+    Calls return immediately; use wait() (or the loop directly) to run them:
+
+        client = AsyncOmegaClient('example.com/api')
+        calls = [client.get('/service/%d' % i) for i in range(1000)]
+        results = client.wait(calls)
+
+    Results, errors and data unwrapping match OmegaClient.request(), and
+    prepare() and request_many() work as they do there, on the loop. The
+    calls that can only block (run(), run_many(), stream(), iter_data()
+    and preconnect()) raise exceptions instead. The response cache,
+    coalescing, hedging, the rate limiter, metrics and lifecycle hooks
+    aren't used by these calls. Failed requests are retried as the retry
+    policy says (see set_retry_policy()), with the loop waiting out the
+    backoff rather than sleeping. Host names are looked up through
+    'resolver' (a resolver.Resolver of the client's own by default), which
+    remembers the answers."""
+
+    def __init__(self, url = 'localhost', credentials = None, port = 5800, use_https = True, loop = None, max_connections = 100, timeout = None, resolver = None):
+        if loop is None:
+            loop = EventLoop()
+        if resolver is None:
+            resolver = Resolver()
+        self.loop = loop
+        self.resolver = resolver
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self._idle = {}
+        self._open = {}
+        self._queued = {}
+        self._ssl_context = None
+        OmegaClient.__init__(self, url, credentials, port, use_https)
+
+    def get(self, api, params = (), **opts):
+        return self.request('GET', api, params, **opts)
+
+    def post(self, api, params = (), **opts):
+        return self.request('POST', api, params, **opts)
+
+    def put(self, api, params = (), **opts):
+        return self.request('PUT', api, params, **opts)
+
+    def delete(self, api, params = (), **opts):
+        return self.request('DELETE', api, params, **opts)
+
+    def request(self, method, api, params = (), raw_response = False, full_response = False, get = None, headers = None, verbose = False, no_format = False):
+        '''Starts an API call and returns a Future for its result.'''
+        (method, api, url, data, headers) = self._build_request(method, api, params, get, headers)
+        return self._perform(method, api, url, data, headers, raw_response, full_response, no_format, verbose)
+
+    def _perform(self, method, api, url, data, headers, raw_response = False, full_response = False, no_format = False, verbose = False, expect_continue = False):
+        # prepared requests come through here too, so they get futures as well
+        future = Future()
+        if verbose:
+            self._log_request(method, url, data, headers)
+        if data:
+            (data, headers) = self._compress_body(data, headers)
+        request = _Request(method, api, url, data, headers, future, {
+            'raw_response': raw_response,
+            'full_response': full_response,
+            'verbose': verbose,
+            'no_format': no_format
+        })
+        request.attempt = self._retry_policy.start(self._get_key(), method)
+        if self.timeout is not None:
+            request.deadline = time.time() + self.timeout
+        self._dispatch(request)
+        return future
+
+    def request_many(self, calls, concurrency = 8, ordered = True, **opts):
+        '''Runs many API calls on the loop from this thread, yielding their outcomes as OmegaClient.request_many() does.
+
+        'calls' is an iterable of (method, api, params) tuples, read lazily;
+        no more than 'concurrency' are in flight at once.'''
+        if concurrency < 1:
+            raise Exception('Invalid concurrency: %s.' % concurrency)
+        calls = iter(calls)
+        active = [] # (index, call, future)
+        pending = {}
+        next_index = 0
+        count = 0
+        more = True
+        while more or active:
+            while more and len(active) < concurrency:
+                try:
+                    call = calls.next()
+                except StopIteration:
+                    more = False
+                    break
+                try:
+                    (method, api, params) = call
+                    active.append((count, call, self.request(method, api, params, **opts)))
+                except Exception, e:
+                    pending[count] = {'index': count, 'call': call, 'result': False, 'data': None, 'error': e}
+                except StandardError, e:
+                    error = Exception('API call failed: %s' % str(e), call)
+                    pending[count] = {'index': count, 'call': call, 'result': False, 'data': None, 'error': error}
+                count += 1
+            if active:
+                self.loop.run_until_any([future for (index, call, future) in active])
+            for (index, call, future) in [entry for entry in active if entry[2].done()]:
+                active.remove((index, call, future))
+                outcome = {'index': index, 'call': call, 'result': True, 'data': None, 'error': None}
+                if future.exception() is None:
+                    outcome['data'] = future.result()
+                else:
+                    outcome['result'] = False
+                    outcome['error'] = future.exception()
+                pending[index] = outcome
+            if ordered:
+                while next_index in pending:
+                    yield pending.pop(next_index)
+                    next_index += 1
+            else:
+                for index in sorted(pending):
+                    yield pending.pop(index)
+
+    def run(self, *args, **opts):
+        raise Exception(_BLOCKING % 'run')
+
+    def run_many(self, *args, **opts):
+        raise Exception(_BLOCKING % 'run_many')
+
+    def stream(self, *args, **opts):
+        raise Exception(_BLOCKING % 'stream')
+
+    def iter_data(self, *args, **opts):
+        raise Exception(_BLOCKING % 'iter_data')
+
+    def preconnect(self, *args, **opts):
+        raise Exception(_BLOCKING % 'preconnect')
+
+    def wait(self, futures):
+        '''Runs the event loop until the future(s) finish, returning the result(s).'''
+        self.loop.run_until_complete(futures)
+        if isinstance(futures, Future):
+            return futures.result()
+        return [future.result() for future in futures]
+
+    def close(self):
+        '''Closes all idle connections.'''
+        for key in self._idle:
+            for conn in self._idle[key]:
+                conn.close()
+                self._open[key] -= 1
+        self._idle = {}
+
+    def _get_key(self):
+        return (self._get_scheme(), self._hostname, self._port)
+
+    def _wrap_ssl(self, sock, hostname):
+        if hasattr(ssl, 'create_default_context'):
+            if self._ssl_context is None:
+                self._ssl_context = ssl.create_default_context()
+            return self._ssl_context.wrap_socket(
+                sock, server_hostname = hostname, do_handshake_on_connect = False)
+        return ssl.wrap_socket(sock, do_handshake_on_connect = False)
+
+    def _dispatch(self, request):
+        '''Starts another try of a request, unless the host's circuit is open.'''
+        try:
+            request.attempt.next()
+        except Exception, e:
+            request.future.set_exception(e)
+            return
+        self._assign(request)
+
+    def _assign(self, request):
+        '''Sends a request over an idle connection or a new one, or queues it for the next to come free.'''
+        key = self._get_key()
+        idle = self._idle.get(key)
+        if idle:
+            idle.pop().send(request)
+        elif self._open.get(key, 0) < self.max_connections:
+            conn = _Connection(self, key)
+            try:
+                conn.open()
+            except socket.error, e:
+                self._retry(request, e, False)
+                return
+            self._open[key] = self._open.get(key, 0) + 1
+            conn.send(request)
+        else:
+            self._queued.setdefault(key, []).append(request)
+
+    def _retry(self, request, error, sent = True):
+        attempt = request.attempt
+        delay = attempt.retry_delay(sent)
+        if delay is None:
+            request.future.set_exception(Exception('HTTP request to %s://%s:%s failed after %d %s: %s' %
+                (attempt.key + (attempt.tries, attempt.tries == 1 and 'try' or 'tries', str(error) or error.__class__.__name__))))
+            return
+        if request.opts['verbose']:
+            sys.stderr.write('# Retry: %s after %.3fs\n' % (str(error) or error.__class__.__name__, delay))
+        self.loop.call_later(delay, lambda: self._dispatch(request))
+
+    def _connection_idle(self, conn):
+        queued = self._queued.get(conn.key)
+        if queued:
+            # counted as a try when it was queued
+            conn.send(queued.pop(0))
+        else:
+            self._idle.setdefault(conn.key, []).append(conn)
+
+    def _connection_closed(self, conn):
+        idle = self._idle.get(conn.key, [])
+        if conn in idle:
+            idle.remove(conn)
+        self._open[conn.key] -= 1
+        queued = self._queued.get(conn.key)
+        if queued:
+            # still the same try
+            self._assign(queued.pop(0))
+
+    def _finish(self, request, response):
+        opts = request.opts
+        self._save_cookies(request.url, response.cookies, opts['verbose'])
+        if opts['verbose']:
+            self._log_response(response.status, response.reason, response.header_lines)
+        if response.status in self._retry_policy.statuses:
+            delay = request.attempt.retry_delay(True, response.getheader('Retry-After'))
+            if delay is not None:
+                if opts['verbose']:
+                    sys.stderr.write('# Retry: %d %s after %.3fs\n' % (response.status, response.reason, delay))
+                self.loop.call_later(delay, lambda: self._dispatch(request))
+                return
+        else:
+            request.attempt.success()
+        try:
+            result = self._handle_response(
+                request.api,
+                response.status,
+                response.reason,
+                response.getheader('Content-Type') or '',
+                compression.inflate(response.getheader('Content-Encoding'), response.body()),
+                opts['raw_response'],
+                opts['full_response'],
+                opts['no_format']
+            )
+        except Exception, e:
+            request.future.set_exception(e)
+            return
+        request.future.set_result(result)
@@ -0,0 +1,189 @@
+#!/usr/bin/python -tt
+
+# omega - python client
+# https://github.com/jfillmore/Omega-API-Engine
+#
+# Copyright 2011, Jonathon Fillmore
+# Licensed under the MIT license. See LICENSE file.
+# http://www.opensource.org/licenses/mit-license.php
+
+
+"""Client-side load balancing across several identical Omega servers."""
+
+import socket
+import threading
+
+from error import Exception
+
+
+class Endpoint:
+    """A server we can send requests to, and how it's been doing."""
+
+    def __init__(self, scheme, host, port):
+        self.key = (scheme, host, port)
+        self.outstanding = 0
+        # moving average of seconds until a response starts coming back
+        self.ewma = None
+        self.failures = 0
+        self.ejected = False
+        self.requests = 0
+        self.ejections = 0
+
+    def __repr__(self):
+        return '%s://%s:%s' % self.key
+
+
+class Balancer:
+    """Picks which endpoint each request goes to.
+
+    Strategies are 'round-robin', 'least-outstanding' (fewest requests
+    waiting on a response) and 'ewma' (lowest recent latency, weighted by
+    outstanding requests). After 'eject_after' failures in a row an
+    endpoint is taken out of rotation and probed (with a TCP connect)
+    every 'probe_interval' seconds until it answers again. If everything
+    has been ejected, requests are spread over all endpoints anyway. With
+    'affinity', requests stick to one endpoint (e.g. for servers keeping
+    sessions locally) until it gets ejected."""
+
+    STRATEGIES = ('round-robin', 'least-outstanding', 'ewma')
+
+    def __init__(self, endpoints, strategy = 'round-robin', affinity = False, eject_after = 3, probe_interval = 5, probe_timeout = 2, decay = 0.3):
+        if not endpoints:
+            raise Exception('At least one endpoint is required.')
+        if not strategy in self.STRATEGIES:
+            raise Exception("Invalid balancing strategy: '%s'. Expected one of: %s." %
+                (strategy, ', '.join(self.STRATEGIES)))
+        self.endpoints = [Endpoint(*key) for key in endpoints]
+        self.strategy = strategy
+        self.affinity = affinity
+        self.eject_after = eject_after
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self.decay = decay
+        self._lock = threading.Lock()
+        self._next = 0
+        self._pinned = None
+        self._prober = None
+        self._closed = threading.Event()
+
+    def pick(self, exclude = (), skip = ()):
+        '''Returns the endpoint to send the next request to, avoiding those excluded (e.g. already tried) if possible and those skipped (e.g. with their circuit open) unless there's nothing else.'''
+        self._lock.acquire()
+        try:
+            if self.affinity and self._pinned is not None and not self._pinned.ejected:
+                if not self._pinned in exclude and not self._pinned in skip:
+                    endpoint = self._pinned
+                    endpoint.outstanding += 1
+                    endpoint.requests += 1
+                    return endpoint
+            endpoints = [e for e in self.endpoints if not e in skip] or self.endpoints
+            candidates = [e for e in endpoints if not e.ejected and not e in exclude]
+            if not candidates:
+                candidates = [e for e in endpoints if not e.ejected] or endpoints
+            # rotate, so ties don't always go to the first endpoint
+            start = self._next % len(candidates)
+            self._next += 1
+            candidates = candidates[start:] + candidates[:start]
+            if self.strategy == 'least-outstanding':
+                endpoint = min(candidates, key = lambda e: e.outstanding)
+            elif self.strategy == 'ewma':
+                # untried endpoints count as fast so they get a chance
+                endpoint = min(candidates, key = lambda e: (e.ewma or 0.0) * (e.outstanding + 1))
+            else:
+                endpoint = candidates[0]
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+            if self.affinity:
+                self._pinned = endpoint
+            return endpoint
+        finally:
+            self._lock.release()
+
+    def success(self, endpoint, latency):
+        '''Records a response from the endpoint, 'latency' seconds after the request was sent.'''
+        self._lock.acquire()
+        try:
+            endpoint.outstanding -= 1
+            endpoint.failures = 0
+            if endpoint.ewma is None:
+                endpoint.ewma = latency
+            else:
+                endpoint.ewma += self.decay * (latency - endpoint.ewma)
+        finally:
+            self._lock.release()
+
+    def release(self, endpoint):
+        '''Records a request that was abandoned without hearing from the endpoint either way.'''
+        self._lock.acquire()
+        try:
+            endpoint.outstanding -= 1
+        finally:
+            self._lock.release()
+
+    def failure(self, endpoint):
+        '''Records a failed request, ejecting the endpoint if it keeps failing.'''
+        self._lock.acquire()
+        try:
+            endpoint.outstanding -= 1
+            endpoint.failures += 1
+            if endpoint.ejected or endpoint.failures < self.eject_after:
+                return
+            endpoint.ejected = True
+            endpoint.ejections += 1
+            if self._prober is None:
+                self._prober = threading.Thread(target = self._probe_loop, name = 'omega-balancer-probe')
+                self._prober.daemon = True
+                self._prober.start()
+        finally:
+            self._lock.release()
+
+    def probe(self, endpoint):
+        '''Returns whether an ejected endpoint looks to be back (i.e. accepts connections).'''
+        try:
+            sock = socket.create_connection(endpoint.key[1:], self.probe_timeout)
+        except socket.error:
+            return False
+        sock.close()
+        return True
+
+    def _probe_loop(self):
+        while True:
+            self._closed.wait(self.probe_interval)
+            if self._closed.is_set():
+                return
+            for endpoint in [e for e in self.endpoints if e.ejected]:
+                if self.probe(endpoint):
+                    self._lock.acquire()
+                    try:
+                        endpoint.ejected = False
+                        endpoint.failures = 0
+                    finally:
+                        self._lock.release()
+            self._lock.acquire()
+            try:
+                if not [e for e in self.endpoints if e.ejected]:
+                    self._prober = None
+                    return
+            finally:
+                self._lock.release()
+
+    def close(self):
+        '''Stops probing ejected endpoints.'''
+        self._closed.set()
+
+    def stats(self):
+        '''Returns the state of each endpoint.'''
+        self._lock.acquire()
+        try:
+            return dict([
+                (repr(e), {
+                    'requests': e.requests,
+                    'outstanding': e.outstanding,
+                    'ewma': e.ewma,
+                    'failures': e.failures,
+                    'ejected': e.ejected,
+                    'ejections': e.ejections
+                }) for e in self.endpoints
+            ])
+        finally:
+            self._lock.release()
@@ -0,0 +1,407 @@
+#!/usr/bin/python -tt
+
+# omega - python client
+# https://github.com/jfillmore/Omega-API-Engine
+#
+# Copyright 2011, Jonathon Fillmore
+# Licensed under the MIT license. See LICENSE file.
+# http://www.opensource.org/licenses/mit-license.php
+
+
+"""HTTP caches for GET responses (in memory, or in SQLite to share across processes), with ETag/Last-Modified revalidation."""
+
+import os
+import copy
+import threading
+import time
+import hashlib
+import marshal
+import sqlite3
+import email.utils
+from collections import OrderedDict
+
+# what using the database may raise; e.g. OSError if its directory is missing or read-only
+_DB_ERRORS = (sqlite3.DatabaseError, OSError, IOError)
+
+
+class CacheEntry:
+    """A cached response and the information needed to revalidate it."""
+
+    def __init__(self, status, reason, content_type, data, decoded):
+        self.status = status
+        self.reason = reason
+        self.content_type = content_type
+        self.data = data
+        self.decoded = decoded
+        self.size = len(data)
+        self.etag = None
+        self.last_modified = None
+        self.expires = 0
+        self.must_revalidate = False
+        # seconds past expiring it may still be used while being revalidated
+        self.stale = 0
+
+    def is_fresh(self, now = None):
+        if now is None:
+            now = time.time()
+        return not self.must_revalidate and now < self.expires
+
+    def is_usable_stale(self, now = None):
+        '''Returns whether the (expired) entry may be used while it's revalidated in the background.'''
+        if now is None:
+            now = time.time()
+        return not self.must_revalidate and now < self.expires + self.stale
+
+    def get_decoded(self):
+        '''Returns a copy of the decoded response so callers can't alter the cached one.'''
+        return copy.deepcopy(self.decoded)
+
+    def validators(self):
+        '''Returns the conditional headers to revalidate this entry with.'''
+        headers = {}
+        if self.etag is not None:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified is not None:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+    def update(self, getheader, now = None, ttl = None, stale = 0):
+        '''Reads the caching headers of a response; returns False if it must not be stored.
+
+        A 'ttl' (e.g. from ResponseCache.policy()) overrides the freshness
+        the server gives, short of 'no-store'. 'stale' is how long it may be
+        served stale while being revalidated, unless the server says.'''
+        if now is None:
+            now = time.time()
+        directives = {}
+        for directive in (getheader('Cache-Control') or '').split(','):
+            parts = directive.strip().lower().split('=', 1)
+            if parts[0]:
+                if len(parts) == 2:
+                    directives[parts[0]] = parts[1].strip('"')
+                else:
+                    directives[parts[0]] = True
+        if 'no-store' in directives:
+            return False
+        self.etag = getheader('ETag') or self.etag
+        self.last_modified = getheader('Last-Modified') or self.last_modified
+        self.stale = stale
+        if 'stale-while-revalidate' in directives:
+            try:
+                self.stale = int(directives['stale-while-revalidate'])
+            except ValueError:
+                pass
+        if ttl is not None:
+            # Omega sends 'no-cache' by default; whoever set the TTL knows better for their APIs
+            self.must_revalidate = False
+            self.expires = now + ttl
+            return True
+        self.must_revalidate = 'no-cache' in directives
+        self.expires = now
+        if 'max-age' in directives:
+            try:
+                self.expires = now + int(directives['max-age'])
+            except ValueError:
+                pass
+        elif getheader('Expires'):
+            expires = email.utils.parsedate_tz(getheader('Expires'))
+            if expires is not None:
+                self.expires = email.utils.mktime_tz(expires)
+        # nothing to go on? then it is only worth keeping if we can revalidate it
+        return self.expires > now or self.etag is not None or self.last_modified is not None
+
+
+class ResponseCache:
+    """Byte-capped LRU cache of GET responses.
+
+    'ttls' maps API prefixes to how many seconds their responses stay
+    fresh, whatever the server says; the longest matching prefix wins. A
+    value may also be a (ttl, stale) tuple, 'stale' being how long an
+    expired response may still be served while it's revalidated in the
+    background ('stale' for the rest)."""
+
+    def __init__(self, max_bytes = 16 * 1024 * 1024, ttls = None, stale = 0):
+        self.max_bytes = max_bytes
+        self.ttls = ttls or {}
+        self.stale = stale
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._revalidating = set()
+        self._stats = {
+            'hits': 0,
+            'stale_hits': 0,
+            'misses': 0,
+            'revalidations': 0,
+            'evictions': 0,
+            'stores': 0
+        }
+
+    def policy(self, api):
+        '''Returns the TTL (None to go by the server's headers) and stale allowance for responses from an API.'''
+        api = api.lstrip('/')
+        match = None
+        for prefix in self.ttls:
+            if api.startswith(prefix.lstrip('/')) and (match is None or len(prefix) > len(match)):
+                match = prefix
+        if match is None:
+            return (None, self.stale)
+        ttl = self.ttls[match]
+        if isinstance(ttl, tuple):
+            return ttl
+        return (ttl, self.stale)
+
+    def start_revalidation(self, key):
+        '''Returns True if the caller should revalidate the entry, or False if someone already is.'''
+        self._lock.acquire()
+        try:
+            if key in self._revalidating:
+                return False
+            self._revalidating.add(key)
+            return True
+        finally:
+            self._lock.release()
+
+    def finish_revalidation(self, key):
+        self._lock.acquire()
+        try:
+            self._revalidating.discard(key)
+        finally:
+            self._lock.release()
+
+    def key(self, scheme, host, port, url, headers, cookie = None):
+        '''Returns the cache key for a request; any headers sent (credentials included) and cookies are part of it.'''
+        headers = sorted([(name.lower(), value) for (name, value) in headers.iteritems()
+            if not name.lower().startswith('if-')])
+        return (scheme, host, port, url, tuple(headers), cookie)
+
+    def get(self, key):
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is not None:
+                # mark as recently used
+                del self._entries[key]
+                self._entries[key] = entry
+            return entry
+        finally:
+            self._lock.release()
+
+    def put(self, key, entry):
+        if entry.size > self.max_bytes:
+            # whatever we had is out of date too
+            self.remove(key)
+            return
+        self._lock.acquire()
+        try:
+            if key in self._entries:
+                self._size -= self._entries.pop(key).size
+            self._entries[key] = entry
+            self._size += entry.size
+            self._stats['stores'] += 1
+            while self._size > self.max_bytes:
+                (old_key, old_entry) = self._entries.popitem(last = False)
+                self._size -= old_entry.size
+                self._stats['evictions'] += 1
+        finally:
+            self._lock.release()
+
+    def remove(self, key):
+        self._lock.acquire()
+        try:
+            if key in self._entries:
+                self._size -= self._entries.pop(key).size
+        finally:
+            self._lock.release()
+
+    def count(self, stat):
+        self._lock.acquire()
+        try:
+            self._stats[stat] += 1
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+            self._size = 0
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        '''Returns a snapshot of the cache's counters.'''
+        self._lock.acquire()
+        try:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._size
+        finally:
+            self._lock.release()
+        return stats
+
+
+class PersistentCache(ResponseCache):
+    """Response cache kept in an SQLite database, shared by every process using the same file (e.g. many om_api runs).
+
+    Keys are hashed, so the credentials they include aren't stored. The
+    database is only readable by its owner, and uses write-ahead logging
+    so readers don't hold up writers. When 'max_bytes' is exceeded, the
+    least recently used responses go. If the database can't be used (e.g.
+    it's locked for longer than 'timeout' seconds) requests just go
+    uncached."""
+
+    # last used times are only updated once they're this many seconds old, so hits needn't write
+    touch_interval = 60
+
+    def __init__(self, path = '~/.omega_cache', max_bytes = 64 * 1024 * 1024, ttls = None, stale = 0, timeout = 10):
+        ResponseCache.__init__(self, max_bytes, ttls, stale)
+        self.path = os.path.expanduser(path)
+        self.timeout = timeout
+        self._local = threading.local()
+        self._stats['errors'] = 0
+
+    def _db(self):
+        # connections can't be shared between threads
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            # responses hold whatever the user's credentials can see
+            os.close(os.open(self.path, os.O_RDWR | os.O_CREAT, 0600))
+            db = sqlite3.connect(self.path, self.timeout, isolation_level = None)
+            db.text_factory = str
+            db.execute('PRAGMA journal_mode = WAL')
+            db.execute('PRAGMA synchronous = NORMAL')
+            db.execute('''CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                status INTEGER,
+                reason TEXT,
+                content_type TEXT,
+                data BLOB,
+                decoded BLOB,
+                etag TEXT,
+                last_modified TEXT,
+                expires REAL,
+                must_revalidate INTEGER,
+                stale REAL,
+                size INTEGER,
+                used REAL
+            )''')
+            db.execute('CREATE INDEX IF NOT EXISTS responses_used ON responses (used)')
+            self._local.db = db
+        return db
+
+    def key(self, scheme, host, port, url, headers, cookie = None):
+        return hashlib.sha1(repr(ResponseCache.key(self, scheme, host, port, url, headers, cookie))).hexdigest()
+
+    def get(self, key):
+        try:
+            db = self._db()
+            row = db.execute(
+                '''SELECT status, reason, content_type, data, decoded, etag, last_modified, expires, must_revalidate, stale, used
+                FROM responses WHERE key = ?''', (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            decoded = marshal.loads(str(row[4]))
+            now = time.time()
+            if now - row[10] > self.touch_interval:
+                db.execute('UPDATE responses SET used = ? WHERE key = ?', (now, key))
+        except _DB_ERRORS:
+            self.count('errors')
+            return None
+        except (ValueError, EOFError, TypeError):
+            # damaged, or marshalled by another version of Python; either way it's a miss
+            self.count('errors')
+            self.remove(key)
+            return None
+        entry = CacheEntry(row[0], row[1], row[2], str(row[3]), decoded)
+        (entry.etag, entry.last_modified, entry.expires, entry.must_revalidate, entry.stale) = row[5:10]
+        entry.must_revalidate = bool(entry.must_revalidate)
+        return entry
+
+    def put(self, key, entry):
+        try:
+            decoded = marshal.dumps(entry.decoded)
+        except ValueError:
+            self.remove(key)
+            return
+        size = len(entry.data) + len(decoded)
+        if size > self.max_bytes:
+            self.remove(key)
+            return
+        try:
+            db = self._db()
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                db.execute('''INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', (
+                    key,
+                    entry.status,
+                    entry.reason,
+                    entry.content_type,
+                    sqlite3.Binary(entry.data),
+                    sqlite3.Binary(decoded),
+                    entry.etag,
+                    entry.last_modified,
+                    entry.expires,
+                    int(entry.must_revalidate),
+                    entry.stale,
+                    size,
+                    time.time()
+                ))
+                evicted = self._evict(db)
+                db.execute('COMMIT')
+            except:
+                db.execute('ROLLBACK')
+                raise
+        except _DB_ERRORS:
+            self.count('errors')
+            return
+        self._lock.acquire()
+        try:
+            self._stats['stores'] += 1
+            self._stats['evictions'] += evicted
+        finally:
+            self._lock.release()
+
+    def _evict(self, db):
+        total = db.execute('SELECT SUM(size) FROM responses').fetchone()[0] or 0
+        evicted = 0
+        while total > self.max_bytes:
+            rows = db.execute('SELECT key, size FROM responses ORDER BY used LIMIT 100').fetchall()
+            if not rows:
+                break
+            for (key, size) in rows:
+                db.execute('DELETE FROM responses WHERE key = ?', (key,))
+                total -= size
+                evicted += 1
+                if total <= self.max_bytes:
+                    break
+        return evicted
+
+    def remove(self, key):
+        try:
+            self._db().execute('DELETE FROM responses WHERE key = ?', (key,))
+        except _DB_ERRORS:
+            self.count('errors')
+
+    def clear(self):
+        try:
+            self._db().execute('DELETE FROM responses')
+        except _DB_ERRORS:
+            self.count('errors')
+
+    def stats(self):
+        '''Returns a snapshot of this process's counters, and the size of the shared cache.'''
+        self._lock.acquire()
+        try:
+            stats = dict(self._stats)
+        finally:
+            self._lock.release()
+        try:
+            (stats['entries'], stats['bytes']) = self._db().execute('SELECT COUNT(*), SUM(size) FROM responses').fetchone()
+        except _DB_ERRORS:
+            self.count('errors')
+            stats['errors'] += 1
+            (stats['entries'], stats['bytes']) = (None, None)
+        stats['bytes'] = stats['bytes'] or 0
+        return stats
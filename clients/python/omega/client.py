@@ -13,51 +13,155 @@
 import pycurl
 import urllib
 import httplib
-try:
-    import json
-except:
-    import simplejson
-    json = simplejson
 
 import re
 import sys
 import dbg
-import StringIO
+import shutil
 import os
 import tempfile
 import base64
 import hashlib
 import socket
+import time
+import select
+import mmap
+import mimetools
+import copy
+import threading
+import Queue
 
 from error import Exception
 import util
+from pool import ConnectionPool
+from cache import CacheEntry
+import jsonstream
+import compression
+import codec
+from prepared import PreparedRequest
+from cookies import shared_jar
+from retry import RetryPolicy
+from balancer import Balancer
+from timing import Timing
+from limiter import RateLimiter
+
+class _PrefixedFile:
+    """Socket file that hands back an already read line first (for responses that skip '100 Continue')."""
+
+    def __init__(self, line, fp):
+        self._line = line
+        self._fp = fp
+
+    def makefile(self, mode = 'rb', bufsize = 0):
+        return self
+
+    def readline(self, limit = -1):
+        if self._line:
+            line = self._line
+            self._line = None
+            return line
+        return self._fp.readline(limit)
+
+    def read(self, amt = -1):
+        return self._fp.read(amt)
+
+    def close(self):
+        self._fp.close()
+
+_curl_share = None
+
+def _get_curl_share():
+    '''Returns the share handle letting run()'s curl handles reuse DNS lookups and TLS sessions.'''
+    global _curl_share
+    if _curl_share is None and hasattr(pycurl, 'CurlShare'):
+        share = pycurl.CurlShare()
+        share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+        if hasattr(pycurl, 'LOCK_DATA_SSL_SESSION'):
+            share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+        _curl_share = share
+    return _curl_share
 
 class OmegaClient:
     """Client for talking to an Omega Server."""
     _version = '0.2'
-    _http = None
+    _pool = None
+    _cache = None
+    _auth_header = None
+    _cookie_jar = None
+    _shared_cookies = False
+    _retry_policy = None
+    _hedger = None
+    _balancer = None
+    _metrics = None
+    _limiter = None
+    _coalescer = None
+    # path of the Unix domain socket to talk HTTP over, if not TCP
+    _unix_socket = None
     _hostname = None
     _folder = '/'
     _url = None
     _session_coookie = None
     _cookie_file = None
     _useragent = 'OmegaClient/0.2'
+    _spool_size = 8 * 1024 * 1024
+    _continue_timeout = 3
+    _accept_encoding = compression.ACCEPT_ENCODING
+    _compress_threshold = None
+    _compress_level = 6
 
-    def __init__(self, url = 'localhost', credentials = None, port = 5800, use_https = True):
+    def __init__(self, url = 'localhost', credentials = None, port = 5800, use_https = True, pool = None, cache = None, cookie_jar = None, retry_policy = None):
         self._cookie_file = os.path.expanduser('~/.omega_cookie') # tempfile.NamedTemporaryFile()
+        # connections may be shared between clients by handing in a pool
+        if pool is None:
+            pool = ConnectionPool()
+        self._pool = pool
+        # GET responses are only cached if given a cache.ResponseCache
+        self._cache = cache
+        # cookies are kept in memory and saved in batches; see cookies.CookieJar
+        # (without one of our own, set_credentials() picks the jar shared by those credentials)
+        self._cookie_jar = cookie_jar
+        self._shared_cookies = cookie_jar is None
+        if retry_policy is None:
+            retry_policy = RetryPolicy()
+        self._retry_policy = retry_policy
+        self._local = threading.local()
+        self._hooks = {'request': [], 'response': [], 'error': []}
+        # idle curl handles for run(); see _get_curl()
+        self._curls = []
+        self._curl_lock = threading.Lock()
+        self._transfer_lock = threading.Lock()
+        self._transfer = {
+            'requests': 0,
+            'request_bytes': 0,
+            'request_wire_bytes': 0,
+            'response_bytes': 0,
+            'response_wire_bytes': 0
+        }
         self.set_https(use_https)
         self.set_credentials(credentials)
         self.set_port(port)
         self.set_url(url)
         # TODO: python 2.7 supports an order tuple object we can use to preserve order :)
-        self.encode = json.JSONEncoder().encode
-        self.decode = json.JSONDecoder().decode
+        self.set_codec()
         # setup cookie jar
     
     def set_url(self, url):
+        '''Sets where the service is, e.g. 'example.com/api', 'https://example.com:5800/api/' or 'unix:///run/omega.sock:/api/'.'''
         if url != '':
             self._url = url
-            if url.find('/') == -1:
+            self._unix_socket = None
+            if url.lower()[0:7] == 'unix://':
+                # the socket's path, then the folder after a colon
+                (path, folder) = (url[7:].split(':', 1) + [''])[0:2]
+                if not path:
+                    raise Exception('Invalid API service URL: %s.' % url)
+                self._unix_socket = path
+                self.set_https(False)
+                self._hostname = 'localhost'
+                self._folder = folder.lstrip('/')
+                if not self._folder.endswith('/'):
+                    self._folder = ''.join((self._folder, '/'))
+            elif url.find('/') == -1:
                 self._hostname = url
                 self._folder = ''
             else:
@@ -71,7 +175,7 @@ class OmegaClient:
                 else:
                     # some other protocol perhaps?
                     if re.match('^\w+://', url):
-                        raise Exception('Only HTTP and HTTPS are supported protocols.')
+                        raise Exception('Only HTTP, HTTPS and Unix domain sockets are supported protocols.')
                 # do we have a port?
                 match = re.match('^(\w+\.)*\w+(:(\d{0,5}))/?', url)
                 if match:
@@ -84,13 +188,37 @@ class OmegaClient:
                     self._folder = ''.join((self._folder, '/'))
         else:
             raise Exception('Invalid API service URL: %s.' % url)
-        # having set everything, init httplib
-        if self._use_https:
-            self._http = httplib.HTTPSConnection(self._hostname, self._port)
-        else:
-            self._http = httplib.HTTPConnection(self._hostname, self._port)
-        self._http.cookies = False
         
+    def set_endpoints(self, hosts, strategy = 'round-robin', affinity = False, **opts):
+        '''Spreads requests over several identical servers, given as a list of 'host' or 'host:port' strings.
+
+        The scheme and folder still come from the URL, which also remains
+        the host as far as cookies and caching are concerned. See
+        balancer.Balancer for the strategies and options available. Pass
+        None to go back to just the URL's host. Only requests going over
+        the connection pool are balanced; run() and run_many() calls sent
+        with curl always go to the URL's host.'''
+        if self._balancer is not None:
+            self._balancer.close()
+            self._balancer = None
+        if hosts is None:
+            return
+        endpoints = []
+        for host in hosts:
+            if ':' in host:
+                (host, port) = host.rsplit(':', 1)
+                port = int(port)
+            else:
+                port = self._port
+            endpoints.append((self._get_scheme(), host, port))
+        self._balancer = Balancer(endpoints, strategy, affinity, **opts)
+
+    def get_endpoint_stats(self):
+        '''Returns the state of each server being balanced over (requests, outstanding, latency, ejections), if any.'''
+        if self._balancer is None:
+            return None
+        return self._balancer.stats()
+
     def get_url(self):
         return self._url
 
@@ -113,6 +241,16 @@ class OmegaClient:
             self._credentials = creds
         else:
             raise Exception("Invalid credentials. Keys of 'username'/'password' or 'token' expected, but were not found.")
+        # hash once now rather than on every request
+        self._auth_header = None
+        if creds and 'username' in creds and 'password' in creds:
+            md5 = hashlib.md5();
+            md5.update(':'.join(
+                [creds['username'], creds['password']]
+            ))
+            self._auth_header = 'Basic ' + base64.b64encode(md5.hexdigest())
+        if self._shared_cookies:
+            self._cookie_jar = shared_jar(self._cookie_file, creds)
 
     def set_https(self, secure = True):
         if secure:
@@ -125,24 +263,490 @@ class OmegaClient:
             self._port = port
         else:
             raise Exception('Invalid API service port: %i.' % port)
+
+    def set_spool_size(self, size):
+        '''Sets how much (in bytes) of a response run() holds in memory, when given an 'output' file, before spilling to a temp file.
+
+        Only stream(), iter_data() and run() with an 'output' file run in
+        constant memory; every other call returns the whole response, so
+        holds all of it in memory regardless of this size.'''
+        self._spool_size = size
+
+    def set_codec(self, backend = None, pretty = True):
+        '''Sets the JSON codec: a codec.Codec, or the name of a backend (e.g. 'ujson', 'simplejson', 'json'; defaults to the fastest that keeps floats exact). Without 'pretty', raw responses skip sorting and indenting.'''
+        if isinstance(backend, codec.Codec):
+            self._codec = backend
+        else:
+            self._codec = codec.get_codec(backend, pretty)
+        self.encode = self._codec.encode
+        self.decode = self._codec.decode
+
+    def get_codec(self):
+        return self._codec
+
+    def set_compression(self, accept = True, threshold = None, level = 6):
+        '''Sets whether compressed responses are accepted, and the size (in bytes) above which request bodies are gzipped (None to never).'''
+        if accept:
+            self._accept_encoding = compression.ACCEPT_ENCODING
+        else:
+            self._accept_encoding = None
+        self._compress_threshold = threshold
+        self._compress_level = level
+
+    def get_transfer_stats(self):
+        '''Returns total request/response byte counts, both as sent over the wire and uncompressed.'''
+        self._transfer_lock.acquire()
+        try:
+            return dict(self._transfer)
+        finally:
+            self._transfer_lock.release()
+
+    def on_request(self, func):
+        '''Calls 'func(timing)' as each request is about to be sent; see timing.Timing.'''
+        self._hooks['request'].append(func)
+
+    def on_response(self, func):
+        '''Calls 'func(timing)' once each response has been read, with the time spent in each phase.'''
+        self._hooks['response'].append(func)
+
+    def on_error(self, func):
+        '''Calls 'func(timing, error)' when a request fails without getting a response.'''
+        self._hooks['error'].append(func)
+
+    def _run_hooks(self, name, *args):
+        for func in self._hooks[name]:
+            func(*args)
+
+    def last_timing(self):
+        '''Returns the timing.Timing of the last request made by this thread.'''
+        return getattr(self._local, 'timing', None)
+
+    def last_transfer(self):
+        '''Returns the byte counts of the last request made by this thread.'''
+        return getattr(self._local, 'transfer', None)
+
+    def get_pool(self):
+        return self._pool
+
+    def set_transport(self, transport):
+        '''Sets the transport.Transport requests are sent through (e.g. an http2.HTTP2Transport or transport.WSGITransport); the default is a pool.ConnectionPool.'''
+        self._pool = transport
+
+    def get_transport(self):
+        return self._pool
+
+    def preconnect(self, count = 1):
+        '''Opens (and handshakes) up to 'count' connections per server ahead of a burst of requests; returns how many were opened.'''
+        if self._balancer is not None:
+            keys = [e.key for e in self._balancer.endpoints if not e.ejected]
+        else:
+            keys = [self._get_pool_key()]
+        opened = 0
+        for key in keys:
+            opened += self._pool.preconnect(*(key + (count,)))
+        return opened
+
+    def get_pool_stats(self):
+        '''Returns connection pool counters (checkouts, waits, new connections, reuse ratio, etc).'''
+        return self._pool.stats()
+
+    def set_cache(self, cache):
+        '''Sets the cache.ResponseCache to use for GET requests, or None to disable caching.'''
+        self._cache = cache
+
+    def set_cookie_jar(self, cookie_jar):
+        '''Sets the cookies.CookieJar to use (e.g. to share cookies between clients).'''
+        self._cookie_jar = cookie_jar
+        self._shared_cookies = False
+
+    def get_cookie_jar(self):
+        return self._cookie_jar
+
+    def set_retry_policy(self, policy):
+        '''Sets the retry.RetryPolicy deciding how failed requests are retried (and when to fail fast).'''
+        self._retry_policy = policy
+
+    def get_retry_stats(self):
+        '''Returns retry counters and the state of each host's circuit breaker.'''
+        return self._retry_policy.stats()
+
+    def set_hedging(self, hedger):
+        '''Sets the hedge.Hedger used to race slow GETs against a second copy, or None to stop hedging.'''
+        self._hedger = hedger
+
+    def get_hedge_stats(self):
+        '''Returns hedging counters (hedges sent, won, denied by the budget), if hedging.'''
+        if self._hedger is None:
+            return None
+        return self._hedger.stats()
+
+    def set_coalescing(self, coalescer):
+        '''Sets the coalesce.Coalescer letting identical GETs made at the same time share one request, or None to stop.'''
+        self._coalescer = coalescer
+
+    def get_coalesce_stats(self):
+        '''Returns coalescing counters (requests, sent, and coalesced into another), if coalescing.'''
+        if self._coalescer is None:
+            return None
+        return self._coalescer.stats()
+
+    def set_metrics(self, metrics):
+        '''Sets the metrics.Metrics to record requests in (latency, bytes, statuses, retries), or None to stop.'''
+        self._metrics = metrics
+        if metrics is not None:
+            metrics.add_collector('pool', self.get_pool_stats)
+            metrics.add_collector('retry', self.get_retry_stats)
+            metrics.add_collector('cache', lambda: self.get_cache_stats() or {})
+            metrics.add_collector('hedge', lambda: self.get_hedge_stats() or {})
+            metrics.add_collector('limiter', self._get_limiter_metrics)
+            metrics.add_collector('coalesce', lambda: self.get_coalesce_stats() or {})
+
+    def get_metrics(self):
+        return self._metrics
+
+    def set_limiter(self, limiter):
+        '''Sets the limiter.RateLimiter holding requests back so servers aren't overloaded, or None to stop.'''
+        self._limiter = limiter
+
+    def get_limiter(self):
+        return self._limiter
+
+    def get_limiter_stats(self):
+        '''Returns rate limiting counters and the current concurrency limits, if limiting.'''
+        if self._limiter is None:
+            return None
+        return self._limiter.stats()
+
+    def _get_limiter_metrics(self):
+        if self._limiter is None:
+            return {}
+        values = self._limiter.stats()
+        del values['limits']
+        values.update(self._limiter.gauges())
+        return values
+
+    def get_cache_stats(self):
+        '''Returns response cache counters (hits, misses, revalidations, evictions), if caching.'''
+        if self._cache is None:
+            return None
+        return self._cache.stats()
+
+    def _get_scheme(self):
+        if self._use_https:
+            return 'https'
+        return 'http'
+
+    def _get_pool_key(self):
+        '''Returns the (scheme, host, port) to get connections to the service for.'''
+        if self._unix_socket is not None:
+            return ('unix', self._unix_socket, 0)
+        return (self._get_scheme(), self._hostname, self._port)
     
     # old style API invoker
-    def run(self, api, args = (), raw_response = False, full_response = False, get = None, post = None, files = None):
-        # check and prep the data
-        if api == '':
-            raise Exception("Invalid service API: '%s'." %api)
-        api = urllib.quote(api)
+    def run(self, api, args = (), raw_response = False, full_response = False, get = None, post = None, files = None, output = None):
+        # given an 'output' file the raw response is copied there instead of returned,
+        # via a temp file (once past _spool_size) while curl can't say yet whether it's an error
+        if not self._pool.curl_compatible:
+            return self._run_transport(api, args, raw_response, full_response, get, post, files, output)
+        curl = self._get_curl()
+        try:
+            state = self._setup_curl(curl, api, args, get, post, files)
+            permit = None
+            if self._limiter is not None:
+                permit = self._limiter.acquire('%s://%s:%s' % self._get_pool_key(), api)
+            try:
+                curl.perform()
+            except pycurl.error, e:
+                if permit is not None:
+                    permit.release()
+                self._fail_timing(state['timing'], Exception('API call failed: %s' % e.args[-1]))
+                raise
+            if permit is not None:
+                permit.release(
+                    curl.getinfo(curl.HTTP_CODE),
+                    curl.getinfo(curl.STARTTRANSFER_TIME) - curl.getinfo(curl.PRETRANSFER_TIME)
+                )
+            return self._finish_curl(curl, state, raw_response, full_response, output)
+        finally:
+            self._put_curl(curl)
+
+    def run_many(self, calls, concurrency = 8, ordered = True, raw_response = False, full_response = False, get = None, post = None):
+        '''Runs many old style API calls at once from this thread, with curl's multi interface.
+
+        'calls' is an iterable of (api, args) or (api, args, files) tuples,
+        read lazily. Yields one dict per call, as request_many() does:
+        {'index', 'call', 'result', 'data', 'error'}. Results come back in
+        input order unless 'ordered' is False.'''
+        if concurrency < 1:
+            raise Exception('Invalid concurrency: %s.' % concurrency)
+        if not self._pool.curl_compatible:
+            # nothing to overlap; e.g. a WSGI app runs in this thread anyway
+            for (index, call) in enumerate(calls):
+                outcome = {'index': index, 'call': call, 'result': True, 'data': None, 'error': None}
+                try:
+                    files = None
+                    if len(call) > 2:
+                        files = call[2]
+                    outcome['data'] = self.run(call[0], call[1], raw_response, full_response, get, post, files)
+                except Exception, e:
+                    outcome['result'] = False
+                    outcome['error'] = e
+                yield outcome
+            return
+        calls = iter(calls)
+        multi = pycurl.CurlMulti()
+        endpoint = '%s://%s:%s' % self._get_pool_key()
+        active = {} # curl => (index, call, state, permit)
+        pending = {}
+        held = None # the next call, if the limiter wouldn't let it go yet
+        next_index = 0
+        count = 0
+        more = True
+        try:
+            while more or held is not None or active:
+                # keep 'concurrency' transfers going
+                while (more or held is not None) and len(active) < concurrency:
+                    if held is not None:
+                        (call, held) = (held, None)
+                    else:
+                        try:
+                            call = calls.next()
+                        except StopIteration:
+                            more = False
+                            break
+                    permit = None
+                    if self._limiter is not None:
+                        try:
+                            # waiting on the limiter while transfers are going would stall them, and with them their permits
+                            permit = self._limiter.acquire(endpoint, call[0], not active)
+                        except Exception, e:
+                            pending[count] = {'index': count, 'call': call, 'result': False, 'data': None, 'error': e}
+                            count += 1
+                            continue
+                        if permit is None:
+                            held = call
+                            break
+                    curl = self._get_curl()
+                    try:
+                        (api, args) = call[0:2]
+                        files = None
+                        if len(call) > 2:
+                            files = call[2]
+                        state = self._setup_curl(curl, api, args, get, post, files)
+                    except Exception, e:
+                        if permit is not None:
+                            permit.release()
+                        self._put_curl(curl)
+                        pending[count] = {'index': count, 'call': call, 'result': False, 'data': None, 'error': e}
+                        count += 1
+                        continue
+                    multi.add_handle(curl)
+                    active[curl] = (count, call, state, permit)
+                    count += 1
+                if active:
+                    while multi.perform()[0] == pycurl.E_CALL_MULTI_PERFORM:
+                        pass
+                    finished = []
+                    while True:
+                        (queued, succeeded, failed) = multi.info_read()
+                        finished += [(curl, None) for curl in succeeded]
+                        finished += [(curl, message) for (curl, errno, message) in failed]
+                        if not queued:
+                            break
+                    for (curl, message) in finished:
+                        multi.remove_handle(curl)
+                        (index, call, state, permit) = active.pop(curl)
+                        if permit is not None:
+                            if message is not None:
+                                permit.release()
+                            else:
+                                permit.release(
+                                    curl.getinfo(curl.HTTP_CODE),
+                                    curl.getinfo(curl.STARTTRANSFER_TIME) - curl.getinfo(curl.PRETRANSFER_TIME)
+                                )
+                        outcome = {'index': index, 'call': call, 'result': True, 'data': None, 'error': None}
+                        try:
+                            if message is not None:
+                                error = Exception('API call failed: %s' % message, call)
+                                self._fail_timing(state['timing'], error)
+                                raise error
+                            outcome['data'] = self._finish_curl(curl, state, raw_response, full_response)
+                        except Exception, e:
+                            outcome['result'] = False
+                            outcome['error'] = e
+                        except StandardError, e:
+                            outcome['result'] = False
+                            outcome['error'] = Exception('API call failed: %s' % str(e), call)
+                        self._put_curl(curl)
+                        pending[index] = outcome
+                    if not finished:
+                        # curl knows when it next needs to do something (e.g. retry a connect)
+                        timeout = multi.timeout()
+                        if timeout < 0 or timeout > 1000:
+                            timeout = 1000
+                        if held is not None:
+                            # the limiter may let it go (e.g. on the rate limit) before curl has anything to do
+                            timeout = min(timeout, 10)
+                        multi.select(timeout / 1000.0)
+                # hand out whatever we can
+                if ordered:
+                    while next_index in pending:
+                        yield pending.pop(next_index)
+                        next_index += 1
+                else:
+                    for index in sorted(pending):
+                        yield pending.pop(index)
+        finally:
+            for (curl, (index, call, state, permit)) in active.items():
+                multi.remove_handle(curl)
+                if permit is not None:
+                    permit.release()
+                self._fail_timing(state['timing'], Exception('API call abandoned.', call))
+                self._put_curl(curl)
+            multi.close()
+
+    def _get_curl(self):
+        '''Returns an idle curl handle, keeping its connections (and TLS sessions) from previous calls.'''
+        self._curl_lock.acquire()
+        try:
+            if self._curls:
+                return self._curls.pop()
+        finally:
+            self._curl_lock.release()
         curl = pycurl.Curl()
-        data = [
-            ('OMEGA_ENCODING', (curl.FORM_CONTENTS, 'json')),
-            ('OMEGA_API_PARAMS', (curl.FORM_CONTENTS, self.encode(args)))
+        # a new handle has no TLS session to resume, so borrow from the others (this survives reset())
+        share = _get_curl_share()
+        if share is not None:
+            curl.setopt(curl.SHARE, share)
+        return curl
+
+    def _put_curl(self, curl):
+        curl.reset()
+        self._curl_lock.acquire()
+        try:
+            self._curls.append(curl)
+        finally:
+            self._curl_lock.release()
+
+    def _curl_timing(self, curl, timing, status):
+        '''Fills in a timing record from curl's own (cumulative) timers and runs the response hooks.'''
+        dns = curl.getinfo(curl.NAMELOOKUP_TIME)
+        connect = curl.getinfo(curl.CONNECT_TIME)
+        tls = curl.getinfo(curl.APPCONNECT_TIME) or connect
+        pretransfer = curl.getinfo(curl.PRETRANSFER_TIME)
+        first_byte = curl.getinfo(curl.STARTTRANSFER_TIME)
+        total = curl.getinfo(curl.TOTAL_TIME)
+        timing.dns = dns
+        timing.connect = max(0.0, connect - dns)
+        timing.tls = max(0.0, tls - connect)
+        timing.send = max(0.0, pretransfer - tls)
+        # curl doesn't say when the request finished going out, so this includes sending it
+        timing.wait = max(0.0, first_byte - pretransfer)
+        timing.transfer = max(0.0, total - first_byte)
+        timing.reused = curl.getinfo(curl.NUM_CONNECTS) == 0
+        timing.tries = 1
+        timing.status = status
+        timing.total = total
+        self._record_metrics(timing, status, int(curl.getinfo(curl.SIZE_UPLOAD)), int(curl.getinfo(curl.SIZE_DOWNLOAD)))
+        self._local.timing = timing
+        self._run_hooks('response', timing)
+
+    def _fail_timing(self, timing, error):
+        timing.finish()
+        self._record_metrics(timing, 'error')
+        self._local.timing = timing
+        self._run_hooks('error', timing, error)
+
+    def _finish_timing(self, response):
+        timing = response.timing
+        timing.finish(response.status)
+        self._record_metrics(
+            timing,
+            response.status,
+            response.transfer['request_wire_bytes'],
+            response.transfer['response_wire_bytes'],
+            response.tries
+        )
+        self._local.timing = timing
+        self._run_hooks('response', timing)
+
+    def _start_metrics(self, timing):
+        '''Counts a timed request as in flight, in whichever metrics.Metrics are set as it starts.'''
+        timing._metrics = self._metrics
+        if timing._metrics is not None:
+            timing._metrics.start_request()
+
+    def _record_metrics(self, timing, status, request_bytes = 0, response_bytes = 0, tries = 1):
+        '''Records a finished request in the metrics it was started in, if any (just the once).'''
+        metrics = timing._metrics
+        if metrics is None:
+            return
+        timing._metrics = None
+        metrics.finish_request(timing.method, timing.api, status, timing.total, request_bytes, response_bytes, tries)
+
+    def _run_fields(self, args = (), post = None):
+        '''Returns the form fields an old style API call posts.'''
+        fields = [
+            ('OMEGA_ENCODING', 'json'),
+            ('OMEGA_API_PARAMS', self.encode(args))
         ]
         if self._credentials:
-            data.append(('OMEGA_CREDENTIALS', (curl.FORM_CONTENTS, self.encode(self._credentials))))
+            fields.append(('OMEGA_CREDENTIALS', self.encode(self._credentials)))
         # include any extra post data
         if post:
-            (name, value) = post.split('=', 1)
-            data.append((name, (curl.FORM_CONTENTS, value)))
+            fields.append(tuple(post.split('=', 1)))
+        return fields
+
+    def _encode_form(self, fields, files = None):
+        '''Returns a multipart/form-data body with the fields and files, and its content type.'''
+        boundary = mimetools.choose_boundary()
+        parts = []
+        for (name, value) in fields:
+            parts.append('--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s\r\n' % (boundary, name, value))
+        for name in files or ():
+            path = files[name]
+            upload = open(path, 'rb')
+            try:
+                parts.append('--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\n'
+                    'Content-Type: application/octet-stream\r\n\r\n%s\r\n' % (boundary, name, os.path.basename(path), upload.read()))
+            finally:
+                upload.close()
+        parts.append('--%s--\r\n' % boundary)
+        return (''.join(parts), 'multipart/form-data; boundary=%s' % boundary)
+
+    def _run_transport(self, api, args = (), raw_response = False, full_response = False, get = None, post = None, files = None, output = None):
+        '''Runs an old style API call through a transport that libcurl can't stand in for (e.g. a WSGI app).'''
+        (method, quoted_api, url, headers) = self._build_base('POST', api, get)
+        (data, headers['Content-type']) = self._encode_form(self._run_fields(args, post), files)
+        self._local.timing = None
+        timing = self._start_timing(method, url, quoted_api)
+        try:
+            (http, response) = self._open_response(method, url, data, headers)
+            succeeded = response.status >= 200 and response.status < 300
+            if output is None or not succeeded:
+                response_data = self._read_body(http, response)
+        except:
+            error = sys.exc_info()
+            self._local.pending_timing = None
+            self._fail_timing(timing, error[1])
+            raise error[0], error[1], error[2]
+        if output is not None and succeeded:
+            # the status is known up front here, so the body can go straight to the output
+            size = 0
+            for chunk in self._iter_body(http, response, 65536):
+                output.write(chunk)
+                size += len(chunk)
+            return size
+        self._finish_timing(response)
+        return self._finish_run(quoted_api, response.status, response.getheader('Content-Type') or '', response_data, raw_response, full_response)
+
+    def _setup_curl(self, curl, api, args = (), get = None, post = None, files = None):
+        '''Sets a curl handle up to run an old style API call, returning the state _finish_curl() needs.'''
+        # check and prep the data
+        if api == '':
+            raise Exception("Invalid service API: '%s'." %api)
+        api = urllib.quote(api)
+        data = [(name, (curl.FORM_CONTENTS, value)) for (name, value) in self._run_fields(args, post)]
         if files:
             # add in our files to the data
             for name in files:
@@ -160,10 +764,23 @@ class OmegaClient:
             url = '?'.join((url, get))
         # fire away
         curl.setopt(curl.URL, url) 
+        if self._unix_socket is not None:
+            curl.setopt(curl.UNIX_SOCKET_PATH, self._unix_socket)
         curl.setopt(curl.POST, 1)
         curl.setopt(curl.USERAGENT, self._useragent)
-        curl.setopt(curl.COOKIEFILE, self._cookie_file)
-        curl.setopt(curl.COOKIEJAR, self._cookie_file)
+        if self._accept_encoding:
+            # libcurl takes care of decompressing for us
+            curl.setopt(curl.ENCODING, self._accept_encoding)
+        # cookies come from (and go back to) our jar rather than curl's own cookie file
+        cookie_url = self._cookie_url(url[url.index('/', url.index('://') + 3):])
+        cookie = self._cookie_jar.get_header(cookie_url)
+        if cookie:
+            curl.setopt(curl.COOKIE, cookie)
+        set_cookies = []
+        def header_line(line):
+            if line[:11].lower() == 'set-cookie:':
+                set_cookies.append(line[11:].strip())
+        curl.setopt(curl.HEADERFUNCTION, header_line)
         if self._use_https:
             curl.setopt(curl.SSL_VERIFYPEER, 0) # TODO: don't always assume
             curl.setopt(curl.SSL_VERIFYHOST, 0) # TODO: don't always assume
@@ -171,12 +788,32 @@ class OmegaClient:
             curl.setopt(curl.HTTPPOST, data)
         else:
             curl.setopt(curl.POSTFIELDS, '&'.join(args))
-        response = StringIO.StringIO()
-        curl.setopt(curl.WRITEFUNCTION, response.write)
-        curl.perform()
-        response = response.getvalue()
+        spool = tempfile.SpooledTemporaryFile(self._spool_size)
+        curl.setopt(curl.WRITEFUNCTION, spool.write)
+        timing = Timing('curl', 'POST', url, api)
+        self._start_metrics(timing)
+        self._run_hooks('request', timing)
+        return {'api': api, 'cookie_url': cookie_url, 'spool': spool, 'set_cookies': set_cookies, 'timing': timing}
+
+    def _finish_curl(self, curl, state, raw_response = False, full_response = False, output = None):
+        '''Handles the response to an old style API call once curl has run it.'''
+        (api, spool) = (state['api'], state['spool'])
+        self._cookie_jar.extract(state['cookie_url'], state['set_cookies'])
         http_code = curl.getinfo(curl.HTTP_CODE)
         content_type = curl.getinfo(curl.CONTENT_TYPE) or "";
+        self._curl_timing(curl, state['timing'], http_code)
+        spool.seek(0)
+        try:
+            if output is not None and http_code >= 200 and http_code < 300:
+                shutil.copyfileobj(spool, output)
+                return spool.tell()
+            response = spool.read()
+        finally:
+            spool.close()
+        return self._finish_run(api, http_code, content_type, response, raw_response, full_response)
+
+    def _finish_run(self, api, http_code, content_type, response, raw_response = False, full_response = False):
+        '''Returns the result of an old style API call, given its response body.'''
         if http_code < 200 or http_code >= 300:
             # see if we got json data back
             try:
@@ -192,7 +829,6 @@ class OmegaClient:
                 error = response
             raise Exception("Server returned HTTP code %s. Response:\n%s" %
                 (str(http_code), str(error)))
-        curl.close()
         if raw_response:
             return response
         else:
@@ -237,8 +873,336 @@ class OmegaClient:
     def delete(self, api, params, opts = {}):
         return self.request('DELETE', api, params, opts);
 
-    def request(self, method, api, params = (), raw_response = False, full_response = False, get = None, headers = {}, verbose = False, no_format = False):
-        '''New REST-friendly API invoker'''
+    def request(self, method, api, params = (), raw_response = False, full_response = False, get = None, headers = None, verbose = False, no_format = False, body = None, expect_continue = False):
+        '''New REST-friendly API invoker
+
+        Rather than the encoded params, a 'body' may be sent instead: a
+        string, a file (or mmap) or an iterable of strings. Files of known
+        size are sent with a Content-Length, anything else chunked. With
+        'expect_continue' the body waits for the server's '100 Continue'
+        so it isn't sent only to be rejected.'''
+        (method, api, url, data, headers) = self._build_request(method, api, params, get, headers)
+        if body is not None:
+            data = body
+        return self._perform(method, api, url, data, headers, raw_response, full_response, no_format, verbose, expect_continue)
+
+    def prepare(self, method, api, get = None, headers = None, raw_response = False, full_response = False, no_format = False):
+        '''Returns a PreparedRequest for calling the same API repeatedly with different params.
+
+        The URL, headers and credentials are worked out once up front, so
+        each call only pays for encoding its params. Changes to the client's
+        URL or credentials afterwards are not picked up.'''
+        return PreparedRequest(self, method, api, get, headers, raw_response, full_response, no_format)
+
+    def _perform(self, method, api, url, data, headers, raw_response = False, full_response = False, no_format = False, verbose = False, expect_continue = False):
+        '''Sends a built request and returns its result, sharing GETs already in flight if coalescing.'''
+        coalescer = self._coalescer
+        if coalescer is None or method != 'GET' or data:
+            return self._perform_one(method, api, url, data, headers, raw_response, full_response, no_format, verbose, expect_continue)
+        # anything that could change the answer has to match: credentials are in the headers, sessions in cookies
+        key = self._get_pool_key() + (
+            url,
+            tuple(sorted(headers.iteritems())),
+            self._cookie_jar.get_header(self._cookie_url(url)),
+            raw_response,
+            full_response,
+            no_format
+        )
+        # waiters send nothing themselves, so have nothing to time
+        self._local.timing = None
+        return coalescer.run(key, lambda: self._perform_one(
+            method, api, url, data, headers, raw_response, full_response, no_format, verbose, expect_continue
+        ))
+
+    def _perform_one(self, method, api, url, data, headers, raw_response = False, full_response = False, no_format = False, verbose = False, expect_continue = False):
+        '''Sends a built request and returns its result, going through the cache for GETs.'''
+        # cache hits never touch the network, so have nothing to time
+        self._local.timing = None
+        # see if we've got a cached copy to use or revalidate
+        cache = self._cache
+        entry = None
+        if cache is not None and method == 'GET':
+            (scheme, host, port) = self._get_pool_key()
+            # responses to one session (or user) are no good to another
+            cookie = self._cookie_jar.get_header(self._cookie_url(url))
+            cache_key = cache.key(scheme, host, port, url, headers, cookie)
+            entry = cache.get(cache_key)
+            if entry is not None:
+                if entry.is_fresh():
+                    cache.count('hits')
+                    if verbose:
+                        sys.stderr.write('# Cache: hit\n')
+                    return self._cached_result(api, entry, raw_response, full_response, no_format)
+                if entry.is_usable_stale():
+                    cache.count('stale_hits')
+                    if verbose:
+                        sys.stderr.write('# Cache: stale hit, revalidating in the background\n')
+                    self._revalidate(cache, cache_key, entry, api, url, headers)
+                    return self._cached_result(api, entry, raw_response, full_response, no_format)
+                if verbose:
+                    sys.stderr.write('# Cache: stale, revalidating\n')
+                headers.update(entry.validators())
+            elif verbose:
+                sys.stderr.write('# Cache: miss\n')
+        # fire away
+        if verbose:
+            self._log_request(method, url, data, headers)
+        timing = self._start_timing(method, url, api)
+        try:
+            if self._hedger is not None and method == 'GET' and not data:
+                (response, response_data) = self._send_hedged(method, url, data, headers, verbose)
+            else:
+                (response, response_data) = self._send(method, url, data, headers, verbose, expect_continue)
+        except:
+            error = sys.exc_info()
+            self._local.pending_timing = None
+            self._fail_timing(timing, error[1])
+            raise error[0], error[1], error[2]
+        if response.timing is not timing:
+            # a hedge won; it was timed separately, but the caller waited from the start
+            response.timing.started = timing.started
+            response.timing._metrics = timing._metrics
+        self._finish_timing(response)
+        content_type = response.getheader('Content-Type') or ''
+        if entry is not None and response.status == 304:
+            cache.count('revalidations')
+            self._store_revalidated(cache, cache_key, entry, api, response)
+            return self._cached_result(api, entry, raw_response, full_response, no_format)
+        result = self._decode_response(
+            api,
+            response.status,
+            response.reason,
+            content_type,
+            response_data,
+            raw_response,
+            full_response
+        )
+        if cache is not None and method == 'GET':
+            cache.count('misses')
+            if response.status == 200:
+                if raw_response or not content_type.startswith("application/json"):
+                    decoded = result
+                else:
+                    # the caller is free to change the result we return
+                    decoded = copy.deepcopy(result)
+                self._store_response(cache, cache_key, api, response, response_data, decoded)
+        if not content_type.startswith("application/json"):
+            return result
+        return self._unwrap_result(api, response.status, response.reason, result, raw_response, full_response, no_format)
+
+    def _store_response(self, cache, cache_key, api, response, response_data, decoded):
+        entry = CacheEntry(response.status, response.reason, response.getheader('Content-Type') or '', response_data, decoded)
+        if entry.update(response.getheader, None, *cache.policy(api)):
+            cache.put(cache_key, entry)
+        else:
+            cache.remove(cache_key)
+
+    def _store_revalidated(self, cache, cache_key, entry, api, response):
+        if entry.update(response.getheader, None, *cache.policy(api)):
+            # stores that keep copies (e.g. on disk) need the new expiry
+            cache.put(cache_key, entry)
+        else:
+            cache.remove(cache_key)
+
+    def _revalidate(self, cache, cache_key, entry, api, url, headers):
+        '''Refreshes a stale cache entry in another thread, unless that's already happening.'''
+        if not cache.start_revalidation(cache_key):
+            return
+        headers = dict(headers)
+        headers.update(entry.validators())
+
+        def revalidate():
+            try:
+                (response, response_data) = self._send('GET', url, None, headers)
+                if response.status == 304:
+                    cache.count('revalidations')
+                    self._store_revalidated(cache, cache_key, entry, api, response)
+                elif response.status == 200:
+                    content_type = response.getheader('Content-Type') or ''
+                    decoded = response_data
+                    if content_type.startswith("application/json"):
+                        decoded = self.decode(response_data)
+                    self._store_response(cache, cache_key, api, response, response_data, decoded)
+            except (Exception, StandardError):
+                # the stale copy will do until it expires for good
+                pass
+            finally:
+                cache.finish_revalidation(cache_key)
+        # not a daemon, so a short-lived process (e.g. om_api) still finishes the job before exiting
+        thread = threading.Thread(target = revalidate, name = 'omega-cache-revalidate')
+        thread.start()
+
+    def _start_timing(self, method, url, api):
+        '''Starts timing a request, handing the record to _open_response() and running the request hooks.'''
+        timing = Timing(self._pool.name, method, self._cookie_url(url), api)
+        self._local.pending_timing = timing
+        self._start_metrics(timing)
+        self._run_hooks('request', timing)
+        return timing
+
+    def stream(self, method, api, params = (), output = None, get = None, headers = None, verbose = False, chunk_size = 65536, body = None, expect_continue = False):
+        '''Runs an API without buffering the response body in memory.
+
+        The body is passed along untouched (no decoding or unwrapping of the
+        result), either written to the file-like 'output' (returning the
+        number of bytes written) or, if no output is given, returned as an
+        iterator of byte chunks. HTTP error statuses raise exceptions as
+        request() does before any of the body is handed over. Request
+        bodies may be streamed too; see request().'''
+        (method, api, url, data, headers) = self._build_request(method, api, params, get, headers)
+        if body is not None:
+            data = body
+        if verbose:
+            self._log_request(method, url, data, headers)
+        timing = self._start_timing(method, url, api)
+        try:
+            (http, response) = self._open_response(method, url, data, headers, verbose, expect_continue)
+        except:
+            error = sys.exc_info()
+            self._local.pending_timing = None
+            self._fail_timing(timing, error[1])
+            raise error[0], error[1], error[2]
+        if response.status < 200 or response.status >= 300:
+            # errors are small, so read them in to report them as usual
+            response_data = self._read_body(http, response, verbose)
+            self._finish_timing(response)
+            self._decode_response(
+                api,
+                response.status,
+                response.reason,
+                response.getheader('Content-Type') or '',
+                response_data
+            )
+        chunks = self._iter_body(http, response, chunk_size, verbose)
+        if output is None:
+            return chunks
+        size = 0
+        for chunk in chunks:
+            output.write(chunk)
+            size += len(chunk)
+        return size
+
+    def iter_data(self, method, api, params = (), get = None, headers = None, verbose = False, chunk_size = 65536):
+        '''Runs an API and yields the items of its (list) data as they are decoded off the wire.
+
+        Memory use stays flat regardless of how many items come back. A
+        'result' of false raises an exception as request() would, though
+        only once it has been read; any items sent before it are yielded.'''
+        chunks = self.stream(method, api, params, None, get, headers, verbose, chunk_size)
+        return jsonstream.iter_data(chunks, self._codec.raw_decode)
+
+    def _cached_result(self, api, entry, raw_response = False, full_response = False, no_format = False):
+        if not entry.content_type.startswith("application/json"):
+            return entry.decoded
+        if raw_response:
+            # gets encoded again anyway, so there is no need to copy
+            result = entry.decoded
+        else:
+            result = entry.get_decoded()
+        return self._unwrap_result(api, entry.status, entry.reason, result, raw_response, full_response, no_format)
+
+    def request_many(self, calls, concurrency = 8, ordered = True, **opts):
+        '''Runs many API calls over several keep-alive connections at once.
+
+        'calls' is an iterable of (method, api, params) tuples; it is read
+        lazily, so generators of any size are fine. Any extra keyword
+        arguments are passed along to request(). Yields one dict per call:
+        {'index', 'call', 'result', 'data', 'error'}. Failed calls have a
+        'result' of False and their Exception in 'error'; the rest of the
+        batch carries on. Results come back in input order unless 'ordered'
+        is False, in which case they are yielded as they finish. Note that
+        no more than the pool's 'max_size' connections are used per host.'''
+        if concurrency < 1:
+            raise Exception('Invalid concurrency: %s.' % concurrency)
+        todo = Queue.Queue(concurrency * 2)
+        done = Queue.Queue()
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    todo.put(item, True, 0.1)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+
+        def feed():
+            count = 0
+            try:
+                for call in calls:
+                    if not put((count, call)):
+                        break
+                    count += 1
+            finally:
+                done.put(('total', count))
+                for i in range(concurrency):
+                    put(None)
+
+        def work():
+            while not stop.is_set():
+                try:
+                    item = todo.get(True, 0.1)
+                except Queue.Empty:
+                    continue
+                if item is None:
+                    break
+                (index, call) = item
+                outcome = {
+                    'index': index,
+                    'call': call,
+                    'result': True,
+                    'data': None,
+                    'error': None
+                }
+                try:
+                    (method, api, params) = call
+                    outcome['data'] = self.request(method, api, params, **opts)
+                except Exception, e:
+                    outcome['result'] = False
+                    outcome['error'] = e
+                except StandardError, e:
+                    outcome['result'] = False
+                    outcome['error'] = Exception('API call failed: %s' % str(e), call)
+                done.put(('call', outcome))
+
+        threads = [threading.Thread(target = feed)]
+        threads += [threading.Thread(target = work) for i in range(concurrency)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        total = None
+        finished = 0
+        next_index = 0
+        pending = {}
+        try:
+            while total is None or finished < total:
+                (kind, value) = done.get()
+                if kind == 'total':
+                    total = value
+                    continue
+                finished += 1
+                if not ordered:
+                    yield value
+                    continue
+                pending[value['index']] = value
+                while next_index in pending:
+                    yield pending.pop(next_index)
+                    next_index += 1
+        finally:
+            # let any calls still in flight finish up before we go
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+    def _build_request(self, method, api, params = (), get = None, headers = None):
+        '''Returns the method, quoted API, URL, body and headers to send for an API call.'''
+        (method, api, url, headers) = self._build_base(method, api, get, headers)
+        (url, data) = self._encode_params(method, url, params)
+        return (method, api, url, data, headers)
+
+    def _build_base(self, method, api, get = None, headers = None):
+        '''Returns the method, quoted API, URL (sans params) and headers for an API call.'''
         # check and prep the data
         if method is None or method == '':
             method = 'GET'
@@ -246,94 +1210,425 @@ class OmegaClient:
         if api == '' or api == None:
             raise Exception("Invalid service API: '%s'." %api)
         api = urllib.quote(api)
-        if self._credentials:
-            creds = self._credentials
-            md5 = hashlib.md5();
-            md5.update(':'.join(
-                [creds['username'], creds['password']]
-            ))
-            headers['Authentication'] = 'Basic ' + base64.b64encode(
-                md5.hexdigest())
-        http = self._http
+        # never touch the caller's headers; we may be running in many threads at once
+        if headers is None:
+            headers = {}
+        else:
+            headers = dict(headers)
+        if self._auth_header:
+            headers['Authentication'] = self._auth_header
         # figure our our URL and get args
-        url = self._url
         headers['Content-type'] = 'application/json'
         headers['Accept'] = 'application/json'
+        if self._accept_encoding and not 'Accept-Encoding' in headers:
+            headers['Accept-Encoding'] = self._accept_encoding
         url = util.pretty_path('/'.join(('', self._folder, api)), True)
         if get:
             url = '?'.join((url, get))
+        return (method, api, url, headers)
+
+    def _encode_params(self, method, url, params):
+        '''Returns the URL and body with the API params encoded into one or the other.'''
         if method == 'GET':
             url = '?'.join((url, '&'.join([
                 '='.join(
                     (urllib.quote(name), urllib.quote(str(params[name])))
                 ) for name in params
             ])))
-            data = None
-        else:
-            data = self.encode(params)
-        # fire away
-        if verbose:
-            if self._use_https:
-                proto = 'https'
-            else:
-                proto = 'http'
-            sys.stderr.write(
-                '# Request: %s %s://%s:%d%s, params: "%s", headers: "%s", cookies: "%s"\n' %
-                ((method, proto, self._hostname, self._port, url, data, str(headers), str(http.cookies)))
-            )
-        #http.request(method, url, data, headers)
-        # be willing to try again if the socket got closed on us (e.g. timeout)
-        tries = 0
-        max_tries = 3
+            return (url, None)
+        return (url, self.encode(params))
+
+    def _log_request(self, method, url, data, headers):
+        if data is not None and not isinstance(data, basestring):
+            data = '(streamed %s)' % type(data).__name__
+        sys.stderr.write(
+            '# Request: %s %s://%s:%s%s, params: "%s", headers: "%s", cookies: "%s"\n' %
+            ((method,) + self._get_pool_key() + (url, data, str(headers), self._cookie_jar.get_header(self._cookie_url(url))))
+        )
+
+    def _log_response(self, status, reason, header_lines):
+        sys.stderr.write(
+            '# Response Status: %s %s\n# Response Headers: %s\n' %
+            (status, reason, self.encode(header_lines))
+        )
+
+    def _cookie_url(self, url):
+        (scheme, host, port) = self._get_pool_key()
+        if scheme == 'unix':
+            # a socket has no host name, so its (quoted) path stands in for one
+            return 'http://%s%s' % (urllib.quote(host, ''), url)
+        return '%s://%s:%s%s' % (scheme, host, port, url)
+
+    def _save_cookies(self, url, cookies, verbose = False):
+        '''Remembers the cookies from a list of Set-Cookie header values sent in response to the URL.'''
+        if cookies:
+            if verbose:
+                for cookie in cookies:
+                    sys.stderr.write('# Response Cookie: %s\n' % (cookie))
+            self._cookie_jar.extract(self._cookie_url(url), cookies)
+
+    def _send(self, method, url, data, headers, verbose = False, expect_continue = False):
+        '''Sends a request over a pooled connection and returns the response and its body.'''
+        (http, response) = self._open_response(method, url, data, headers, verbose, expect_continue)
+        return (response, self._read_body(http, response, verbose))
+
+    def _send_hedged(self, method, url, data, headers, verbose = False):
+        '''Sends a request, racing a second copy of it if the first is slow; see set_hedging().'''
+        primary = self._local.pending_timing
+
+        def send(racer):
+            self._local.racer = racer
+            if getattr(self._local, 'pending_timing', None) is None:
+                # the hedge runs in its own thread, so gets its own record
+                self._local.pending_timing = Timing(self._pool.name, method, primary.url, primary.api)
+            try:
+                return (self._send(method, url, data, dict(headers), verbose), self._local.transfer)
+            finally:
+                self._local.racer = None
+        (sent, self._local.transfer) = self._hedger.run(send)
+        return sent
+
+    def _open_response(self, method, url, data, headers, verbose = False, expect_continue = False):
+        '''Sends a request over a pooled connection and returns the connection and response, body unread.'''
+        pool = self._pool
+        key = self._get_pool_key()
         response = None
-        while tries < max_tries and response is None:
-            tries += 1
+        streamed = data is not None and not isinstance(data, basestring)
+        if streamed:
+            body_len = self._body_length(data)
+        elif data:
+            body_len = len(data)
+        transfer = {
+            'request_bytes': 0,
+            'request_wire_bytes': 0,
+            'response_bytes': 0,
+            'response_wire_bytes': 0
+        }
+        if not streamed and data:
+            transfer['request_bytes'] = len(data)
+            (data, headers) = self._compress_body(data, headers)
+            body_len = len(data)
+        has_body = streamed or bool(data)
+        cookie = self._cookie_jar.get_header(self._cookie_url(url))
+        attempt = self._retry_policy.start(key, method)
+        racer = getattr(self._local, 'racer', None)
+        timing = getattr(self._local, 'pending_timing', None)
+        self._local.pending_timing = None
+        if timing is None:
+            timing = Timing(self._pool.name, method, self._cookie_url(url))
+        balancer = self._balancer
+        endpoint = None
+        tried = []
+        rejected = []
+        if balancer is not None:
+            attempt.failover = len(balancer.endpoints) > 1
+        while response is None:
+            if balancer is not None:
+                # each try may go to a different server
+                endpoint = balancer.pick(tried, rejected)
+                key = attempt.key = endpoint.key
+                try:
+                    attempt.next()
+                except Exception:
+                    # its circuit is open, but another server may well be fine
+                    balancer.release(endpoint)
+                    rejected.append(endpoint)
+                    if len(rejected) == len(balancer.endpoints):
+                        raise
+                    continue
+                except:
+                    balancer.release(endpoint)
+                    raise
+                tried.append(endpoint)
+            else:
+                attempt.next()
+            queued = time.time()
+            permit = None
+            try:
+                if self._limiter is not None:
+                    permit = self._limiter.acquire('%s://%s:%s' % key, timing.api)
+                http = pool.get(*key)
+            except:
+                if permit is not None:
+                    permit.release()
+                if endpoint is not None:
+                    balancer.release(endpoint)
+                raise
+            sent = False
+            started = time.time()
+            timing.queue += started - queued
+            timing.tries += 1
             try:
+                if racer is not None:
+                    racer.attach(http)
+                # connect up front so we know whether a failure happened before anything went out
+                timing.reused = http.sock is not None
+                if not timing.reused:
+                    pool.connect(http, timing)
+                sent = True
+                sending = time.time()
                 # start the request
                 http.putrequest(method, url)
                 # send our headers
                 for hdr, value in headers.iteritems():
                     http.putheader(hdr, value);
                 # and our cookies too!
-                if http.cookies:
-                    [http.putheader('Cookie', value) for value in http.cookies]
+                if cookie:
+                    http.putheader('Cookie', cookie)
                 # write the body
-                header_names = headers.fromkeys([k.lower() for k in headers])
-                if data:
-                    body_len = len(data)
-                    if body_len:
+                if has_body:
+                    if body_len is None:
+                        http.putheader('Transfer-Encoding', 'chunked')
+                    else:
                         http.putheader('Content-Length', str(body_len))
-                http.endheaders()
-                if data:
-                    http.send(data)
+                    if expect_continue:
+                        http.putheader('Expect', '100-continue')
+                if has_body and not streamed and not expect_continue:
+                    # in one write, or Nagle holds the body back until the server's delayed ACK (~40ms)
+                    http.endheaders(data)
+                    transfer['request_wire_bytes'] = len(data)
+                else:
+                    http.endheaders()
+                if has_body and (streamed or expect_continue):
+                    if expect_continue:
+                        response = self._await_continue(http, method)
+                    if response is None:
+                        wire_bytes = self._send_body(http, data, body_len is None)
+                        transfer['request_wire_bytes'] = wire_bytes
+                        if streamed:
+                            transfer['request_bytes'] = wire_bytes
                 # get our response back from the server and parse
-                response = http.getresponse()
-            except socket.error, v:
-                http.connect()
+                waiting = time.time()
+                timing.send += waiting - sending
+                if response is None:
+                    response = http.getresponse()
+                    timing.wait += time.time() - waiting
+            except (socket.error, httplib.HTTPException), e:
+                pool.discard(http)
+                if permit is not None:
+                    # timing out is a sign of overload; a refused connection isn't
+                    permit.release(overloaded = isinstance(e, socket.timeout))
+                if racer is not None and racer.cancelled:
+                    if endpoint is not None:
+                        balancer.release(endpoint)
+                    raise Exception('Request cancelled.')
+                if endpoint is not None:
+                    balancer.failure(endpoint)
+                # a streamed body can only be read once, so there is no sending it again
+                if not attempt.failure(sent, retryable = not streamed):
+                    raise Exception('HTTP request to %s://%s:%s failed after %d %s: %s' %
+                        (key + (attempt.tries, attempt.tries == 1 and 'try' or 'tries', str(e) or e.__class__.__name__)))
+                if verbose:
+                    sys.stderr.write('# Retry: %s after %.3fs\n' % (str(e) or e.__class__.__name__, attempt.last_delay))
+                response = None
+                continue
             except:
-                http.close()
-        if response is None:
-            raise Exception('HTTP request failed and could not be retried.')
+                pool.discard(http)
+                if permit is not None:
+                    permit.release()
+                if endpoint is not None:
+                    balancer.release(endpoint)
+                raise
+            # the slot stays taken until the body is in; see _release_permit()
+            response.permit = None
+            if permit is not None:
+                response.permit = (permit, response.status, time.time() - sending)
+            if response.status in self._retry_policy.statuses:
+                # not worth holding onto through the backoff, or for an error's body
+                self._release_permit(response)
+                if endpoint is not None:
+                    balancer.failure(endpoint)
+                retry_after = response.getheader('Retry-After')
+                if attempt.failure(True, retry_after, not streamed):
+                    if verbose:
+                        sys.stderr.write('# Retry: %d %s after %.3fs\n' % (response.status, response.reason, attempt.last_delay))
+                    response.read()
+                    self._release(http, response)
+                    response = None
+            else:
+                if endpoint is not None:
+                    balancer.success(endpoint, time.time() - started)
+                attempt.success()
+        response.transfer = transfer
+        response.tries = attempt.tries
+        response.timing = timing
+        response.inflater = None
         # see if we get a cookie back
-        response_headers = str(response.msg).split('\n');
-        cookies = [c.split(': ')[1].split('; ')[0] for c in response_headers if c.startswith('Set-Cookie: ')]
-        if cookies:
-            # note that we ignore the path
-            if verbose:
-                for cookie in cookies:
-                    sys.stderr.write('# Response Cookie: %s\n' % (cookie))
-            http.cookies = cookies
+        self._save_cookies(url, response.msg.getheaders('Set-Cookie'), verbose)
+        if verbose:
+            self._log_response(
+                response.status,
+                response.reason,
+                str(response.msg).strip().split('\r\n')
+            )
+        return (http, response)
+
+    def _body_length(self, body):
+        '''Returns the number of bytes left in a streamed body, or None if it can't be known up front.'''
+        if isinstance(body, mmap.mmap):
+            return len(body) - body.tell()
+        if hasattr(body, 'fileno') and hasattr(body, 'tell'):
+            try:
+                return os.fstat(body.fileno()).st_size - body.tell()
+            except (OSError, IOError, ValueError):
+                pass
+        return None
+
+    def _compress_body(self, data, headers):
+        '''Gzips a request body if it's big enough to be worth it; returns the body and headers to send.'''
+        if self._compress_threshold is None or len(data) < self._compress_threshold:
+            return (data, headers)
+        if 'Content-Encoding' in headers:
+            return (data, headers)
+        headers = dict(headers)
+        headers['Content-Encoding'] = 'gzip'
+        return (compression.gzip(data, self._compress_level), headers)
+
+    def _send_body(self, http, body, chunked = False, chunk_size = 65536):
+        '''Sends a request body, returning the number of bytes sent.'''
+        if isinstance(body, basestring):
+            http.send(body)
+            return len(body)
+        sent = 0
+        if hasattr(body, 'read'):
+            chunks = iter(lambda: body.read(chunk_size), '')
+        else:
+            chunks = body
+        for chunk in chunks:
+            if not chunk:
+                continue
+            if chunked:
+                http.send('%x\r\n%s\r\n' % (len(chunk), chunk))
+            else:
+                http.send(chunk)
+            sent += len(chunk)
+        if chunked:
+            http.send('0\r\n\r\n')
+        return sent
+
+    def _await_continue(self, http, method):
+        '''Waits for '100 Continue' before a body is sent. Returns the final response if the server answered early instead.'''
+        if http.sock is None:
+            # not a socket based transport; the body may as well go now
+            return None
+        (readable, writable, errored) = select.select([http.sock], [], [], self._continue_timeout)
+        if not readable:
+            # no word from the server; send the body anyway
+            return None
+        # unbuffered, so we read no further than the interim response
+        fp = http.sock.makefile('rb', 0)
+        line = fp.readline(65537)
+        if line.split(None, 2)[1:2] == ['100']:
+            while True:
+                line = fp.readline(65537)
+                if line in ('\r\n', '\n', ''):
+                    return None
+        response = http.response_class(_PrefixedFile(line, fp), method = method)
+        response.begin()
+        # we never sent the body we promised, so the connection can't be reused
+        response.will_close = True
+        return response
+
+    def _release_permit(self, response):
+        '''Frees the limiter slot (if any) a response has held since its request went out, learning from its time to first byte.'''
+        if response.permit is None:
+            return
+        (permit, status, latency) = response.permit
+        response.permit = None
+        permit.release(status, latency)
+
+    def _release(self, http, response):
+        '''Hands a connection back to the pool once its response has been read.'''
+        self._release_permit(response)
+        racer = getattr(self._local, 'racer', None)
+        if racer is not None:
+            racer.detach(http)
+        if response.will_close:
+            self._pool.discard(http)
+        else:
+            self._pool.put(http)
+
+    def _read_body(self, http, response, verbose = False):
+        '''Reads (and decompresses) a whole response body, handing the connection back to the pool.'''
+        reading = time.time()
+        try:
+            response_data = self._inflate(response, response.read(), True)
+            response.timing.transfer += time.time() - reading
+        except:
+            self._release_permit(response)
+            self._pool.discard(http)
+            raise
+        self._release(http, response)
+        self._record_transfer(response.transfer, verbose)
+        return response_data
+
+    def _iter_body(self, http, response, chunk_size, verbose = False):
+        complete = False
+        timing = response.timing
+        try:
+            while True:
+                # only our own reading counts, not what the caller does with each chunk
+                reading = time.time()
+                chunk = response.read(chunk_size)
+                if not chunk:
+                    break
+                chunk = self._inflate(response, chunk)
+                timing.transfer += time.time() - reading
+                if chunk:
+                    yield chunk
+            chunk = self._inflate(response, '', True)
+            timing.transfer += time.time() - reading
+            if chunk:
+                yield chunk
+            complete = True
+        finally:
+            # a half-read response leaves the connection unusable
+            if complete:
+                self._release(http, response)
+                self._record_transfer(response.transfer, verbose)
+                self._finish_timing(response)
+            else:
+                self._release_permit(response)
+                self._pool.discard(http)
+                self._fail_timing(timing, Exception('Response body was not read to the end.'))
+
+    def _inflate(self, response, data, final = False):
+        if response.inflater is None:
+            response.inflater = compression.Inflater(response.getheader('Content-Encoding'))
+        response.transfer['response_wire_bytes'] += len(data)
+        data = response.inflater.decompress(data)
+        if final:
+            data += response.inflater.flush()
+        response.transfer['response_bytes'] += len(data)
+        return data
+
+    def _record_transfer(self, transfer, verbose = False):
+        self._local.transfer = transfer
+        self._transfer_lock.acquire()
+        try:
+            self._transfer['requests'] += 1
+            for name in transfer:
+                self._transfer[name] += transfer[name]
+        finally:
+            self._transfer_lock.release()
         if verbose:
             sys.stderr.write(
-                '# Response Status: %s %s\n# Response Headers: %s\n' %
-                (response.status, response.reason, self.encode(
-                    str(response.msg).strip().split('\r\n')
-                ))
+                '# Transfer: sent %d bytes (%d uncompressed), received %d bytes (%d uncompressed)\n' %
+                (transfer['request_wire_bytes'], transfer['request_bytes'],
+                transfer['response_wire_bytes'], transfer['response_bytes'])
             )
-        content_type = response.getheader('Content-Type') or '';
-        response_data = response.read();
+
+    def _handle_response(self, api, status, reason, content_type, response_data, raw_response = False, full_response = False, no_format = False):
+        '''Checks the status and result of an API response, returning the data as requested.'''
+        result = self._decode_response(api, status, reason, content_type, response_data, raw_response, full_response)
+        if not content_type.startswith("application/json"):
+            return result
+        return self._unwrap_result(api, status, reason, result, raw_response, full_response, no_format)
+
+    def _decode_response(self, api, status, reason, content_type, response_data, raw_response = False, full_response = False):
+        '''Raises an exception for HTTP errors; otherwise returns the decoded JSON response (or the raw data if not JSON).'''
         # handle any errors based on status code
-        if response.status < 200 or response.status >= 300:
+        if status < 200 or status >= 300:
             if content_type.startswith("application/json"):
                 try:
                     result = self.decode(response_data)
@@ -352,27 +1647,30 @@ class OmegaClient:
                 else:
                     msg = dbg.obj2str(result)
                 raise Exception('API "%s" failed (%d %s)\n%s' %
-                    (urllib.unquote(api), response.status, response.reason, msg))
+                    (urllib.unquote(api), status, reason, msg))
             else:
                 if raw_response:
                     msg = response_data
                 else:
                     msg = error
                 raise Exception('API "%s" failed (%d %s)\n%s' %
-                     (api, response.status, response.reason, msg))
+                     (api, status, reason, msg))
         # return a raw response if needed; otherwise decode if JSON
         if not content_type.startswith("application/json"):
             return response_data
         try:
-            result = self.decode(response_data)
+            return self.decode(response_data)
         except:
             raise Exception('Failed to decode API result\n' + response_data)
+
+    def _unwrap_result(self, api, status, reason, result, raw_response = False, full_response = False, no_format = False):
+        '''Checks a decoded API result for success and picks out the data portion (unless everything is requested).'''
         # check to see if our API call was successful
         if 'result' in result and result['result'] == False:
             if 'reason' in result:
                 if full_response:
                     raise Exception('"%s" failed (%d %s):\n%s' %
-                        (urllib.unquote(api), response.status, response.reason, dbg.obj2str(result)))
+                        (urllib.unquote(api), status, reason, dbg.obj2str(result)))
                 else:
                     raise Exception(result['reason'])
             else:
@@ -381,17 +1679,14 @@ class OmegaClient:
             # all is well, return the data portion of the response (unless everything is requested)
             if full_response:
                 if raw_response:
-                    if no_format:
-                        result = json.dumps(result, sort_keys = True) + "\n"
-                    else:
-                        result = json.dumps(result, sort_keys = True, indent = 4) + "\n"
+                    result = self._codec.format(result, not no_format) + "\n"
             else:
                 if raw_response:
                     if 'data' in result:
                         if no_format:
                             result = self.encode(result['data']) + "\n"
                         else:
-                            result = json.dumps(result['data'], sort_keys = True, indent = 4) + "\n"
+                            result = self._codec.format(result['data']) + "\n"
                     else:
                         result = '{}'
                 else:
@@ -0,0 +1,88 @@
+#!/usr/bin/python -tt
+
+# omega - python client
+# https://github.com/jfillmore/Omega-API-Engine
+#
+# Copyright 2011, Jonathon Fillmore
+# Licensed under the MIT license. See LICENSE file.
+# http://www.opensource.org/licenses/mit-license.php
+
+
+"""Single-flight request coalescing: identical requests made at the same time share one trip to the server."""
+
+import sys
+import copy
+import threading
+
+
+class _Flight:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.waiters = 0
+        self.result = None
+        self.error = None
+
+
+class Coalescer:
+    """Runs one copy of each request at a time; see OmegaClient.set_coalescing().
+
+    While a request is in flight, others with the same key wait for it
+    rather than being sent too. Each gets its own deep copy of the result,
+    so callers may change what they're given, or the same exception."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._stats = {
+            'requests': 0,
+            'sent': 0,
+            'coalesced': 0
+        }
+
+    def run(self, key, send):
+        '''Returns the result of 'send()', or of the identical request already in flight under 'key'.'''
+        self._lock.acquire()
+        try:
+            self._stats['requests'] += 1
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+                self._stats['sent'] += 1
+                leader = True
+            else:
+                flight.waiters += 1
+                self._stats['coalesced'] += 1
+                leader = False
+        finally:
+            self._lock.release()
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error[0], flight.error[1], flight.error[2]
+            return copy.deepcopy(flight.result)
+        try:
+            flight.result = send()
+        except:
+            flight.error = sys.exc_info()
+        self._lock.acquire()
+        try:
+            # anyone asking from now on sends their own request
+            del self._flights[key]
+        finally:
+            self._lock.release()
+        flight.done.set()
+        if flight.error is not None:
+            raise flight.error[0], flight.error[1], flight.error[2]
+        if flight.waiters:
+            # the waiters are copying the original, so it mustn't change underneath them
+            return copy.deepcopy(flight.result)
+        return flight.result
+
+    def stats(self):
+        '''Returns how many requests were made, how many were sent and how many were saved by sharing another's.'''
+        self._lock.acquire()
+        try:
+            return dict(self._stats)
+        finally:
+            self._lock.release()
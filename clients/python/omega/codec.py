@@ -0,0 +1,161 @@
+#!/usr/bin/python -tt
+
+# omega - python client
+# https://github.com/jfillmore/Omega-API-Engine
+#
+# Copyright 2011, Jonathon Fillmore
+# Licensed under the MIT license. See LICENSE file.
+# http://www.opensource.org/licenses/mit-license.php
+
+
+"""JSON codecs, using the fastest exact backend available (simplejson w/ speedups, then the stdlib), or ujson if asked for."""
+
+import json
+
+from error import Exception
+
+# backend name => module
+_backends = {}
+try:
+    import ujson
+    _backends['ujson'] = ujson
+except ImportError:
+    pass
+try:
+    import simplejson
+    _backends['simplejson'] = simplejson
+except ImportError:
+    pass
+_backends['json'] = json
+
+
+# ujson (1.x at least) rounds floats to 15 digits or fewer when encoding, so is only used when asked for
+_lossy = ('ujson',)
+
+
+def _has_speedups(name):
+    if name == 'simplejson':
+        try:
+            from simplejson import _speedups
+            return True
+        except ImportError:
+            return False
+    return True
+
+
+def get_backends():
+    '''Returns the names of the available backends, fastest first.'''
+    order = ['ujson', 'simplejson', 'json']
+    # simplejson without its C extension is slower than the stdlib
+    if 'simplejson' in _backends and not _has_speedups('simplejson'):
+        order.remove('simplejson')
+        order.append('simplejson')
+    return [name for name in order if name in _backends]
+
+
+def get_default_backend():
+    '''Returns the name of the fastest backend that encodes and decodes numbers exactly.'''
+    return [name for name in get_backends() if not name in _lossy][0]
+
+
+class Codec:
+    """Encodes/decodes JSON with a given backend (by default the fastest exact one).
+
+    With 'pretty' set, format() (used for raw responses) sorts keys and
+    indents; without it format() just encodes as fast as it can. ujson is
+    fastest, but only used if named: floats it encodes may lose precision."""
+
+    def __init__(self, backend = None, pretty = True):
+        if backend is None:
+            backend = get_default_backend()
+        if not backend in _backends:
+            raise Exception("JSON backend '%s' is not available. Available backends: %s." %
+                (backend, ', '.join(get_backends())))
+        self.name = backend
+        self.pretty = pretty
+        module = _backends[backend]
+        if backend == 'ujson':
+            self.encode = module.dumps
+            self.decode = _precise_loads(module)
+            self._dumps = module.dumps
+            # ujson has no raw_decode, which incremental decoding needs
+            self.raw_decode = json.JSONDecoder().raw_decode
+        else:
+            self.encode = module.JSONEncoder().encode
+            self.decode = module.JSONDecoder().decode
+            self._dumps = module.dumps
+            self.raw_decode = module.JSONDecoder().raw_decode
+
+    def format(self, obj, indent = True):
+        '''Encodes an object for display: keys sorted and (optionally) indented, unless not pretty.'''
+        if not self.pretty:
+            return self.encode(obj)
+        if indent:
+            return self._dumps(obj, sort_keys = True, indent = 4)
+        return self._dumps(obj, sort_keys = True)
+
+
+def _precise_loads(module):
+    '''Returns ujson's loads(), decoding floats exactly where it can (it rounds them by default, for speed).'''
+    try:
+        module.loads('0.1', precise_float = True)
+    except TypeError:
+        return module.loads
+    return lambda text: module.loads(text, precise_float = True)
+
+
+_default = None
+
+def get_codec(backend = None, pretty = True):
+    '''Returns a codec for the given backend, or the fastest exact one available.'''
+    global _default
+    if backend is None and pretty:
+        if _default is None:
+            _default = Codec()
+        return _default
+    return Codec(backend, pretty)
+
+
+if __name__ == '__main__':
+    # benchmark the available backends against some typical Omega payloads
+    import sys
+    import time
+
+    def timed(func, arg, min_time = 0.5):
+        count = 0
+        start = time.time()
+        while True:
+            func(arg)
+            count += 1
+            elapsed = time.time() - start
+            if elapsed >= min_time:
+                return elapsed / count
+
+    row = {
+        'id': 123456,
+        'name': u'Example Service \u2603',
+        'enabled': True,
+        'balance': 1234.56,
+        'created': '2011-07-04 12:34:56',
+        'tags': ['alpha', 'beta', 'gamma'],
+        'owner': {'username': 'jdoe', 'email': 'jdoe@example.com', 'groups': [1, 2, 3]},
+        'notes': None
+    }
+    payloads = [
+        ('small', {'result': True, 'data': row}),
+        ('list-1k', {'result': True, 'data': [dict(row, id = i) for i in range(1000)]}),
+        ('list-50k', {'result': True, 'data': [dict(row, id = i) for i in range(50000)]})
+    ]
+    sys.stdout.write('%-12s %-10s %12s %12s %12s\n' %
+        ('backend', 'payload', 'encode ms', 'decode ms', 'format ms'))
+    for backend in get_backends():
+        codec = Codec(backend)
+        for (name, payload) in payloads:
+            encoded = codec.encode(payload)
+            sys.stdout.write('%-12s %-10s %12.3f %12.3f %12.3f\n' % (
+                backend,
+                name,
+                timed(codec.encode, payload) * 1000,
+                timed(codec.decode, encoded) * 1000,
+                timed(codec.format, payload) * 1000
+            ))
@@ -0,0 +1,66 @@
+#!/usr/bin/python -tt
+
+# omega - python client
+# https://github.com/jfillmore/Omega-API-Engine
+#
+# Copyright 2011, Jonathon Fillmore
+# Licensed under the MIT license. See LICENSE file.
+# http://www.opensource.org/licenses/mit-license.php
+
+
+"""Content-Encoding support: streaming inflate of responses and gzip of request bodies."""
+
+import zlib
+
+from error import Exception
+
+ACCEPT_ENCODING = 'gzip, deflate'
+
+
+class Inflater:
+    """Incrementally decodes a response body according to its Content-Encoding."""
+
+    def __init__(self, encoding):
+        encoding = (encoding or '').strip().lower()
+        self.encoding = encoding
+        self._started = False
+        if encoding in ('gzip', 'x-gzip'):
+            self._obj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            self._obj = zlib.decompressobj()
+        elif encoding in ('', 'identity'):
+            self._obj = None
+        else:
+            raise Exception('Unsupported response content encoding: %s.' % encoding)
+
+    def decompress(self, data):
+        if self._obj is None or not data:
+            return data
+        if self.encoding == 'deflate' and not self._started:
+            self._started = True
+            try:
+                return self._obj.decompress(data)
+            except zlib.error:
+                # plenty of servers send raw deflate data without the zlib wrapper
+                self._obj = zlib.decompressobj(-zlib.MAX_WBITS)
+        try:
+            return self._obj.decompress(data)
+        except zlib.error, e:
+            raise Exception('Failed to decompress %s response: %s' % (self.encoding, str(e)))
+
+    def flush(self):
+        if self._obj is None:
+            return ''
+        return self._obj.flush()
+
+
+def inflate(encoding, data):
+    '''Decodes a complete response body according to its Content-Encoding.'''
+    inflater = Inflater(encoding)
+    return inflater.decompress(data) + inflater.flush()
+
+
+def gzip(data, level = 6):
+    '''Returns the data gzip compressed.'''
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
@@ -0,0 +1,254 @@
+#!/usr/bin/python -tt
+
+# omega - python client
+# https://github.com/jfillmore/Omega-API-Engine
+#
+# Copyright 2011, Jonathon Fillmore
+# Licensed under the MIT license. See LICENSE file.
+# http://www.opensource.org/licenses/mit-license.php
+
+
+"""In-memory cookie jar, saved to disk in batches (on exit or on a timer) rather than on every request."""
+
+import os
+import atexit
+import hashlib
+import tempfile
+import threading
+import weakref
+import cookielib
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class _Request:
+    """Just enough of urllib2.Request for cookielib."""
+
+    def __init__(self, url):
+        self._url = url
+        (self._type, rest) = url.split('://', 1)
+        self._host = rest.split('/', 1)[0]
+        self.headers = {}
+
+    def get_full_url(self):
+        return self._url
+
+    def get_host(self):
+        return self._host
+
+    def get_type(self):
+        return self._type
+
+    def get_origin_req_host(self):
+        return self._host.split(':', 1)[0]
+
+    def is_unverifiable(self):
+        return False
+
+    def has_header(self, name):
+        return name in self.headers
+
+    def get_header(self, name, default = None):
+        return self.headers.get(name, default)
+
+    def header_items(self):
+        return self.headers.items()
+
+    def add_unredirected_header(self, name, value):
+        self.headers[name] = value
+
+
+class _Headers:
+    """Just enough of a response's headers for cookielib."""
+
+    def __init__(self, set_cookies):
+        self._set_cookies = set_cookies
+
+    def info(self):
+        return self
+
+    def getheaders(self, name):
+        if name.lower() == 'set-cookie':
+            return self._set_cookies
+        return []
+
+
+# every jar with a file, so one hook can save them all at exit without keeping them alive
+_jars = weakref.WeakSet()
+# (path, credentials) => the jar shared by everyone using that file as that user; see shared_jar()
+_shared = {}
+_shared_lock = threading.Lock()
+
+
+def shared_jar(path, credentials = None):
+    '''Returns the one CookieJar for a file and set of credentials, so clients using them needn't each load it and save it.
+
+    Clients with different credentials get different jars, so one can't
+    pick up the session another logged in with.'''
+    path = os.path.abspath(os.path.expanduser(path))
+    if credentials:
+        # no sense keeping passwords around in the key
+        credentials = hashlib.sha1(repr(sorted(credentials.items()))).hexdigest()
+    else:
+        credentials = None
+    _shared_lock.acquire()
+    try:
+        jar = _shared.get((path, credentials))
+        if jar is None:
+            jar = _shared[(path, credentials)] = CookieJar(path)
+        return jar
+    finally:
+        _shared_lock.release()
+
+
+def _save_all():
+    for jar in list(_jars):
+        try:
+            jar.save()
+        except (IOError, OSError):
+            pass
+
+atexit.register(_save_all)
+
+
+class CookieJar:
+    """Thread-safe cookie jar shared by every request a client makes.
+
+    Cookies are kept in memory and written to 'path' (Netscape cookie file
+    format, as curl uses) when the process exits, and every 'save_interval'
+    seconds if given. Writes merge with what's on disk under an exclusive
+    lock and land atomically, so concurrent processes don't clobber each
+    other. Session cookies are kept too, so later processes can pick up
+    the server session. Clients sharing a file (and credentials) should
+    share its jar too; see shared_jar()."""
+
+    def __init__(self, path = None, save_interval = None):
+        self.path = path
+        self.save_interval = save_interval
+        self._jar = cookielib.MozillaCookieJar()
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._timer = None
+        if path is not None:
+            self.load()
+            _jars.add(self)
+            if save_interval:
+                self._start_timer()
+
+    def __del__(self):
+        # whatever hasn't been saved yet would be lost with us
+        try:
+            self.save()
+        except (IOError, OSError):
+            pass
+
+    def get_header(self, url):
+        '''Returns the Cookie header value to send to the URL, if any.'''
+        request = _Request(url)
+        self._jar.add_cookie_header(request)
+        return request.get_header('Cookie')
+
+    def extract(self, url, set_cookies):
+        '''Stores the cookies from the Set-Cookie header values of a response to the URL.'''
+        if not set_cookies:
+            return
+        self._jar.extract_cookies(_Headers(set_cookies), _Request(url))
+        self._dirty = True
+
+    def clear(self):
+        self._jar.clear()
+        self._dirty = True
+
+    def __iter__(self):
+        return iter(self._jar)
+
+    def _lock_file(self, exclusive = False):
+        if fcntl is None:
+            return None
+        handle = open(self.path + '.lock', 'a')
+        if exclusive:
+            fcntl.flock(handle.fileno(), fcntl.LOCK_EX)
+        else:
+            fcntl.flock(handle.fileno(), fcntl.LOCK_SH)
+        return handle
+
+    def _unlock_file(self, handle):
+        if handle is not None:
+            fcntl.flock(handle.fileno(), fcntl.LOCK_UN)
+            handle.close()
+
+    def load(self):
+        '''Loads any cookies saved on disk into the jar.'''
+        if self.path is None or not os.path.exists(self.path):
+            return
+        lock = self._lock_file()
+        try:
+            self._jar.load(self.path, ignore_discard = True)
+        except (IOError, cookielib.LoadError):
+            # e.g. not a cookie file; we'll replace it on our next save
+            pass
+        finally:
+            self._unlock_file(lock)
+
+    def save(self):
+        '''Writes the jar to disk (if anything changed), merged with whatever other processes saved.'''
+        if self.path is None or not self._dirty:
+            return
+        self._lock.acquire()
+        try:
+            lock = self._lock_file(True)
+            try:
+                merged = cookielib.MozillaCookieJar()
+                if os.path.exists(self.path):
+                    try:
+                        merged.load(self.path, ignore_discard = True)
+                    except (IOError, cookielib.LoadError):
+                        pass
+                # ours are newer; copied under cookielib's lock, as requests may be adding to them
+                self._jar._cookies_lock.acquire()
+                try:
+                    ours = list(self._jar)
+                finally:
+                    self._jar._cookies_lock.release()
+                for cookie in ours:
+                    merged.set_cookie(cookie)
+                (fd, tmp_path) = tempfile.mkstemp(
+                    prefix = '.' + os.path.basename(self.path),
+                    dir = os.path.dirname(self.path) or '.')
+                os.close(fd)
+                try:
+                    merged.save(tmp_path, ignore_discard = True)
+                    os.chmod(tmp_path, 0600)
+                    os.rename(tmp_path, self.path)
+                except:
+                    os.unlink(tmp_path)
+                    raise
+                self._dirty = False
+            finally:
+                self._unlock_file(lock)
+        finally:
+            self._lock.release()
+
+    def _start_timer(self):
+        def save_loop():
+            while True:
+                self._timer_event.wait(self.save_interval)
+                if self._timer_event.is_set():
+                    return
+                try:
+                    self.save()
+                except (IOError, OSError):
+                    pass
+        self._timer_event = threading.Event()
+        self._timer = threading.Thread(target = save_loop, name = 'omega-cookie-saver')
+        self._timer.daemon = True
+        self._timer.start()
+
+    def stop(self):
+        '''Stops the save timer (if any) and saves one last time.'''
+        if self._timer is not None:
+            self._timer_event.set()
+            self._timer = None
+        self.save()
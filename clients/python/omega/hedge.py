@@ -0,0 +1,274 @@
+#!/usr/bin/python -tt
+
+# omega - python client
+# https://github.com/jfillmore/Omega-API-Engine
+#
+# Copyright 2011, Jonathon Fillmore
+# Licensed under the MIT license. See LICENSE file.
+# http://www.opensource.org/licenses/mit-license.php
+
+
+"""Hedged requests: if a request is slower than usual, send a second copy and keep whichever answers first."""
+
+import sys
+import time
+import socket
+import heapq
+import itertools
+import threading
+import Queue
+import collections
+
+from error import Exception
+
+
+class Racer:
+    """One copy of a hedged request; tracks the connections it uses so it can be cancelled."""
+
+    def __init__(self):
+        self.cancelled = False
+        self._lock = threading.Lock()
+        self._conns = []
+
+    def attach(self, conn):
+        '''Notes a connection the request is about to use; raises if the request was cancelled.'''
+        self._lock.acquire()
+        try:
+            if self.cancelled:
+                raise Exception('Request cancelled.')
+            self._conns.append(conn)
+        finally:
+            self._lock.release()
+
+    def detach(self, conn):
+        '''Forgets a connection once it's done with (e.g. back in the pool for others to use).'''
+        self._lock.acquire()
+        try:
+            if conn in self._conns:
+                self._conns.remove(conn)
+        finally:
+            self._lock.release()
+
+    def cancel(self):
+        '''Aborts the request by shutting down its connection(s), or just its stream of one, underneath it.'''
+        self._lock.acquire()
+        try:
+            self.cancelled = True
+            conns = self._conns
+            self._conns = []
+        finally:
+            self._lock.release()
+        for conn in conns:
+            if hasattr(conn, 'cancel'):
+                # e.g. one stream of a connection that other requests are still using
+                conn.cancel()
+            elif conn.sock is not None:
+                try:
+                    conn.sock.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+
+
+class Hedger:
+    """Decides when to hedge a request and races the copies.
+
+    Once a request has taken longer than the 'percentile' of recent
+    latencies (the last 'window' requests; 'initial_delay' until there are
+    enough of them), a second copy is sent. Hedges are limited to 'budget'
+    (e.g. 0.05 for 5%) of the requests sent, so a slow backend doesn't get
+    twice the load. One scheduler thread (while there are requests that
+    may need hedging) sends the hedges that come due."""
+
+    def __init__(self, percentile = 95, budget = 0.05, initial_delay = 0.1, min_delay = 0.005, window = 1000):
+        self.percentile = percentile
+        self.budget = budget
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self._lock = threading.Lock()
+        self._latencies = collections.deque(maxlen = window)
+        self._delay = initial_delay
+        self._unsorted = 0
+        self._tokens = 0.0
+        self._cond = threading.Condition()
+        self._due = [] # heap of (when, seq, fire)
+        self._seq = itertools.count()
+        self._scheduler = None
+        self._stats = {
+            'requests': 0,
+            'hedges': 0,
+            'hedges_won': 0,
+            'hedges_denied': 0
+        }
+
+    def delay(self):
+        '''Returns how long to wait for an answer before hedging.'''
+        self._lock.acquire()
+        try:
+            # re-sorting on every request adds up; the percentile doesn't move much anyway
+            if self._unsorted >= 20:
+                latencies = sorted(self._latencies)
+                index = min(len(latencies) - 1, int(len(latencies) * self.percentile / 100.0))
+                self._delay = max(self.min_delay, latencies[index])
+                self._unsorted = 0
+            return self._delay
+        finally:
+            self._lock.release()
+
+    def record(self, latency):
+        self._lock.acquire()
+        try:
+            self._latencies.append(latency)
+            self._unsorted += 1
+        finally:
+            self._lock.release()
+
+    def _start(self):
+        self._lock.acquire()
+        try:
+            self._stats['requests'] += 1
+            # each request earns a fraction of a hedge; save up no more than a small burst
+            self._tokens = min(self._tokens + self.budget, max(1.0, self.budget * 100))
+        finally:
+            self._lock.release()
+
+    def _take_token(self):
+        self._lock.acquire()
+        try:
+            if self._tokens < 1:
+                self._stats['hedges_denied'] += 1
+                return False
+            self._tokens -= 1
+            self._stats['hedges'] += 1
+            return True
+        finally:
+            self._lock.release()
+
+    def _count(self, stat):
+        self._lock.acquire()
+        try:
+            self._stats[stat] += 1
+        finally:
+            self._lock.release()
+
+    def _schedule(self, when, fire):
+        '''Has the scheduler thread call 'fire()' at 'when' (a time.time()).'''
+        self._cond.acquire()
+        try:
+            heapq.heappush(self._due, (when, self._seq.next(), fire))
+            if self._scheduler is None:
+                self._scheduler = threading.Thread(target = self._schedule_loop, name = 'omega-hedger')
+                self._scheduler.daemon = True
+                self._scheduler.start()
+            elif self._due[0][2] is fire:
+                # due before whatever it's waiting on
+                self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def _schedule_loop(self):
+        self._cond.acquire()
+        try:
+            while self._due:
+                wait = self._due[0][0] - time.time()
+                if wait > 0:
+                    # timed waits in python 2 poll, but never past the timeout; as every
+                    # hedge is due about the same delay after it's scheduled, one due
+                    # sooner than what we're waiting on (which may be noticed late) is rare
+                    self._cond.wait(wait)
+                    continue
+                fire = heapq.heappop(self._due)[2]
+                self._cond.release()
+                try:
+                    fire()
+                finally:
+                    self._cond.acquire()
+        finally:
+            # the next request to schedule a hedge starts another
+            self._scheduler = None
+            self._cond.release()
+
+    def stats(self):
+        '''Returns hedging counters (requests, hedges sent, won and denied by the budget) and the current delay.'''
+        self._lock.acquire()
+        try:
+            stats = dict(self._stats)
+            stats['delay'] = self._delay
+        finally:
+            self._lock.release()
+        return stats
+
+    def run(self, send):
+        '''Runs 'send(racer)' (hedging it if need be) and returns the first successful result.
+
+        'send' must hand each connection it uses to racer.attach() and
+        racer.detach() so the losing copy can be cancelled.'''
+        self._start()
+        started = time.time()
+        delay = self.delay()
+        lock = threading.Lock()
+        done = threading.Event()
+        results = Queue.Queue()
+        primary = Racer()
+        race = {'winner': None, 'hedge': None}
+
+        # the first copy runs here; the scheduler starts a thread for the hedge if we're not done by the time it's due
+        def hedge():
+            lock.acquire()
+            try:
+                if done.is_set() or not self._take_token():
+                    return
+                racer = Racer()
+                race['hedge'] = racer
+            finally:
+                lock.release()
+            thread = threading.Thread(target = run_hedge, args = (racer,))
+            thread.daemon = True
+            try:
+                thread.start()
+            except:
+                # we're waiting on the hedge now, so it has to report back
+                results.put((False, sys.exc_info()))
+
+        def run_hedge(racer):
+            try:
+                outcome = (True, send(racer))
+            except:
+                outcome = (False, sys.exc_info())
+            lock.acquire()
+            try:
+                won = outcome[0] and race['winner'] is None
+                if won:
+                    race['winner'] = racer
+            finally:
+                lock.release()
+            if won:
+                primary.cancel()
+            results.put(outcome)
+
+        self._schedule(started + delay, hedge)
+        try:
+            outcome = (True, send(primary))
+        except:
+            outcome = (False, sys.exc_info())
+        lock.acquire()
+        try:
+            done.set()
+            racer = race['hedge']
+            if outcome[0] and race['winner'] is None:
+                race['winner'] = primary
+        finally:
+            lock.release()
+        if race['winner'] is primary:
+            if racer is not None:
+                racer.cancel()
+        elif racer is not None:
+            # we were beaten (or failed); see how the hedge did
+            hedged = results.get()
+            if hedged[0]:
+                outcome = hedged
+                self._count('hedges_won')
+        (ok, value) = outcome
+        if ok:
+            self.record(time.time() - started)
+            return value
+        raise value[0], value[1], value[2]
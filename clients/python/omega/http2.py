@@ -0,0 +1,836 @@
+#!/usr/bin/python -tt
+
+# omega - python client
+# https://github.com/jfillmore/Omega-API-Engine
+#
+# Copyright 2011, Jonathon Fillmore
+# Licensed under the MIT license. See LICENSE file.
+# http://www.opensource.org/licenses/mit-license.php
+
+
+"""HTTP/2 transport: many requests at once over one connection per server (needs the 'h2' package)."""
+
+import os
+import sys
+import ssl
+import time
+import errno
+import fcntl
+import select
+import socket
+import httplib
+import threading
+from collections import deque
+from cStringIO import StringIO
+
+from error import Exception
+from pool import ConnectionPool
+from transport import Transport
+
+try:
+    import h2.config
+    import h2.connection
+    import h2.errors
+    import h2.events
+    import h2.exceptions
+    import h2.settings
+except ImportError:
+    h2 = None
+
+# connection-specific headers, which HTTP/2 doesn't allow
+_HOP_HEADERS = ('connection', 'keep-alive', 'proxy-connection', 'transfer-encoding', 'upgrade', 'te', 'expect')
+
+
+class HTTP2Response:
+    """A response on an HTTP/2 stream, working like an httplib.HTTPResponse."""
+
+    def __init__(self, stream, headers):
+        self._stream = stream
+        self.status = None
+        fields = []
+        for (name, value) in headers:
+            if name == ':status':
+                self.status = int(value)
+            elif not name.startswith(':'):
+                fields.append('%s: %s\r\n' % (name, value))
+        self.reason = httplib.responses.get(self.status, '')
+        self.version = 20
+        self.will_close = False
+        self.msg = httplib.HTTPMessage(StringIO(''.join(fields) + '\r\n'))
+        self.length = None
+        if self.msg.getheader('content-length', '').isdigit():
+            self.length = int(self.msg.getheader('content-length'))
+
+    def getheader(self, name, default = None):
+        return self.msg.getheader(name, default)
+
+    def getheaders(self):
+        return self.msg.items()
+
+    def read(self, amt = None):
+        return self._stream.connection.read(self._stream, amt)
+
+    def close(self):
+        pass
+
+
+class _Dechunker:
+    """Strips the chunked transfer coding from a request body as it's sent; HTTP/2 has frames instead."""
+
+    def __init__(self):
+        self.buffer = ''
+        self.done = False
+
+    def feed(self, data):
+        '''Returns the body data in 'data' (and any left over from before), without the chunk framing.'''
+        self.buffer += data
+        body = []
+        while not self.done:
+            end = self.buffer.find('\r\n')
+            if end < 0:
+                break
+            size = int(self.buffer[:end].split(';', 1)[0], 16)
+            if len(self.buffer) < end + 2 + size + 2:
+                break
+            if size:
+                body.append(self.buffer[end + 2:end + 2 + size])
+            else:
+                self.done = True
+            self.buffer = self.buffer[end + 2 + size + 2:]
+        return ''.join(body)
+
+
+class HTTP2Stream:
+    """One request on an HTTP2Connection, working like an httplib.HTTPConnection.
+
+    If the server turns out not to speak HTTP/2, the request goes over the
+    httplib connection in 'fallback' instead."""
+
+    def __init__(self, connection, timeout = None):
+        self.connection = connection
+        self.timeout = timeout
+        self.fallback = None
+        # streams have no socket of their own; see _await_continue() and hedge.Racer.cancel()
+        self.sock = None
+        self.stream_id = None
+        # the response, as it comes in
+        self.headers = None
+        self.data = deque()
+        self.buffered = 0
+        self.ended = False
+        self.error = None
+        self.cancelled = False
+        # when the stream gives up waiting on the server
+        self.deadline = None
+        self._request = None
+
+    def putrequest(self, method, url, skip_host = 0, skip_accept_encoding = 0):
+        if self.fallback is not None:
+            return self.fallback.putrequest(method, url, skip_host, skip_accept_encoding)
+        connection = self.connection
+        self._request = [(':method', method), (':scheme', connection.scheme), (':authority', connection.authority), (':path', url)]
+        self._headers = []
+        self._has_body = False
+        self._chunked = None
+        self._open = True
+
+    def putheader(self, header, *values):
+        if self.fallback is not None:
+            return self.fallback.putheader(header, *values)
+        name = header.lower()
+        value = ', '.join([str(value) for value in values])
+        if name == 'content-length':
+            self._has_body = True
+        elif name == 'transfer-encoding' and value.lower() == 'chunked':
+            self._has_body = True
+            self._chunked = _Dechunker()
+        elif name == 'host':
+            self._request[2] = (':authority', value)
+            return
+        if name in _HOP_HEADERS:
+            return
+        self._headers.append((name, value))
+
+    def endheaders(self, message_body = None):
+        if self.fallback is not None:
+            return self.fallback.endheaders(message_body)
+        # without a body coming the request is over with the headers; otherwise once the body's sent
+        self._open = self._has_body or bool(message_body)
+        self.connection.start_stream(self, self._request + self._headers, not self._open)
+        if message_body:
+            self.send(message_body)
+
+    def send(self, data):
+        if self.fallback is not None:
+            return self.fallback.send(data)
+        if self._chunked is not None:
+            data = self._chunked.feed(data)
+        if data:
+            self.connection.send_data(self, data)
+        if self._chunked is not None and self._chunked.done:
+            self._end()
+
+    def _end(self):
+        if self._open:
+            self._open = False
+            self.connection.end_stream(self)
+
+    def getresponse(self):
+        if self.fallback is not None:
+            return self.fallback.getresponse()
+        if self._request is None:
+            raise httplib.ResponseNotReady()
+        self._request = None
+        self._end()
+        return HTTP2Response(self, self.connection.get_headers(self))
+
+    def cancel(self):
+        '''Aborts the request, resetting just its stream; the connection carries on for the others.'''
+        self.cancelled = True
+        if self.fallback is not None:
+            if self.fallback.sock is not None:
+                try:
+                    self.fallback.sock.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+            return
+        self.connection.reset(self)
+
+    def close(self):
+        if self.fallback is not None:
+            self.fallback.close()
+        else:
+            self.connection.reset(self)
+
+
+class HTTP2Connection:
+    """One HTTP/2 connection to a server, carrying any number of streams at once.
+
+    A background thread owns the socket: it writes out the frames h2 has
+    queued up and hands the events from frames read in to their streams.
+    Everyone else just changes h2's state, holding the lock, and wakes it."""
+
+    def __init__(self, key, ssl_context, timeout = None, window = 65535):
+        (self.scheme, self.host, self.port) = key
+        self.key = key
+        if self.port in (None, {'https': 443, 'http': 80}.get(self.scheme)):
+            self.authority = self.host
+        else:
+            self.authority = '%s:%s' % (self.host, self.port)
+        self.ssl_context = ssl_context
+        self.timeout = timeout
+        self.window = window
+        # 'new', then 'connecting' and 'open', then 'closed'
+        self.state = 'new'
+        # once connected: 'h2', or e.g. 'http/1.1' if the server wouldn't speak HTTP/2
+        self.protocol = None
+        self.error = None
+        self.sock = None
+        self.h2 = None
+        self.streams = {}
+        # false once the server has said it's going away (or we have); streams already open carry on
+        self.accepting = True
+        self._closing = False
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def usable(self):
+        '''Whether new streams may still be started on the connection.'''
+        return self.state != 'closed' and self.accepting
+
+    def connect(self, pool, timing = None):
+        '''Connects (via 'pool', for the timing breakdown) if nobody has yet; returns whether this call did.'''
+        self._cond.acquire()
+        try:
+            while self.state == 'connecting':
+                self._cond.wait()
+            if self.state == 'open' or self.protocol not in (None, 'h2'):
+                return False
+            if self.state == 'closed':
+                raise socket.error('HTTP/2 connection to %s://%s:%s closed: %s' % (self.key + (self.error or 'closed',)))
+            self.state = 'connecting'
+        finally:
+            self._cond.release()
+        try:
+            if self.scheme == 'https':
+                http = httplib.HTTPSConnection(self.host, self.port, timeout = self.timeout, context = self.ssl_context)
+            else:
+                http = httplib.HTTPConnection(self.host, self.port, timeout = self.timeout)
+            pool.connect(http, timing)
+            sock = http.sock
+            if self.scheme == 'https':
+                protocol = sock.selected_alpn_protocol() or 'http/1.1'
+            else:
+                # plain HTTP servers have no way to tell us; we were told they speak h2 (i.e. h2c)
+                protocol = 'h2'
+            if protocol == 'h2':
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self._start(sock)
+        except:
+            error = sys.exc_info()[1]
+            self._cond.acquire()
+            try:
+                self.state = 'closed'
+                self.error = str(error) or error.__class__.__name__
+                self._cond.notifyAll()
+            finally:
+                self._cond.release()
+            raise
+        self._cond.acquire()
+        try:
+            self.protocol = protocol
+            if protocol == 'h2':
+                self.state = 'open'
+            else:
+                # left for take_socket(), so the first request over HTTP/1.1 needn't connect again
+                self.state = 'closed'
+                self.accepting = False
+                self.sock = sock
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+        return True
+
+    def take_socket(self):
+        '''Returns the socket of a connection that the server wouldn't speak HTTP/2 over, once.'''
+        self._cond.acquire()
+        try:
+            sock = self.sock
+            self.sock = None
+            return sock
+        finally:
+            self._cond.release()
+
+    def _start(self, sock):
+        config = h2.config.H2Configuration(client_side = True)
+        self.h2 = h2.connection.H2Connection(config = config)
+        self.h2.local_settings = h2.settings.Settings(client = True, initial_values = {
+            h2.settings.SettingCodes.ENABLE_PUSH: 0,
+            h2.settings.SettingCodes.INITIAL_WINDOW_SIZE: self.window
+        })
+        self.h2.initiate_connection()
+        if self.window > 65535:
+            # the connection's own window can only be changed this way
+            self.h2.increment_flow_control_window(self.window - 65535)
+        (self._wake_r, self._wake_w) = os.pipe()
+        for fd in (self._wake_r, self._wake_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        sock.setblocking(0)
+        self.sock = sock
+        self._thread = threading.Thread(target = self._run, name = 'omega-h2-%s' % self.authority)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _wake(self):
+        '''Gets the I/O thread to look at h2 again; the lock must be held.'''
+        if self.state != 'open':
+            return
+        try:
+            os.write(self._wake_w, 'x')
+        except OSError, e:
+            # full already, so it's being woken anyway
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def _run(self):
+        sock = self.sock
+        pending = ''
+        error = None
+        try:
+            while True:
+                self._cond.acquire()
+                try:
+                    pending += self.h2.data_to_send()
+                    if not pending and (self._closing or (not self.accepting and not self.streams)):
+                        break
+                    timeout = self._expire()
+                finally:
+                    self._cond.release()
+                # TLS may have decrypted more than was asked for last time; select() can't know that
+                if isinstance(sock, ssl.SSLSocket) and sock.pending():
+                    (readable, writable) = ([sock], [])
+                else:
+                    (readable, writable, errored) = select.select([sock, self._wake_r], pending and [sock] or [], [], timeout)
+                if self._wake_r in readable:
+                    os.read(self._wake_r, 4096)
+                if sock in writable:
+                    try:
+                        pending = pending[sock.send(pending[:65536]):]
+                    except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+                        pass
+                    except socket.error, e:
+                        if e.args[0] != errno.EAGAIN:
+                            raise
+                if sock in readable:
+                    try:
+                        data = sock.recv(65536)
+                    except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+                        continue
+                    except socket.error, e:
+                        if e.args[0] == errno.EAGAIN:
+                            continue
+                        raise
+                    if not data:
+                        raise socket.error('Connection closed by the server.')
+                    self._cond.acquire()
+                    try:
+                        self._handle(self.h2.receive_data(data))
+                    finally:
+                        self._cond.release()
+        except (socket.error, select.error, h2.exceptions.ProtocolError), e:
+            error = e
+        except:
+            # nothing else enforces the streams' deadlines, so fail them rather than leave them waiting forever
+            self._close(sys.exc_info()[1])
+            raise
+        self._close(error)
+
+    def _handle(self, events):
+        '''Hands what's come in over to the streams it's for; the lock must be held.'''
+        for event in events:
+            stream = self.streams.get(getattr(event, 'stream_id', None))
+            if isinstance(event, h2.events.ResponseReceived):
+                if stream is not None:
+                    stream.headers = event.headers
+            elif isinstance(event, h2.events.DataReceived):
+                if stream is None:
+                    # nobody's going to read it, so let the server send more in its place
+                    self.h2.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+                else:
+                    stream.data.append(event.data)
+                    stream.buffered += len(event.data)
+                    if event.flow_controlled_length > len(event.data):
+                        # padding counts against the window too, but there's nothing to read
+                        self.h2.acknowledge_received_data(event.flow_controlled_length - len(event.data), event.stream_id)
+            elif isinstance(event, h2.events.StreamEnded):
+                if stream is not None:
+                    stream.ended = True
+            elif isinstance(event, h2.events.StreamReset):
+                if stream is not None and not stream.ended and stream.error is None:
+                    stream.error = socket.error('HTTP/2 stream reset by the server (error %s).' % event.error_code)
+            elif isinstance(event, h2.events.ConnectionTerminated):
+                self.accepting = False
+                for (stream_id, other) in self.streams.items():
+                    if stream_id > event.last_stream_id and other.error is None:
+                        # never processed, so it's safe to send again
+                        other.error = socket.error('HTTP/2 connection going away (error %s).' % event.error_code)
+            if stream is not None:
+                stream.deadline = None
+            elif isinstance(event, h2.events.WindowUpdated):
+                # more room on the connection as a whole; anyone may be able to send
+                for other in self.streams.values():
+                    other.deadline = None
+        self._cond.notifyAll()
+
+    def _expire(self):
+        '''Times out streams that have waited too long, returning seconds until the next will (or None); the lock must be held.'''
+        now = time.time()
+        timeout = None
+        for stream in self.streams.values():
+            if stream.deadline is None:
+                continue
+            left = stream.deadline - now
+            if left <= 0:
+                stream.error = socket.timeout('timed out')
+                stream.deadline = None
+                self._cond.notifyAll()
+            elif timeout is None or left < timeout:
+                timeout = left
+        return timeout
+
+    def _close(self, error = None):
+        self._cond.acquire()
+        try:
+            self.state = 'closed'
+            self.accepting = False
+            if error is not None:
+                self.error = str(error) or error.__class__.__name__
+            for stream in self.streams.values():
+                if not stream.ended and stream.error is None:
+                    stream.error = socket.error('HTTP/2 connection closed: %s' % (self.error or 'closed by the client'))
+            self._cond.notifyAll()
+            sock = self.sock
+            self.sock = None
+        finally:
+            self._cond.release()
+        # nobody wakes a closed connection, so the pipe can go
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        sock.close()
+
+    def _wait(self, stream):
+        '''Waits for something to happen on the stream; the lock must be held. Raises if something went wrong.'''
+        if stream.error is not None:
+            raise stream.error
+        if stream.timeout is not None and stream.deadline is None:
+            stream.deadline = time.time() + stream.timeout
+            # so the I/O thread knows to time it out
+            self._wake()
+        self._cond.wait()
+        if stream.error is not None:
+            raise stream.error
+
+    def _check(self):
+        if not self.usable():
+            raise socket.error('HTTP/2 connection to %s://%s:%s closed: %s' % (self.key + (self.error or 'going away',)))
+
+    def start_stream(self, stream, headers, end_stream = False):
+        '''Starts a stream by sending its headers, once the server will allow another stream.'''
+        self._cond.acquire()
+        try:
+            while True:
+                self._check()
+                if self.h2.open_outbound_streams < self.h2.remote_settings.max_concurrent_streams:
+                    break
+                # a stream finishing will wake us up
+                self._cond.wait()
+            try:
+                stream.stream_id = self.h2.get_next_available_stream_id()
+            except h2.exceptions.NoAvailableStreamIDError:
+                # we've used them all up; new streams need a new connection
+                self.accepting = False
+                self._check()
+            self.h2.send_headers(stream.stream_id, headers, end_stream = end_stream)
+            self.streams[stream.stream_id] = stream
+            self._wake()
+        finally:
+            self._cond.release()
+
+    def send_data(self, stream, data):
+        '''Sends some of a stream's body, as fast as the server's flow control windows allow.'''
+        pos = 0
+        self._cond.acquire()
+        try:
+            while pos < len(data):
+                if stream.error is not None:
+                    raise stream.error
+                try:
+                    size = min(len(data) - pos, self.h2.local_flow_control_window(stream.stream_id), self.h2.max_outbound_frame_size)
+                    if size <= 0:
+                        self._wait(stream)
+                        continue
+                    self.h2.send_data(stream.stream_id, data[pos:pos + size])
+                except h2.exceptions.StreamClosedError:
+                    if stream.headers is not None:
+                        # the server answered without the rest of the body; the response will say why
+                        return
+                    raise socket.error('HTTP/2 stream closed while sending the request.')
+                pos += size
+                self._wake()
+        finally:
+            self._cond.release()
+
+    def end_stream(self, stream):
+        self._cond.acquire()
+        try:
+            self._check_stream(stream)
+            try:
+                self.h2.end_stream(stream.stream_id)
+            except h2.exceptions.StreamClosedError:
+                pass
+            self._wake()
+        finally:
+            self._cond.release()
+
+    def _check_stream(self, stream):
+        if stream.error is not None and stream.headers is None:
+            raise stream.error
+
+    def get_headers(self, stream):
+        '''Waits for a stream's response headers.'''
+        self._cond.acquire()
+        try:
+            while stream.headers is None:
+                self._wait(stream)
+            return stream.headers
+        finally:
+            self._cond.release()
+
+    def read(self, stream, amt = None):
+        '''Reads up to 'amt' bytes (or all) of a stream's response body, waiting for some if there's none yet.'''
+        self._cond.acquire()
+        try:
+            if amt is None:
+                chunks = []
+                while True:
+                    # take it as it comes, or the server would run out of window before the end
+                    chunks.extend(stream.data)
+                    stream.data.clear()
+                    if stream.buffered:
+                        self._acknowledge(stream, stream.buffered)
+                        stream.buffered = 0
+                    if stream.ended:
+                        return ''.join(chunks)
+                    self._wait(stream)
+            while not stream.ended and not stream.buffered:
+                self._wait(stream)
+            chunks = []
+            size = 0
+            while stream.data and size < amt:
+                chunk = stream.data.popleft()
+                if size + len(chunk) > amt:
+                    stream.data.appendleft(chunk[amt - size:])
+                    chunk = chunk[:amt - size]
+                chunks.append(chunk)
+                size += len(chunk)
+            stream.buffered -= size
+            if size:
+                # now that it's been read the server may send more; h2 decides when it's worth telling it
+                self._acknowledge(stream, size)
+            return ''.join(chunks)
+        finally:
+            self._cond.release()
+
+    def _acknowledge(self, stream, size):
+        if self.state != 'open':
+            return
+        try:
+            self.h2.acknowledge_received_data(size, stream.stream_id)
+        except h2.exceptions.ProtocolError:
+            return
+        self._wake()
+
+    def finish(self, stream):
+        '''Forgets a stream whose response has been read.'''
+        self._cond.acquire()
+        try:
+            self.streams.pop(stream.stream_id, None)
+            self._cond.notifyAll()
+            if not self.accepting and not self.streams:
+                # the last stream on a connection that's going away; let the I/O thread finish up
+                self._wake()
+        finally:
+            self._cond.release()
+
+    def reset(self, stream):
+        '''Cancels a stream that's still going, without disturbing the others; returns whether it was.'''
+        self._cond.acquire()
+        try:
+            if stream.stream_id is None or not stream.stream_id in self.streams:
+                return False
+            del self.streams[stream.stream_id]
+            cancelled = not stream.ended
+            if self.state == 'open':
+                if cancelled:
+                    try:
+                        self.h2.reset_stream(stream.stream_id, h2.errors.ErrorCodes.CANCEL)
+                    except (h2.exceptions.StreamClosedError, h2.exceptions.ProtocolError):
+                        pass
+                if stream.buffered:
+                    # unread, but it still counts against the connection's window
+                    self._acknowledge(stream, stream.buffered)
+                self._wake()
+            if stream.error is None:
+                stream.error = socket.error('HTTP/2 stream cancelled.')
+            stream.data.clear()
+            stream.buffered = 0
+            self._cond.notifyAll()
+            return cancelled
+        finally:
+            self._cond.release()
+
+    def close(self):
+        '''Tells the server we're going (with a GOAWAY) and closes the connection.'''
+        self._cond.acquire()
+        try:
+            if self.state == 'new':
+                self.state = 'closed'
+            elif self.state == 'open' and not self._closing:
+                self._closing = True
+                self.accepting = False
+                try:
+                    self.h2.close_connection()
+                except h2.exceptions.ProtocolError:
+                    pass
+                self._wake()
+            sock = None
+            if self.state == 'closed':
+                sock = self.sock
+                self.sock = None
+        finally:
+            self._cond.release()
+        if sock is not None:
+            sock.close()
+
+
+
+class HTTP2Transport(Transport):
+    """Sends requests to each server as streams on one HTTP/2 connection; see OmegaClient.set_transport().
+
+    However many requests are in flight at once (e.g. from request_many(),
+    or threads sharing a client), they share one connection and TLS session
+    per server, up to the number of streams the server allows at once.
+    Headers are HPACK compressed and both ways are flow controlled: the
+    server may only get 'window' bytes ahead of what's been read of each
+    response. Cancelling a request (e.g. the losing copy of a hedged one)
+    resets just its stream. HTTPS servers that don't pick h2 via ALPN are
+    remembered and talked to over HTTP/1.1 through 'pool', as are plain
+    HTTP servers unless 'prior_knowledge' says they speak h2 anyway (i.e.
+    h2c). The default pool is a pool.ConnectionPool using 'ssl_context'
+    if one is given, or else its own default context (not the one made
+    here, which offers h2). ALPN protocols are set on 'ssl_context'. A
+    stream gives up after 'timeout' seconds without hearing from the
+    server."""
+
+    name = 'h2'
+
+    def __init__(self, timeout = None, window = 1048576, ssl_context = None, prior_knowledge = False, pool = None):
+        if h2 is None:
+            raise Exception("The HTTP/2 transport requires the 'h2' package.")
+        if not getattr(ssl, 'HAS_ALPN', False):
+            raise Exception('The HTTP/2 transport requires an ssl module with ALPN support (python 2.7.10+, OpenSSL 1.0.2+).')
+        if pool is None:
+            pool = ConnectionPool(timeout = timeout, ssl_context = ssl_context)
+        if ssl_context is None:
+            ssl_context = ssl.create_default_context()
+        ssl_context.set_alpn_protocols(['h2', 'http/1.1'])
+        self.timeout = timeout
+        self.window = window
+        self.ssl_context = ssl_context
+        self.prior_knowledge = prior_knowledge
+        self.pool = pool
+        self._lock = threading.Lock()
+        self._conns = {}
+        # key => protocol, for servers known not to speak HTTP/2
+        self._protocols = {}
+        self._stats = {
+            'streams': 0,
+            'connections': 0,
+            'cancelled': 0,
+            'fallbacks': 0
+        }
+
+    def _speaks_h2(self, key):
+        if key in self._protocols:
+            return False
+        return key[0] == 'https' or (key[0] == 'http' and self.prior_knowledge)
+
+    def _get_connection(self, key):
+        '''Returns the server's HTTP/2 connection, starting a new one if need be, or None if it doesn't speak HTTP/2.'''
+        self._lock.acquire()
+        try:
+            if not self._speaks_h2(key):
+                return None
+            connection = self._conns.get(key)
+            if connection is None or not connection.usable():
+                connection = self._conns[key] = HTTP2Connection(key, self.ssl_context, self.timeout, self.window)
+            return connection
+        finally:
+            self._lock.release()
+
+    def _connected(self, connection, opened):
+        self._lock.acquire()
+        try:
+            if connection.protocol != 'h2':
+                self._protocols[connection.key] = connection.protocol
+            elif opened:
+                self._stats['connections'] += 1
+        finally:
+            self._lock.release()
+
+    def _count(self, name):
+        self._lock.acquire()
+        try:
+            self._stats[name] += 1
+        finally:
+            self._lock.release()
+
+    def get(self, scheme, host, port):
+        '''Returns a new stream on the server's connection, or an HTTP/1.1 connection if it doesn't speak HTTP/2.'''
+        key = (scheme, host, port)
+        connection = self._get_connection(key)
+        if connection is None:
+            self._count('fallbacks')
+            return self.pool.get(*key)
+        return HTTP2Stream(connection, self.timeout)
+
+    def connect(self, conn, timing = None):
+        '''Connects a stream's connection if nobody has yet; if the server won't speak HTTP/2 the stream falls back to HTTP/1.1.'''
+        if not isinstance(conn, HTTP2Stream):
+            return self.pool.connect(conn, timing)
+        connection = conn.connection
+        started = time.time()
+        opened = connection.connect(self.pool, timing)
+        self._connected(connection, opened)
+        if connection.protocol == 'h2':
+            if not opened and timing is not None:
+                # we may have waited on someone else's handshake, but that's all
+                timing.reused = True
+                timing.connect += time.time() - started
+            self._count('streams')
+            return conn
+        self._count('fallbacks')
+        fallback = self.pool.get(*connection.key)
+        try:
+            sock = connection.take_socket()
+            if sock is None:
+                self.pool.connect(fallback, timing)
+            else:
+                fallback.sock = sock
+        except:
+            self.pool.discard(fallback)
+            raise
+        conn.fallback = fallback
+        return conn
+
+    def put(self, conn):
+        if not isinstance(conn, HTTP2Stream):
+            self.pool.put(conn)
+        elif conn.fallback is not None:
+            self.pool.put(conn.fallback)
+        else:
+            conn.connection.finish(conn)
+
+    def discard(self, conn):
+        if not isinstance(conn, HTTP2Stream):
+            self.pool.discard(conn)
+        elif conn.fallback is not None:
+            self.pool.discard(conn.fallback)
+        elif conn.connection.reset(conn) or conn.cancelled:
+            self._count('cancelled')
+
+    def preconnect(self, scheme, host, port, count = 1):
+        '''Opens the server's HTTP/2 connection ahead of time (one is all it takes), or 'count' HTTP/1.1 ones if it doesn't speak h2.'''
+        key = (scheme, host, port)
+        connection = self._get_connection(key)
+        if connection is not None:
+            try:
+                opened = connection.connect(self.pool)
+            except (socket.error, httplib.HTTPException), e:
+                raise Exception('Failed to connect to %s://%s:%s: %s' % (key + (str(e),)))
+            self._connected(connection, opened)
+            if connection.protocol == 'h2':
+                return int(opened)
+            sock = connection.take_socket()
+            if sock is not None:
+                sock.close()
+        return self.pool.preconnect(scheme, host, port, count)
+
+    def stats(self):
+        '''Returns counters for streams and connections, what's open now, and the stats of the HTTP/1.1 pool.'''
+        self._lock.acquire()
+        try:
+            stats = dict(self._stats)
+            connections = self._conns.values()
+        finally:
+            self._lock.release()
+        stats['open'] = len([connection for connection in connections if connection.state == 'open'])
+        stats['active_streams'] = sum([len(connection.streams) for connection in connections])
+        stats['http1'] = self.pool.stats()
+        return stats
+
+    def close(self):
+        '''Closes all connections; streams still going on them fail.'''
+        self._lock.acquire()
+        try:
+            connections = self._conns.values()
+            self._conns = {}
+        finally:
+            self._lock.release()
+        for connection in connections:
+            connection.close()
+        self.pool.close()
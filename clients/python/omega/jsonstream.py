@@ -0,0 +1,199 @@
+#!/usr/bin/python -tt
+
+# omega - python client
+# https://github.com/jfillmore/Omega-API-Engine
+#
+# Copyright 2011, Jonathon Fillmore
+# Licensed under the MIT license. See LICENSE file.
+# http://www.opensource.org/licenses/mit-license.php
+
+
+"""Incremental decoding of Omega response envelopes (e.g. '{"result": true, "data": [...]}') and streamed encoding of JSON arrays."""
+
+try:
+    import json
+except:
+    import simplejson
+    json = simplejson
+
+from error import Exception
+
+WHITESPACE = ' \t\n\r'
+
+
+class _NeedMore(StandardError):
+    pass
+
+
+class EnvelopeDecoder:
+    """Decodes a response envelope from a stream of chunks, yielding the items of 'data' as they arrive.
+
+    Everything else in the envelope (e.g. 'result', 'reason') is decoded
+    into 'envelope'. If 'data' is not a list it is yielded whole."""
+
+    def __init__(self, raw_decode = None):
+        if raw_decode is None:
+            raw_decode = json.JSONDecoder().raw_decode
+        self.raw_decode = raw_decode
+        self.envelope = {}
+        self._buffer = ''
+        self._pos = 0
+        self._mark = 0
+        self._eof = False
+        self._state = 'start'
+        self._key = None
+
+    def decode(self, chunks):
+        '''Generator yielding each item of the envelope's data.'''
+        chunks = iter(chunks)
+        while True:
+            try:
+                for item in self._parse():
+                    yield item
+                # finish reading whatever trails the envelope so the source can clean up
+                for chunk in chunks:
+                    pass
+                return
+            except _NeedMore:
+                pass
+            # rewind to the start of whatever we were in the middle of and get more
+            self._buffer = self._buffer[self._mark:]
+            self._pos = 0
+            try:
+                self._buffer += chunks.next()
+            except StopIteration:
+                if self._eof:
+                    raise Exception('Failed to decode API result; response ended early.', self._buffer[:256])
+                self._eof = True
+
+    def _parse(self):
+        # resumable; the state lives in 'self._state' so we can pick up where we left off
+        while True:
+            self._mark = self._pos
+            if self._state == 'start':
+                self._expect('{')
+                self._state = 'key'
+            elif self._state == 'key':
+                char = self._peek()
+                if char == '}':
+                    self._pos += 1
+                    self._state = 'done'
+                    continue
+                (self._key, self._pos) = self._value()
+                self._expect(':')
+                self._state = 'value'
+            elif self._state == 'value':
+                if self._key == 'data' and self._peek() == '[':
+                    self._pos += 1
+                    self._state = 'item'
+                    continue
+                (value, self._pos) = self._value(True)
+                if self._key == 'data':
+                    yield value
+                else:
+                    self.envelope[self._key] = value
+                    self._check_result()
+                self._state = 'next_key'
+            elif self._state == 'item':
+                char = self._peek()
+                if char == ']':
+                    self._pos += 1
+                    self._state = 'next_key'
+                    continue
+                (value, self._pos) = self._value(True)
+                if self._peek() == ',':
+                    self._pos += 1
+                # only hand it out once we know we won't need to rewind past it
+                self._mark = self._pos
+                self._state = 'item'
+                yield value
+            elif self._state == 'next_key':
+                char = self._peek()
+                self._pos += 1
+                if char == ',':
+                    self._state = 'key'
+                elif char == '}':
+                    self._state = 'done'
+                else:
+                    raise Exception('Failed to decode API result; unexpected "%s".' % char)
+            elif self._state == 'done':
+                self._check_result(True)
+                return
+
+    def _check_result(self, finished = False):
+        envelope = self.envelope
+        if 'result' in envelope and envelope['result'] == False:
+            # wait for a reason unless it's never coming
+            if 'reason' in envelope:
+                raise Exception(envelope['reason'])
+            if finished:
+                raise Exception('API failed\n%s' % envelope)
+
+    def _skip(self):
+        buffer = self._buffer
+        pos = self._pos
+        while pos < len(buffer) and buffer[pos] in WHITESPACE:
+            pos += 1
+        self._pos = pos
+        if pos == len(buffer):
+            raise _NeedMore()
+
+    def _peek(self):
+        self._skip()
+        return self._buffer[self._pos]
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise Exception('Failed to decode API result; expected "%s" but found "%s".' %
+                (char, self._buffer[self._pos]))
+        self._pos += 1
+
+    def _value(self, delimited = False):
+        self._skip()
+        try:
+            (value, end) = self.raw_decode(self._buffer, self._pos)
+        except ValueError:
+            if self._eof:
+                raise Exception('Failed to decode API result.', self._buffer[self._pos:self._pos + 256])
+            raise _NeedMore()
+        if delimited:
+            # numbers and such may continue into the next chunk; make sure we saw their end
+            pos = end
+            while pos < len(self._buffer) and self._buffer[pos] in WHITESPACE:
+                pos += 1
+            if pos == len(self._buffer):
+                if not self._eof:
+                    raise _NeedMore()
+            elif self._buffer[pos] not in ',]}':
+                if not self._eof:
+                    raise _NeedMore()
+                raise Exception('Failed to decode API result; unexpected "%s".' % self._buffer[pos])
+        return (value, end)
+
+
+def iter_data(chunks, raw_decode = None):
+    '''Yields the items of an envelope's data from an iterable of chunks.'''
+    return EnvelopeDecoder(raw_decode).decode(chunks)
+
+
+def encode_array(records, encode = None, chunk_size = 65536):
+    '''Yields an iterable of records as the chunks of a JSON array, without building the whole string.'''
+    if encode is None:
+        encode = json.JSONEncoder().encode
+    chunk = ['[']
+    size = 1
+    first = True
+    for record in records:
+        if first:
+            first = False
+        else:
+            chunk.append(',')
+        record = encode(record)
+        chunk.append(record)
+        size += len(record) + 1
+        if size >= chunk_size:
+            yield ''.join(chunk)
+            chunk = []
+            size = 0
+    chunk.append(']')
+    yield ''.join(chunk)
@@ -0,0 +1,281 @@
+#!/usr/bin/python -tt
+
+# omega - python client
+# https://github.com/jfillmore/Omega-API-Engine
+#
+# Copyright 2011, Jonathon Fillmore
+# Licensed under the MIT license. See LICENSE file.
+# http://www.opensource.org/licenses/mit-license.php
+
+
+"""Client-side rate limiting and adaptive (AIMD) concurrency limits, so batch jobs don't overload servers."""
+
+import time
+import threading
+
+from error import Exception
+
+
+class TokenBucket:
+    """Allows 'rate' requests per second on average, in bursts of up to 'burst'."""
+
+    def __init__(self, rate, burst = None):
+        if rate <= 0:
+            raise Exception('Invalid rate: %s.' % rate)
+        self.rate = float(rate)
+        self.burst = float(burst or max(1.0, rate))
+        self.tokens = self.burst
+        self.updated = time.time()
+
+    def take(self):
+        '''Takes a token if there is one and returns 0, or else returns how many seconds until there will be.'''
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class AdaptiveLimit:
+    """How many requests may be in flight at once, adjusted AIMD-style.
+
+    While responses come back about as fast as usual the limit grows by
+    about one per round of requests; when the server says it's overloaded
+    (e.g. a 429 or 503) or recent latency (a moving average, so one slow
+    response doesn't count) climbs past 'tolerance' times the usual it's
+    multiplied by 'backoff'. It backs off at most once per round, so a
+    burst of failures from requests sent at the old limit only counts once.
+    Latencies under 'min_latency' are treated as equal; it's all noise."""
+
+    def __init__(self, initial = 4, min_limit = 1, max_limit = 64, backoff = 0.5, tolerance = 2.0, smoothing = 0.1, decay = 0.01, min_latency = 0.005):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.tolerance = tolerance
+        self.smoothing = smoothing
+        self.decay = decay
+        self.min_latency = min_latency
+        self.in_flight = 0
+        # moving averages of seconds until a response starts coming back: lately, and usually (kept low)
+        self.recent = None
+        self.baseline = None
+        self.backoffs = 0
+        self._backed_off = 0
+
+    def available(self):
+        return self.in_flight < max(self.min_limit, int(self.limit))
+
+    def finish(self, started, latency = None, overloaded = False):
+        '''Records a finished request; 'latency' is None if there's nothing to learn from it (e.g. the connection failed).'''
+        self.in_flight -= 1
+        if latency is None and not overloaded:
+            return
+        if latency is not None:
+            latency = max(latency, self.min_latency)
+            if self.recent is None:
+                self.recent = latency
+            else:
+                self.recent += self.smoothing * (latency - self.recent)
+            if not overloaded and self.baseline is not None and self.tolerance is not None:
+                overloaded = self.recent > self.baseline * self.tolerance
+            if not overloaded:
+                # drop straight to faster times, but drift up slowly so a server that's gotten slower for good is accepted
+                if self.baseline is None or self.recent < self.baseline:
+                    self.baseline = self.recent
+                else:
+                    self.baseline += self.decay * (self.recent - self.baseline)
+        if overloaded:
+            if started >= self._backed_off:
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+                self._backed_off = time.time()
+                self.backoffs += 1
+                # start over on latency; what we saw was at the old limit
+                self.recent = None
+        elif self.in_flight + 1 >= self.limit / 2:
+            # only grow if we're actually using the limit we've got
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+
+class Permit:
+    """Permission to send one request; release() it once the response (or error) is in."""
+
+    def __init__(self, limiter, limit):
+        self.started = time.time()
+        self._limiter = limiter
+        self._limit = limit
+
+    def release(self, status = None, latency = None, overloaded = False):
+        '''Frees up the slot, learning from the response's status and latency (seconds until it started coming back).'''
+        if self._limiter is None:
+            return
+        limiter = self._limiter
+        self._limiter = None
+        if self._limit is None:
+            return
+        if status in limiter.overload_statuses:
+            overloaded = True
+        limiter._finish(self._limit, self.started, latency, overloaded)
+
+
+class _Rule:
+
+    def __init__(self, prefix, endpoint, rate, burst, adaptive, opts):
+        self.prefix = prefix
+        self.endpoint = endpoint
+        self.rate = rate
+        self.burst = burst
+        self.adaptive = adaptive
+        self.opts = opts
+        # each endpoint a rule applies to gets its own bucket and limit
+        self.buckets = {}
+        self.limits = {}
+
+    def matches(self, endpoint, api):
+        if self.endpoint is not None and self.endpoint != endpoint:
+            return False
+        return api.startswith(self.prefix)
+
+    def get_bucket(self, endpoint):
+        if self.rate is None:
+            return None
+        bucket = self.buckets.get(endpoint)
+        if bucket is None:
+            bucket = self.buckets[endpoint] = TokenBucket(self.rate, self.burst)
+        return bucket
+
+    def get_limit(self, endpoint):
+        if not self.adaptive:
+            return None
+        limit = self.limits.get(endpoint)
+        if limit is None:
+            limit = self.limits[endpoint] = AdaptiveLimit(**self.opts)
+        return limit
+
+
+class RateLimiter:
+    """Holds requests back according to a list of rules; see OmegaClient.set_limiter().
+
+    Each rule applies to API paths starting with 'prefix' ('' for all),
+    optionally only on one endpoint (e.g. 'http://host:5858'). A rule can
+    cap the request rate ('rate' per second, bursting to 'burst') and/or
+    keep an AdaptiveLimit on concurrency ('adaptive', with any options for
+    it). Only the most specific matching rule applies: a rule for an
+    endpoint beats one without, then longer prefixes win. Rules without an
+    endpoint keep separate state for each endpoint they see. Requests wait
+    up to 'timeout' seconds (None for forever) to be let through."""
+
+    def __init__(self, timeout = None, overload_statuses = (429, 503)):
+        self.timeout = timeout
+        self.overload_statuses = overload_statuses
+        self._rules = []
+        self._cond = threading.Condition()
+        self._stats = {
+            'requests': 0,
+            'waits': 0,
+            'wait_time': 0.0,
+            'timeouts': 0
+        }
+
+    def add(self, prefix = '', endpoint = None, rate = None, burst = None, adaptive = False, **opts):
+        '''Adds a rule; 'opts' are passed on to AdaptiveLimit (e.g. initial, max_limit, backoff).'''
+        if rate is None and not adaptive:
+            raise Exception('A rule needs a rate, adaptive concurrency, or both.')
+        self._cond.acquire()
+        try:
+            self._rules.append(_Rule(prefix.lstrip('/'), endpoint, rate, burst, adaptive, opts))
+            self._rules.sort(key = lambda rule: (rule.endpoint is None, -len(rule.prefix)))
+        finally:
+            self._cond.release()
+        return self
+
+    def _match(self, endpoint, api):
+        for rule in self._rules:
+            if rule.matches(endpoint, api):
+                return rule
+        return None
+
+    def acquire(self, endpoint, api = None, block = True):
+        '''Waits until a request to the API on the endpoint may be sent, returning a Permit for it (or None, without 'block', if it can't be sent yet).'''
+        api = (api or '').lstrip('/')
+        started = time.time()
+        waited = False
+        self._cond.acquire()
+        try:
+            rule = self._match(endpoint, api)
+            if rule is None:
+                self._stats['requests'] += 1
+                return Permit(self, None)
+            bucket = rule.get_bucket(endpoint)
+            limit = rule.get_limit(endpoint)
+            while True:
+                if limit is None or limit.available():
+                    delay = 0
+                    if bucket is not None:
+                        delay = bucket.take()
+                    if not delay:
+                        break
+                else:
+                    # a finishing request will wake us up
+                    delay = None
+                if not block:
+                    return None
+                if self.timeout is not None:
+                    left = started + self.timeout - time.time()
+                    if left <= 0:
+                        self._stats['timeouts'] += 1
+                        raise Exception('Timed out after %.3f seconds waiting on the rate limit for %s.' % (self.timeout, endpoint))
+                    if delay is None or delay > left:
+                        delay = left
+                waited = True
+                self._cond.wait(delay)
+            if limit is not None:
+                limit.in_flight += 1
+            self._stats['requests'] += 1
+            if waited:
+                self._stats['waits'] += 1
+                self._stats['wait_time'] += time.time() - started
+            return Permit(self, limit)
+        finally:
+            self._cond.release()
+
+    def _finish(self, limit, started, latency, overloaded):
+        self._cond.acquire()
+        try:
+            limit.finish(started, latency, overloaded)
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
+
+    def stats(self):
+        '''Returns counters (requests, waits, wait time, timeouts) and each adaptive limit's state, by rule and endpoint.'''
+        self._cond.acquire()
+        try:
+            stats = dict(self._stats)
+            limits = {}
+            for rule in self._rules:
+                for (endpoint, limit) in rule.limits.iteritems():
+                    limits['%s %s' % (endpoint, rule.prefix or '*')] = {
+                        'limit': limit.limit,
+                        'in_flight': limit.in_flight,
+                        'latency': limit.recent,
+                        'baseline': limit.baseline,
+                        'backoffs': limit.backoffs
+                    }
+            stats['limits'] = limits
+        finally:
+            self._cond.release()
+        return stats
+
+    def gauges(self):
+        '''Returns each adaptive limit as a labelled gauge, for metrics.Metrics.add_collector().'''
+        gauges = {}
+        for (name, limit) in self.stats()['limits'].iteritems():
+            (endpoint, prefix) = name.split(' ', 1)
+            labels = '{endpoint="%s",prefix="%s"}' % (endpoint, prefix.replace('"', '\\"'))
+            gauges['concurrency_limit' + labels] = limit['limit']
+            gauges['in_flight' + labels] = limit['in_flight']
+            gauges['backoffs' + labels] = limit['backoffs']
+        return gauges
@@ -0,0 +1,253 @@
+#!/usr/bin/python -tt
+
+# omega - python client
+# https://github.com/jfillmore/Omega-API-Engine
+#
+# Copyright 2011, Jonathon Fillmore
+# Licensed under the MIT license. See LICENSE file.
+# http://www.opensource.org/licenses/mit-license.php
+
+
+"""Client-side request metrics (latency histograms, byte and status counts), exportable for Prometheus."""
+
+import os
+import re
+import math
+import tempfile
+import threading
+
+# latencies are bucketed HDR-style: each doubling from 2^(MIN_EXP - 1) to
+# 2^MAX_EXP seconds (~61us to 256s) is split into SUB_BUCKETS linear steps
+MIN_EXP = -13
+MAX_EXP = 8
+SUB_BUCKETS = 4
+
+_ids = re.compile(r'/(\d+|[0-9a-fA-F]{8}-[0-9a-fA-F-]{27}|[0-9a-fA-F]{24,})(?=/|$)')
+
+
+def template(api):
+    '''Returns an API path with IDs (numbers, UUIDs, long hex strings) replaced, so calls to the same API are counted together.'''
+    api = api.split('?', 1)[0]
+    return _ids.sub('/:id', api)
+
+
+class Histogram:
+    """Log-linear latency histogram; cheap to record into, with fixed bucket bounds.
+
+    Values past the last bound are only counted in 'overflow' (and so
+    only in the +Inf bucket when exported)."""
+
+    bounds = [
+        math.ldexp(1 + (j + 1.0) / SUB_BUCKETS, exp - 1)
+        for exp in range(MIN_EXP, MAX_EXP + 1)
+        for j in range(SUB_BUCKETS)
+    ]
+
+    def __init__(self):
+        self.counts = [0] * len(self.bounds)
+        self.overflow = 0
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        (mantissa, exp) = math.frexp(value)
+        if value <= 0 or exp < MIN_EXP:
+            self.counts[0] += 1
+        elif exp > MAX_EXP:
+            self.overflow += 1
+        else:
+            self.counts[(exp - MIN_EXP) * SUB_BUCKETS + int((mantissa - 0.5) * 2 * SUB_BUCKETS)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        '''Returns the upper bound of the bucket holding the given percentile.'''
+        if not self.count:
+            return None
+        wanted = self.count * percent / 100.0
+        seen = 0
+        for (index, count) in enumerate(self.counts):
+            seen += count
+            if seen >= wanted and count:
+                return min(self.bounds[index], self.max)
+        # in the overflow, which has no upper bound
+        return self.max
+
+
+class _ApiStats:
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.statuses = {}
+        self.retries = 0
+
+
+class Metrics:
+    """Collects request metrics for one or more clients; see OmegaClient.set_metrics().
+
+    Requests are counted per method and API template (see template()).
+    Counters from elsewhere (e.g. the connection pool) can be included in
+    exports with add_collector(). Call start() to have the metrics written
+    to a Prometheus textfile and/or handed to a callback periodically."""
+
+    def __init__(self, templater = template):
+        self.templater = templater
+        self.in_flight = 0
+        self._lock = threading.Lock()
+        self._apis = {}
+        self._collectors = {}
+        self._templates = {}
+        self._stop = None
+
+    def start_request(self):
+        self._lock.acquire()
+        try:
+            self.in_flight += 1
+        finally:
+            self._lock.release()
+
+    def finish_request(self, method, api, status, latency, request_bytes = 0, response_bytes = 0, tries = 1):
+        '''Records a finished request; 'status' is the HTTP status, or e.g. 'error' if there wasn't one.'''
+        # templating costs a regex; the same APIs get called over and over
+        name = self._templates.get(api)
+        if name is None:
+            name = self.templater(api)
+            if len(self._templates) < 10000:
+                self._templates[api] = name
+        key = (method, name)
+        self._lock.acquire()
+        try:
+            self.in_flight -= 1
+            stats = self._apis.get(key)
+            if stats is None:
+                stats = self._apis[key] = _ApiStats()
+            stats.latency.record(latency)
+            stats.request_bytes += request_bytes
+            stats.response_bytes += response_bytes
+            stats.statuses[status] = stats.statuses.get(status, 0) + 1
+            stats.retries += tries - 1
+        finally:
+            self._lock.release()
+
+    def add_collector(self, name, func):
+        '''Includes the numeric values of the dict returned by 'func()' in exports, as omega_client_<name>_<key>.'''
+        self._collectors[name] = func
+
+    def snapshot(self):
+        '''Returns the metrics so far as a dict.'''
+        self._lock.acquire()
+        try:
+            apis = {}
+            for ((method, name), stats) in self._apis.iteritems():
+                latency = stats.latency
+                apis['%s %s' % (method, name)] = {
+                    'count': latency.count,
+                    'latency_sum': latency.sum,
+                    'latency_max': latency.max,
+                    'p50': latency.percentile(50),
+                    'p90': latency.percentile(90),
+                    'p99': latency.percentile(99),
+                    'request_bytes': stats.request_bytes,
+                    'response_bytes': stats.response_bytes,
+                    'statuses': dict(stats.statuses),
+                    'retries': stats.retries
+                }
+            snapshot = {'in_flight': self.in_flight, 'apis': apis}
+        finally:
+            self._lock.release()
+        for (name, func) in self._collectors.items():
+            snapshot[name] = func()
+        return snapshot
+
+    def prometheus(self):
+        '''Returns the metrics in the Prometheus text exposition format.'''
+        lines = []
+
+        def header(name, kind, text):
+            lines.append('# HELP %s %s' % (name, text))
+            lines.append('# TYPE %s %s' % (name, kind))
+
+        self._lock.acquire()
+        try:
+            apis = sorted([(key, stats) for (key, stats) in self._apis.iteritems()])
+            header('omega_client_request_duration_seconds', 'histogram', 'Time taken by API requests.')
+            for ((method, name), stats) in apis:
+                labels = 'method="%s",api="%s"' % (method, _escape(name))
+                latency = stats.latency
+                total = 0
+                for (bound, count) in zip(latency.bounds, latency.counts):
+                    total += count
+                    lines.append('omega_client_request_duration_seconds_bucket{%s,le="%.6g"} %d' % (labels, bound, total))
+                lines.append('omega_client_request_duration_seconds_bucket{%s,le="+Inf"} %d' % (labels, latency.count))
+                lines.append('omega_client_request_duration_seconds_sum{%s} %.6f' % (labels, latency.sum))
+                lines.append('omega_client_request_duration_seconds_count{%s} %d' % (labels, latency.count))
+            for (metric, attr, text) in (
+                    ('omega_client_request_bytes_total', 'request_bytes', 'Bytes sent in request bodies, on the wire.'),
+                    ('omega_client_response_bytes_total', 'response_bytes', 'Bytes received in response bodies, on the wire.'),
+                    ('omega_client_retries_total', 'retries', 'Requests sent again after a failure.')):
+                header(metric, 'counter', text)
+                for ((method, name), stats) in apis:
+                    lines.append('%s{method="%s",api="%s"} %d' % (metric, method, _escape(name), getattr(stats, attr)))
+            header('omega_client_responses_total', 'counter', 'Responses by HTTP status.')
+            for ((method, name), stats) in apis:
+                for (status, count) in sorted(stats.statuses.items()):
+                    lines.append('omega_client_responses_total{method="%s",api="%s",status="%s"} %d' %
+                        (method, _escape(name), status, count))
+            header('omega_client_in_flight', 'gauge', 'Requests currently in progress.')
+            lines.append('omega_client_in_flight %d' % self.in_flight)
+        finally:
+            self._lock.release()
+        for (name, func) in sorted(self._collectors.items()):
+            for (key, value) in sorted(func().items()):
+                if isinstance(value, (int, long, float)) and not isinstance(value, bool):
+                    # collectors mix counters and gauges, and don't say which
+                    header('omega_client_%s_%s' % (name, key), 'untyped', 'The %s stat "%s".' % (name, key))
+                    lines.append('omega_client_%s_%s %s' % (name, key, value))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        '''Writes the metrics to a file (e.g. for node_exporter's textfile collector), replacing it atomically.'''
+        (fd, tmp_path) = tempfile.mkstemp(prefix = '.' + os.path.basename(path), dir = os.path.dirname(path) or '.')
+        try:
+            os.write(fd, self.prometheus())
+            os.close(fd)
+            os.chmod(tmp_path, 0644)
+            os.rename(tmp_path, path)
+        except:
+            os.unlink(tmp_path)
+            raise
+
+    def start(self, interval = 60, path = None, callback = None):
+        '''Writes the metrics to 'path' and/or passes a snapshot() to 'callback' every 'interval' seconds.'''
+        self.stop()
+        stop = self._stop = threading.Event()
+
+        def export_loop():
+            while True:
+                stop.wait(interval)
+                if stop.is_set():
+                    return
+                try:
+                    if path is not None:
+                        self.write(path)
+                    if callback is not None:
+                        callback(self.snapshot())
+                except (IOError, OSError):
+                    pass
+        thread = threading.Thread(target = export_loop, name = 'omega-metrics-export')
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        if self._stop is not None:
+            self._stop.set()
+            self._stop = None
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1,376 @@
+#!/usr/bin/python -tt
+
+# omega - python client
+# https://github.com/jfillmore/Omega-API-Engine
+#
+# Copyright 2011, Jonathon Fillmore
+# Licensed under the MIT license. See LICENSE file.
+# http://www.opensource.org/licenses/mit-license.php
+
+
+"""Thread-safe pool of keep-alive HTTP(S) connections."""
+
+import httplib
+import select
+import socket
+import ssl
+import sys
+import threading
+import time
+
+from error import Exception
+from resolver import Resolver
+from transport import Transport
+
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    """HTTP over a Unix domain socket, for servers on the same host."""
+
+    def __init__(self, path, host = 'localhost', timeout = socket._GLOBAL_DEFAULT_TIMEOUT):
+        httplib.HTTPConnection.__init__(self, host, timeout = timeout)
+        self.path = path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+            sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.path)
+        except socket.error:
+            sock.close()
+            raise
+        self.sock = sock
+
+
+class ConnectionPool(Transport):
+    """Pool of keep-alive connections, keyed by (scheme, host, port); the default transport.
+
+    Connections are checked out with get() and must be handed back with
+    put() once the response has been fully read, or with discard() if the
+    connection is no longer usable. At most 'max_size' connections per key
+    exist at once; further callers wait up to 'timeout' seconds for one to
+    be returned. Connections sitting idle for more than 'max_idle' seconds
+    are closed by a background reaper, which only runs while any are idle.
+    HTTPS connections share one SSL context ('ssl_context', or the same
+    default httplib would use), rather than loading the CA certificates
+    again for every connection. Host names
+    are looked up and connected to through 'resolver' (a resolver.Resolver
+    of the pool's own by default), which caches lookups and races a host's
+    addresses against each other."""
+
+    name = 'httplib'
+    curl_compatible = True
+
+    def __init__(self, max_size = 10, max_idle = 60, timeout = None, reap_interval = 15, ssl_context = None, resolver = None):
+        if resolver is None:
+            resolver = Resolver()
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.reap_interval = reap_interval
+        self.ssl_context = ssl_context
+        self.resolver = resolver
+        self._cond = threading.Condition()
+        self._idle = {} # key => [(conn, last_used), ...], most recently used last
+        self._count = {} # key => connections alive, idle or checked out
+        self._generation = 0 # bumped by close(); connections from before it aren't pooled again
+        self._reaper = None
+        self._stats = {
+            'checkouts': 0,
+            'waits': 0,
+            'new_connections': 0,
+            'reused': 0,
+            'discarded': 0,
+            'reaped': 0,
+            'unhealthy': 0,
+            'preconnected': 0
+        }
+
+    def _connect(self, key):
+        (scheme, host, port) = key
+        if scheme == 'unix':
+            # the 'host' is the socket's path
+            return UnixHTTPConnection(host)
+        if scheme == 'https':
+            context = self._get_ssl_context()
+            if context is None:
+                return httplib.HTTPSConnection(host, port)
+            return httplib.HTTPSConnection(host, port, context = context)
+        return httplib.HTTPConnection(host, port)
+
+    def connect(self, conn, timing = None):
+        '''Connects (and for HTTPS, handshakes) a connection from _connect(), adding the time taken by each step to 'timing'.'''
+        started = time.time()
+        if isinstance(conn, UnixHTTPConnection):
+            conn.connect()
+            if timing is not None:
+                timing.connect += time.time() - started
+            return conn
+        addresses = self.resolver.resolve(conn.host, conn.port)
+        resolved = time.time()
+        timeout = conn.timeout
+        if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+            timeout = socket.getdefaulttimeout()
+        sock = self.resolver.connect(addresses, timeout)
+        connected = time.time()
+        if isinstance(conn, httplib.HTTPSConnection):
+            context = getattr(conn, '_context', None)
+            if context is None:
+                sock = ssl.wrap_socket(sock, conn.key_file, conn.cert_file)
+            else:
+                server_hostname = None
+                if ssl.HAS_SNI:
+                    server_hostname = conn.host
+                sock = context.wrap_socket(sock, server_hostname = server_hostname)
+        conn.sock = sock
+        if timing is not None:
+            timing.dns += resolved - started
+            timing.connect += connected - resolved
+            timing.tls += time.time() - connected
+        return conn
+
+    def _get_ssl_context(self):
+        # SSL contexts only exist as of python 2.7.9
+        if self.ssl_context is None and hasattr(ssl, '_create_default_https_context'):
+            self._cond.acquire()
+            try:
+                if self.ssl_context is None:
+                    self.ssl_context = ssl._create_default_https_context()
+            finally:
+                self._cond.release()
+        return self.ssl_context
+
+    def _is_healthy(self, conn):
+        '''An idle keep-alive socket should have nothing to read; if it does, the server either closed it or sent junk.'''
+        sock = conn.sock
+        if sock is None:
+            return True
+        try:
+            (readable, writable, errored) = select.select([sock], [], [sock], 0)
+        except (socket.error, select.error, ValueError):
+            return False
+        if readable and not errored and isinstance(sock, ssl.SSLSocket):
+            return self._is_healthy_ssl(sock)
+        return not readable and not errored
+
+    def _is_healthy_ssl(self, sock):
+        # TLS 1.3 servers send session tickets after the handshake, so a fresh
+        # connection is readable without there being anything to read
+        timeout = sock.gettimeout()
+        sock.setblocking(0)
+        try:
+            try:
+                sock.recv(1)
+            except ssl.SSLError, e:
+                return e.args[0] == ssl.SSL_ERROR_WANT_READ
+            except socket.error:
+                return False
+            return False
+        finally:
+            sock.settimeout(timeout)
+
+    def get(self, scheme, host, port):
+        '''Checks out a connection for the given scheme/host/port, creating one if the pool has room.'''
+        key = (scheme, host, port)
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.time() + self.timeout
+        waited = False
+        self._cond.acquire()
+        try:
+            while True:
+                idle = self._idle.get(key)
+                while idle:
+                    (conn, last_used) = idle.pop()
+                    if time.time() - last_used <= self.max_idle and self._is_healthy(conn):
+                        self._stats['checkouts'] += 1
+                        self._stats['reused'] += 1
+                        return conn
+                    if time.time() - last_used > self.max_idle:
+                        self._stats['reaped'] += 1
+                    else:
+                        self._stats['unhealthy'] += 1
+                    self._count[key] -= 1
+                    conn.close()
+                if self._count.get(key, 0) < self.max_size:
+                    self._count[key] = self._count.get(key, 0) + 1
+                    self._stats['checkouts'] += 1
+                    self._stats['new_connections'] += 1
+                    generation = self._generation
+                    break
+                if not waited:
+                    waited = True
+                    self._stats['waits'] += 1
+                if deadline is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise Exception('Timed out waiting for a connection to %s://%s:%s.' % key)
+                    self._cond.wait(remaining)
+        finally:
+            self._cond.release()
+        # connect outside of the lock; httplib opens the socket lazily anyway
+        try:
+            conn = self._connect(key)
+        except:
+            self._release(key)
+            raise
+        conn.pool_key = key
+        conn.pool_generation = generation
+        return conn
+
+    def put(self, conn):
+        '''Returns a connection to the pool for reuse, or closes it if the pool was closed since it was checked out.'''
+        key = conn.pool_key
+        self._cond.acquire()
+        try:
+            if conn.pool_generation != self._generation:
+                conn.close()
+                self._count[key] -= 1
+                self._cond.notify()
+                return
+            self._idle.setdefault(key, []).append((conn, time.time()))
+            self._cond.notify()
+        finally:
+            self._cond.release()
+        self._start_reaper()
+
+    def discard(self, conn):
+        '''Closes a checked out connection and frees its slot in the pool.'''
+        conn.close()
+        self._cond.acquire()
+        try:
+            self._stats['discarded'] += 1
+        finally:
+            self._cond.release()
+        self._release(conn.pool_key)
+
+    def _release(self, key):
+        self._cond.acquire()
+        try:
+            self._count[key] -= 1
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def preconnect(self, scheme, host, port, count = 1):
+        '''Opens (and for HTTPS, handshakes) connections ahead of time until 'count' are idle, returning how many were opened.'''
+        key = (scheme, host, port)
+        self._cond.acquire()
+        try:
+            idle = len(self._idle.get(key, []))
+            wanted = min(count - idle, self.max_size - self._count.get(key, 0))
+            if wanted <= 0:
+                return 0
+            self._count[key] = self._count.get(key, 0) + wanted
+            generation = self._generation
+        finally:
+            self._cond.release()
+        errors = []
+
+        def connect():
+            try:
+                conn = self._connect(key)
+                conn.pool_key = key
+                conn.pool_generation = generation
+                self.connect(conn)
+            except:
+                # whatever went wrong, the slot reserved for it has to be given back
+                errors.append(sys.exc_info()[1])
+                self._release(key)
+                return
+            self.put(conn)
+
+        # handshakes mostly wait on the network, so do them all at once
+        threads = [threading.Thread(target = connect) for i in range(wanted)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        opened = wanted - len(errors)
+        self._cond.acquire()
+        try:
+            self._stats['new_connections'] += opened
+            self._stats['preconnected'] += opened
+        finally:
+            self._cond.release()
+        if errors and not opened:
+            raise Exception('Failed to connect to %s://%s:%s: %s' % (key + (str(errors[0]),)))
+        return opened
+
+    def reap(self):
+        '''Closes any connections that have been idle for too long.'''
+        now = time.time()
+        self._cond.acquire()
+        try:
+            for key in self._idle:
+                keep = []
+                for (conn, last_used) in self._idle[key]:
+                    if now - last_used > self.max_idle:
+                        conn.close()
+                        self._count[key] -= 1
+                        self._stats['reaped'] += 1
+                    else:
+                        keep.append((conn, last_used))
+                self._idle[key] = keep
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+    def _start_reaper(self):
+        if self._reaper is not None:
+            return
+        self._cond.acquire()
+        try:
+            if self._reaper is None:
+                self._reaper = threading.Thread(target = self._reap_loop, name = 'omega-pool-reaper')
+                self._reaper.daemon = True
+                self._reaper.start()
+        finally:
+            self._cond.release()
+
+    def _reap_loop(self):
+        while True:
+            time.sleep(self.reap_interval)
+            self.reap()
+            self._cond.acquire()
+            try:
+                # nothing left to reap (e.g. once closed); put() starts another reaper when there is
+                if not [idle for idle in self._idle.values() if idle]:
+                    self._reaper = None
+                    return
+            finally:
+                self._cond.release()
+
+    def close(self):
+        '''Closes all idle connections. Checked out connections are closed as they are returned.
+
+        The pool can still be used afterwards; it opens new connections.'''
+        self._cond.acquire()
+        try:
+            self._generation += 1
+            for key in self._idle:
+                for (conn, last_used) in self._idle[key]:
+                    conn.close()
+                    self._count[key] -= 1
+            self._idle = {}
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+    def stats(self):
+        '''Returns a snapshot of the pool's counters.'''
+        self._cond.acquire()
+        try:
+            stats = dict(self._stats)
+            stats['idle'] = sum([len(idle) for idle in self._idle.values()])
+            stats['open'] = sum(self._count.values())
+        finally:
+            self._cond.release()
+        if stats['checkouts']:
+            stats['reuse_ratio'] = float(stats['reused']) / stats['checkouts']
+        else:
+            stats['reuse_ratio'] = 0.0
+        stats['resolver'] = self.resolver.stats()
+        return stats
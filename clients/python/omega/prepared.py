@@ -0,0 +1,78 @@
+#!/usr/bin/python -tt
+
+# omega - python client
+# https://github.com/jfillmore/Omega-API-Engine
+#
+# Copyright 2011, Jonathon Fillmore
+# Licensed under the MIT license. See LICENSE file.
+# http://www.opensource.org/licenses/mit-license.php
+
+
+"""Prepared API requests, for calling the same API over and over in tight loops."""
+
+import urllib
+
+
+class PreparedRequest:
+    """An API call with its URL and headers worked out ahead of time; see OmegaClient.prepare()."""
+
+    def __init__(self, client, method, api, get = None, headers = None, raw_response = False, full_response = False, no_format = False):
+        self.client = client
+        (self.method, self.api, self.url, self.headers) = client._build_base(method, api, get, headers)
+        self.raw_response = raw_response
+        self.full_response = full_response
+        self.no_format = no_format
+        if self.method == 'GET':
+            self._query_prefix = self.url + '?'
+        else:
+            self._query_prefix = None
+
+    def __call__(self, params = (), verbose = False):
+        return self.send(params, verbose)
+
+    def build(self, params = ()):
+        '''Returns the URL and body to send for the given params.'''
+        if self._query_prefix is not None:
+            quote = urllib.quote
+            return (self._query_prefix + '&'.join([
+                quote(name) + '=' + quote(str(params[name])) for name in params
+            ]), None)
+        return (self.url, self.client.encode(params))
+
+    def send(self, params = (), verbose = False):
+        '''Runs the API with the given params, returning the result as OmegaClient.request() would.'''
+        (url, data) = self.build(params)
+        # headers are copied since caching may add revalidation headers
+        return self.client._perform(
+            self.method,
+            self.api,
+            url,
+            data,
+            dict(self.headers),
+            self.raw_response,
+            self.full_response,
+            self.no_format,
+            verbose
+        )
+
+
+if __name__ == '__main__':
+    # compare the per-call overhead of building a request from scratch vs. prepared
+    import sys
+    import time
+    from client import OmegaClient
+
+    def timed(func, count = 100000):
+        start = time.time()
+        for i in xrange(count):
+            func()
+        return (time.time() - start) / count
+
+    client = OmegaClient('localhost/api/v1', {'username': 'user', 'password': 'secret'})
+    for method in ('GET', 'POST'):
+        params = {'account_id': 12345, 'name': 'example', 'enabled': True}
+        prepared = client.prepare(method, '/account/list')
+        before = timed(lambda: client._build_request(method, '/account/list', params))
+        after = timed(lambda: prepared.build(params))
+        sys.stdout.write('%-4s  request: %6.2f us/call  prepared: %6.2f us/call  (%.1fx)\n' %
+            (method, before * 1000000, after * 1000000, before / after))
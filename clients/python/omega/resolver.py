@@ -0,0 +1,265 @@
+#!/usr/bin/python -tt
+
+# omega - python client
+# https://github.com/jfillmore/Omega-API-Engine
+#
+# Copyright 2011, Jonathon Fillmore
+# Licensed under the MIT license. See LICENSE file.
+# http://www.opensource.org/licenses/mit-license.php
+
+
+"""Cached DNS lookups and happy eyeballs (RFC 8305) connects, racing a host's addresses against each other."""
+
+import os
+import time
+import errno
+import select
+import socket
+import threading
+
+_IN_PROGRESS = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN)
+
+
+class Resolver:
+    """Looks up host names, remembering the answers, and connects to whichever address answers first.
+
+    The system resolver doesn't say how long its answers are good for,
+    so they're kept for 'ttl' seconds (and used past that if a lookup
+    fails). Addresses are tried in the order they're given, alternating
+    between IPv6 and IPv4; each attempt gets 'attempt_delay' seconds
+    before the next is started alongside it, and the first to connect
+    wins. An address that fails to connect, or is beaten by one tried
+    after it, is tried after the others for the next 'failure_ttl'
+    seconds, so a broken route (e.g. IPv6 that goes nowhere) only costs
+    the delay once rather than on every connect."""
+
+    def __init__(self, ttl = 60, attempt_delay = 0.25, failure_ttl = 600, max_entries = 1000):
+        self.ttl = ttl
+        self.attempt_delay = attempt_delay
+        self.failure_ttl = failure_ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._cache = {} # (host, port) => (expires, addresses)
+        self._failures = {} # address => (failures in a row, last failed)
+        self._stats = {
+            'lookups': 0,
+            'cache_hits': 0,
+            'stale_hits': 0,
+            'connects': 0,
+            'raced': 0,
+            'failures': 0
+        }
+
+    def resolve(self, host, port):
+        '''Returns the (family, socktype, proto, address) to try for a host, best first.'''
+        key = (host, port)
+        now = time.time()
+        self._lock.acquire()
+        try:
+            self._stats['lookups'] += 1
+            cached = self._cache.get(key)
+            if cached is not None and cached[0] > now:
+                self._stats['cache_hits'] += 1
+                return self._order(cached[1])
+        finally:
+            self._lock.release()
+        try:
+            addresses = [
+                (family, socktype, proto, address)
+                for (family, socktype, proto, canonname, address)
+                in socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+            ]
+        except socket.gaierror:
+            if cached is None:
+                raise
+            # better an old answer than none at all
+            self._lock.acquire()
+            try:
+                self._stats['stale_hits'] += 1
+                return self._order(cached[1])
+            finally:
+                self._lock.release()
+        addresses = _interleave(addresses)
+        self._lock.acquire()
+        try:
+            if len(self._cache) >= self.max_entries:
+                for (name, (expires, entry)) in self._cache.items():
+                    if expires <= now:
+                        del self._cache[name]
+                if len(self._cache) >= self.max_entries:
+                    self._cache.clear()
+            self._cache[key] = (now + self.ttl, addresses)
+            return self._order(addresses)
+        finally:
+            self._lock.release()
+
+    def _order(self, addresses):
+        '''Moves addresses that failed lately to the back, least recently failed first; the lock must be held.'''
+        now = time.time()
+        good = []
+        bad = []
+        for entry in addresses:
+            failure = self._failures.get(entry[3])
+            if failure is not None and now - failure[1] < self.failure_ttl:
+                bad.append((failure[1], entry))
+            else:
+                good.append(entry)
+        bad.sort()
+        return good + [entry for (failed, entry) in bad]
+
+    def _count(self, name, amount = 1):
+        self._lock.acquire()
+        try:
+            self._stats[name] += amount
+        finally:
+            self._lock.release()
+
+    def failed(self, address):
+        '''Notes that an address didn't connect (or too slowly), so it's tried last for a while.'''
+        now = time.time()
+        self._lock.acquire()
+        try:
+            self._stats['failures'] += 1
+            (count, last_failed) = self._failures.get(address, (0, None))
+            self._failures[address] = (count + 1, now)
+            if len(self._failures) > self.max_entries:
+                for (other, (count, last_failed)) in self._failures.items():
+                    if now - last_failed >= self.failure_ttl:
+                        del self._failures[other]
+        finally:
+            self._lock.release()
+
+    def succeeded(self, address):
+        self._lock.acquire()
+        try:
+            self._failures.pop(address, None)
+        finally:
+            self._lock.release()
+
+    def connect(self, addresses, timeout = None):
+        '''Connects to the first of the addresses (from resolve()) to answer, racing them RFC 8305 style; returns the socket.
+
+        The socket is left with 'timeout' set on it (None for blocking);
+        if nothing has connected within 'timeout' seconds socket.timeout is
+        raised, otherwise the last error any address gave.'''
+        if not addresses:
+            raise socket.error('getaddrinfo returns an empty list')
+        self._count('connects')
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        queue = list(addresses)
+        # socket => (address, started)
+        pending = {}
+        error = None
+        next_start = 0
+        winner = None
+        try:
+            while winner is None:
+                now = time.time()
+                if queue and now >= next_start:
+                    (family, socktype, proto, address) = queue.pop(0)
+                    if pending:
+                        self._count('raced')
+                    try:
+                        sock = socket.socket(family, socktype, proto)
+                    except socket.error, error:
+                        self.failed(address)
+                        continue
+                    sock.setblocking(0)
+                    result = sock.connect_ex(address)
+                    if not result:
+                        winner = (sock, address, now)
+                        break
+                    if not result in _IN_PROGRESS:
+                        sock.close()
+                        error = socket.error(result, '%s (%s)' % (os.strerror(result), address[0]))
+                        self.failed(address)
+                        # no point waiting on a connection that's already failed
+                        continue
+                    pending[sock] = (address, now)
+                    next_start = now + self.attempt_delay
+                if not pending:
+                    if not queue:
+                        raise error
+                    continue
+                wait = None
+                if queue:
+                    wait = max(0, next_start - now)
+                if deadline is not None:
+                    if now >= deadline:
+                        for (address, started) in pending.values():
+                            self.failed(address)
+                        raise socket.timeout('timed out')
+                    if wait is None or deadline - now < wait:
+                        wait = deadline - now
+                try:
+                    (readable, writable, errored) = select.select([], pending.keys(), pending.keys(), wait)
+                except select.error, e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                for sock in writable + errored:
+                    if not sock in pending:
+                        continue
+                    (address, started) = pending.pop(sock)
+                    result = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    if not result and winner is None:
+                        winner = (sock, address, started)
+                        continue
+                    sock.close()
+                    if result:
+                        error = socket.error(result, '%s (%s)' % (os.strerror(result), address[0]))
+                        self.failed(address)
+                        # start the next one now rather than waiting out the delay
+                        next_start = 0
+        finally:
+            (sock, address, started) = winner or (None, None, None)
+            for (other, (other_address, other_started)) in pending.items():
+                other.close()
+                if winner is not None and other_started < started:
+                    # tried first, but still going when a later one had connected
+                    self.failed(other_address)
+        self.succeeded(address)
+        sock.settimeout(timeout)
+        return sock
+
+    def clear(self):
+        '''Forgets all cached answers and failures.'''
+        self._lock.acquire()
+        try:
+            self._cache = {}
+            self._failures = {}
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        '''Returns lookup and connect counters, and how many names and failing addresses are remembered.'''
+        self._lock.acquire()
+        try:
+            stats = dict(self._stats)
+            stats['cached'] = len(self._cache)
+            stats['failing'] = len([
+                address for (address, (count, last_failed)) in self._failures.iteritems()
+                if time.time() - last_failed < self.failure_ttl
+            ])
+        finally:
+            self._lock.release()
+        return stats
+
+
+def _interleave(addresses):
+    '''Alternates address families (RFC 8305 section 4), starting with whichever the system put first.'''
+    families = []
+    by_family = {}
+    for entry in addresses:
+        if not entry[0] in by_family:
+            families.append(entry[0])
+            by_family[entry[0]] = []
+        by_family[entry[0]].append(entry)
+    ordered = []
+    while len(ordered) < len(addresses):
+        for family in families:
+            if by_family[family]:
+                ordered.append(by_family[family].pop(0))
+    return ordered
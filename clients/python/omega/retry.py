@@ -0,0 +1,232 @@
+#!/usr/bin/python -tt
+
+# omega - python client
+# https://github.com/jfillmore/Omega-API-Engine
+#
+# Copyright 2011, Jonathon Fillmore
+# Licensed under the MIT license. See LICENSE file.
+# http://www.opensource.org/licenses/mit-license.php
+
+
+"""Retry policy (exponential backoff w/ jitter, Retry-After, deadlines) and per-host circuit breakers."""
+
+import time
+import random
+import threading
+import email.utils
+
+from error import Exception
+
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+
+class CircuitBreaker:
+    """Fails fast while a host keeps failing.
+
+    After 'threshold' failures in a row the circuit opens and requests are
+    refused outright. Once 'reset_timeout' seconds pass a single trial
+    request is let through (half-open); it closes the circuit if it works
+    and re-opens it if not."""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, threshold = 5, reset_timeout = 30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._probing = None
+
+    def allow(self):
+        '''Returns whether a request may be sent right now.'''
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            if time.time() - self.opened_at < self.reset_timeout:
+                return False
+            self.state = self.HALF_OPEN
+            self._probing = None
+        # half-open: just the one trial request at a time (unless it got lost along the way)
+        now = time.time()
+        if self._probing is not None and now - self._probing < self.reset_timeout:
+            return False
+        self._probing = now
+        return True
+
+    def success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probing = None
+
+    def failure(self):
+        '''Records a failure; returns True if that tripped the circuit open.'''
+        self.failures += 1
+        self._probing = None
+        if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.threshold):
+            self.state = self.OPEN
+            self.opened_at = time.time()
+            return True
+        return False
+
+
+class RetryPolicy:
+    """Decides when (and how long to wait before) a failed request is tried again.
+
+    Requests are tried up to 'max_tries' times, sleeping a random amount up
+    to 'backoff' * 2^n seconds (capped at 'max_backoff') between tries, or
+    for however long the server's Retry-After asks. Nothing is retried once
+    'deadline' seconds have passed since the first try. Requests that may
+    have reached the server are only retried for the given 'methods' (set
+    to None to retry every method); connection failures are always safe to
+    retry. Responses with one of the 'statuses' are retried too. Each host
+    gets a CircuitBreaker, shared by every client using the policy."""
+
+    def __init__(self, max_tries = 3, backoff = 0.1, max_backoff = 10, deadline = 30, methods = IDEMPOTENT_METHODS, statuses = (429, 502, 503, 504), breaker_threshold = 5, breaker_timeout = 30):
+        self.max_tries = max_tries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.deadline = deadline
+        self.methods = methods
+        self.statuses = statuses
+        self.breaker_threshold = breaker_threshold
+        self.breaker_timeout = breaker_timeout
+        self._lock = threading.Lock()
+        self._breakers = {}
+        self._stats = {
+            'retries': 0,
+            'giveups': 0,
+            'breaker_trips': 0,
+            'breaker_rejections': 0
+        }
+
+    def start(self, key, method):
+        '''Returns an Attempt to track a request to the host key (scheme, host, port).'''
+        return Attempt(self, key, method)
+
+    def retries_method(self, method):
+        return self.methods is None or method in self.methods
+
+    def check(self, key):
+        '''Raises an exception if the host's circuit is open.'''
+        self._lock.acquire()
+        try:
+            breaker = self._breakers.get(key)
+            if breaker is None or breaker.allow():
+                return
+            self._stats['breaker_rejections'] += 1
+            retry_in = max(0, breaker.reset_timeout - (time.time() - breaker.opened_at))
+        finally:
+            self._lock.release()
+        raise Exception('Circuit open for %s://%s:%s after %d failures; not trying again for %.1f seconds.' %
+            (key + (breaker.failures, retry_in)))
+
+    def success(self, key):
+        self._lock.acquire()
+        try:
+            breaker = self._breakers.get(key)
+            if breaker is not None:
+                breaker.success()
+        finally:
+            self._lock.release()
+
+    def failure(self, key):
+        '''Records a failure against the host; returns True if its circuit is now open.'''
+        self._lock.acquire()
+        try:
+            breaker = self._breakers.get(key)
+            if breaker is None:
+                breaker = CircuitBreaker(self.breaker_threshold, self.breaker_timeout)
+                self._breakers[key] = breaker
+            if breaker.failure():
+                self._stats['breaker_trips'] += 1
+            return breaker.state == CircuitBreaker.OPEN
+        finally:
+            self._lock.release()
+
+    def delay(self, tries, retry_after = None):
+        '''Returns how long to wait before the next try, given the tries so far and any Retry-After header.'''
+        if retry_after is not None:
+            wait = parse_retry_after(retry_after)
+            if wait is not None:
+                return wait
+        # "full jitter", so clients that failed together don't all come back together
+        return random.uniform(0, min(self.max_backoff, self.backoff * (2 ** (tries - 1))))
+
+    def count(self, stat):
+        self._lock.acquire()
+        try:
+            self._stats[stat] += 1
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        '''Returns retry counters and the state of each host's circuit breaker.'''
+        self._lock.acquire()
+        try:
+            stats = dict(self._stats)
+            stats['hosts'] = dict([
+                ('%s://%s:%s' % key, {'state': breaker.state, 'failures': breaker.failures})
+                for (key, breaker) in self._breakers.iteritems()
+            ])
+        finally:
+            self._lock.release()
+        return stats
+
+
+class Attempt:
+    """The retry state of a single request."""
+
+    def __init__(self, policy, key, method):
+        self.policy = policy
+        self.key = key
+        self.method = method
+        self.tries = 0
+        self.started = time.time()
+        self.last_delay = None
+        # whether the next try can go to another host, so this one's circuit opening needn't end the request
+        self.failover = False
+
+    def next(self):
+        '''Starts another try, failing fast if the host's circuit is open.'''
+        self.policy.check(self.key)
+        self.tries += 1
+
+    def success(self):
+        self.policy.success(self.key)
+
+    def failure(self, sent = True, retry_after = None, retryable = True):
+        '''Records a failed try. Returns True (after waiting) if it should be tried again, False to give up.'''
+        delay = self.retry_delay(sent, retry_after, retryable)
+        if delay is None:
+            return False
+        if delay > 0:
+            time.sleep(delay)
+        return True
+
+    def retry_delay(self, sent = True, retry_after = None, retryable = True):
+        '''Records a failed try as failure() does, but returns how long to wait before trying again (None to give up) rather than waiting.'''
+        policy = self.policy
+        if (policy.failure(self.key) and not self.failover) or not retryable or self.tries >= policy.max_tries or (sent and not policy.retries_method(self.method)):
+            policy.count('giveups')
+            return None
+        delay = policy.delay(self.tries, retry_after)
+        if policy.deadline is not None and time.time() - self.started + delay > policy.deadline:
+            policy.count('giveups')
+            return None
+        policy.count('retries')
+        self.last_delay = delay
+        return delay
+
+
+def parse_retry_after(value):
+    '''Returns the seconds to wait from a Retry-After header (in seconds or an HTTP date), or None if unreadable.'''
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    date = email.utils.parsedate_tz(value)
+    if date is None:
+        return None
+    return max(0, email.utils.mktime_tz(date) - time.time())
@@ -56,6 +56,8 @@ class Shell:
         'full_response': False,
         'raw_response': False,
         'raw_noformat': False,
+        'stream': False,
+        'timing': False,
         'headers': {},
         'verbose': False
     }
@@ -154,6 +156,8 @@ OPTIONAL OPTIONS (each may be specified multiple times)
 OTHER OPTIONS (may also be set via 'set' command)
    -f, --full             Return full response instead of just data
    -r, --raw              Print response data in raw form
+   -S, --stream           Stream the raw response body as it arrives (no formatting)
+   -T, --timing           Print where the request's time went (DNS, connect, etc)
    -v, --verbose          Print verbose debugging info to stderr
    -c, --color            Colorize return output (unless returning raw data)
    > FILE                 Write API response to specified file
@@ -189,6 +193,8 @@ EXAMPLE COMMANDS:
             'full_response': self.args['full_response'],
             'raw_response': self.args['raw_response'],
             'raw_noformat': self.args['raw_noformat'],
+            'stream': self.args['stream'],
+            'timing': self.args['timing'],
             'FILES': [],
             'GET': [],
             'POST': []
@@ -274,6 +280,10 @@ EXAMPLE COMMANDS:
                 if part == '-rr' or args['raw_response']:
                     args['raw_noformat'] = True
                 args['raw_response'] = True
+            elif part == '-S' or part == '--stream':
+                args['stream'] = True
+            elif part == '-T' or part == '--timing':
+                args['timing'] = True
             else:
                 # we always pick up the command first
                 if cmd == None:
@@ -313,6 +323,21 @@ EXAMPLE COMMANDS:
                     #(api, self.client.encode(api_params), self.client.encode(args))
                 #)
             try: 
+                if args['stream']:
+                    # write the body out as it arrives instead of holding onto it
+                    if file is None:
+                        output = sys.stdout
+                    else:
+                        output = file
+                    try:
+                        self._stream(cmd, api, api_params, args, '&'.join(args['GET']), output)
+                    finally:
+                        if file is not None:
+                            file.close()
+                    return {
+                        'result': True,
+                        'response': None
+                    }
                 if cmd == 'exec':
                     # TODO: fully deprecate and then remove
                     response = self.client.run(
@@ -340,6 +365,8 @@ EXAMPLE COMMANDS:
             except Exception, e:
                 result = False
                 response = e.message
+            finally:
+                self._print_timing(args)
         else:
             # run an internal command
             try:
@@ -426,7 +453,9 @@ EXAMPLE COMMANDS:
                     get = args['GET']
                 else:
                     get = '&'.join(args['GET'])
-            if method.upper() == 'EXEC':
+            if args['stream']:
+                response = self._stream(method, api, params, args, get, sys.stdout)
+            elif method.upper() == 'EXEC':
                 response = self.client.run(
                     api,
                     params,
@@ -453,7 +482,8 @@ EXAMPLE COMMANDS:
         except Exception, e:
             result = False
             response = e.message
-        if not 'quiet' in args or not args['quiet']:
+        self._print_timing(args)
+        if (not 'quiet' in args or not args['quiet']) and not (result and args['stream']):
             self._print_response(
                 result,
                 response,
@@ -466,6 +496,35 @@ EXAMPLE COMMANDS:
             'reason': response
         }
 
+    def _print_timing(self, args):
+        if args.get('timing'):
+            timing = self.client.last_timing()
+            if timing is not None:
+                sys.stderr.write('# Timing: %s\n' % timing.format())
+
+    def _stream(self, method, api, params, args, get, output):
+        '''Runs an API, writing the raw response body straight to 'output'.'''
+        if method.upper() == 'EXEC':
+            return self.client.run(
+                api,
+                params,
+                True,
+                args['full_response'],
+                get,
+                '&'.join(args['POST']),
+                args['FILES'],
+                output
+            )
+        return self.client.stream(
+            method,
+            api,
+            params,
+            output,
+            get,
+            args['headers'],
+            args['verbose']
+        )
+
     def env(self, key, value = None):
         key = key.lower()
         if key in self._env:
@@ -545,7 +604,7 @@ EXAMPLE COMMANDS:
                 val = pair[param]
                 if not (param in self.args):
                     raise Exception('Unrecognized parameter: "%s". Enter "%shelp" or "%sh" for help.' % (param, self._cmd_char, self._cmd_char))
-                if param in ['color', 'full_response', 'raw_response', 'verbose', 'headers']:
+                if param in ['color', 'full_response', 'raw_response', 'verbose', 'headers', 'timing', 'stream']:
                     # just so there is no confusion on these...
                     if val in ['1', 'true', 'True']:
                         val = True
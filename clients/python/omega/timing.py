@@ -0,0 +1,64 @@
+#!/usr/bin/python -tt
+
+# omega - python client
+# https://github.com/jfillmore/Omega-API-Engine
+#
+# Copyright 2011, Jonathon Fillmore
+# Licensed under the MIT license. See LICENSE file.
+# http://www.opensource.org/licenses/mit-license.php
+
+
+"""Per-request timing records, broken down by phase; see OmegaClient.on_request() and friends."""
+
+import time
+
+PHASES = ('queue', 'dns', 'connect', 'tls', 'send', 'wait', 'transfer')
+
+
+class Timing:
+    """Where the time went for one request, in seconds per phase.
+
+    Phases are 'queue' (waiting for a pooled connection), 'dns',
+    'connect' (TCP), 'tls', 'send' (writing the request), 'wait' (for the
+    server to start answering, i.e. time to first byte) and 'transfer'
+    (reading the body). Phases add up over retries. 'total' is the wall
+    clock time of the whole call, once it's finished."""
+
+    # the metrics.Metrics counting the request as in flight, until it's recorded there
+    _metrics = None
+
+    def __init__(self, transport, method = None, url = None, api = None):
+        self.transport = transport
+        self.method = method
+        self.url = url
+        self.api = api
+        self.status = None
+        self.tries = 0
+        self.reused = False
+        self.started = time.time()
+        self.total = None
+        for phase in PHASES:
+            setattr(self, phase, 0.0)
+
+    def finish(self, status = None):
+        self.status = status
+        self.total = time.time() - self.started
+
+    def phases(self):
+        '''Returns a dict of phase => seconds.'''
+        return dict([(phase, getattr(self, phase)) for phase in PHASES])
+
+    def format(self):
+        '''Returns the breakdown on one line, in milliseconds.'''
+        parts = ['%s %.1fms' % (phase, getattr(self, phase) * 1000) for phase in PHASES]
+        if self.total is not None:
+            parts.append('total %.1fms' % (self.total * 1000))
+        info = [self.transport]
+        if self.reused:
+            info.append('reused connection')
+        if self.tries > 1:
+            info.append('%d tries' % self.tries)
+        return '%s (%s)' % (', '.join(parts), ', '.join(info))
+
+    def __repr__(self):
+        return '<Timing %s %s: %s>' % (self.method, self.url, self.format())
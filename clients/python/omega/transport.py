@@ -0,0 +1,230 @@
+#!/usr/bin/python -tt
+
+# omega - python client
+# https://github.com/jfillmore/Omega-API-Engine
+#
+# Copyright 2011, Jonathon Fillmore
+# Licensed under the MIT license. See LICENSE file.
+# http://www.opensource.org/licenses/mit-license.php
+
+
+"""Transports: what OmegaClient sends requests through, including an in-process one for WSGI apps."""
+
+import sys
+import httplib
+import threading
+import urllib
+from cStringIO import StringIO
+
+from error import Exception
+
+
+class Transport:
+    """Hands out connections to send requests over; see OmegaClient.set_transport().
+
+    Connections are got for a (scheme, host, port) key and work like
+    httplib.HTTPConnection: putrequest(), putheader(), endheaders(),
+    send() and getresponse(), which returns something that works like an
+    httplib.HTTPResponse. Once a response has been read the connection is
+    handed back with put(), or with discard() if it's no longer usable.
+    Retries, cookies, caching and the like are up to the client, so work
+    the same whatever the transport. pool.ConnectionPool is the default:
+    keep-alive sockets over TCP, TLS or Unix domain sockets."""
+
+    # as shown in timing.Timing records
+    name = 'transport'
+    # whether old style run() calls may go through libcurl to reach the same servers instead
+    curl_compatible = False
+
+    def get(self, scheme, host, port):
+        raise NotImplementedError()
+
+    def put(self, conn):
+        pass
+
+    def discard(self, conn):
+        pass
+
+    def connect(self, conn, timing = None):
+        '''Connects a connection from get() that isn't connected yet (i.e. its 'sock' is None).'''
+        conn.connect()
+        return conn
+
+    def preconnect(self, scheme, host, port, count = 1):
+        '''Gets connections ready ahead of time, if that means anything for the transport; returns how many were opened.'''
+        return 0
+
+    def stats(self):
+        return {}
+
+    def close(self):
+        pass
+
+
+class WSGIResponse:
+    """A response from a WSGI app, working like an httplib.HTTPResponse."""
+
+    def __init__(self, status, headers, body):
+        (code, self.reason) = (status.split(' ', 1) + [''])[0:2]
+        self.status = int(code)
+        self.version = 11
+        self.will_close = False
+        self.msg = httplib.HTTPMessage(StringIO(''.join(['%s: %s\r\n' % header for header in headers]) + '\r\n'))
+        self.length = len(body)
+        self._body = StringIO(body)
+
+    def getheader(self, name, default = None):
+        return self.msg.getheader(name, default)
+
+    def getheaders(self):
+        return self.msg.items()
+
+    def read(self, amt = None):
+        if amt is None:
+            return self._body.read()
+        return self._body.read(amt)
+
+    def close(self):
+        pass
+
+
+class WSGIConnection:
+    """Runs requests through a WSGI app, in this thread, rather than sending them anywhere."""
+
+    def __init__(self, app, scheme, host, port, environ = None):
+        self.app = app
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.environ = environ or {}
+        # there's never a socket; see _await_continue() and hedge.Racer.cancel()
+        self.sock = None
+        self._method = None
+
+    def connect(self):
+        pass
+
+    def close(self):
+        pass
+
+    def putrequest(self, method, url, skip_host = 0, skip_accept_encoding = 0):
+        self._method = method
+        self._url = url
+        self._headers = {}
+        self._body = []
+
+    def putheader(self, header, *values):
+        self._headers[header.lower()] = ', '.join([str(value) for value in values])
+
+    def endheaders(self, message_body = None):
+        if message_body is not None:
+            self._body.append(message_body)
+
+    def send(self, data):
+        self._body.append(data)
+
+    def getresponse(self):
+        if self._method is None:
+            raise httplib.ResponseNotReady()
+        body = ''.join(self._body)
+        headers = self._headers
+        if headers.pop('transfer-encoding', '').lower() == 'chunked':
+            body = _dechunk(body)
+        headers.pop('content-length', None)
+        (path, query) = (self._url.split('?', 1) + [''])[0:2]
+        environ = {
+            'REQUEST_METHOD': self._method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': urllib.unquote(path),
+            'QUERY_STRING': query,
+            'CONTENT_TYPE': headers.pop('content-type', ''),
+            'CONTENT_LENGTH': str(len(body)),
+            'SERVER_NAME': self.host,
+            'SERVER_PORT': str(self.port),
+            'SERVER_PROTOCOL': 'HTTP/1.1',
+            'REMOTE_ADDR': '127.0.0.1',
+            'HTTP_HOST': '%s:%s' % (self.host, self.port),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': self.scheme,
+            'wsgi.input': StringIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False
+        }
+        for (name, value) in headers.iteritems():
+            environ['HTTP_' + name.upper().replace('-', '_')] = value
+        environ.update(self.environ)
+        self._method = None
+        started = {}
+        output = []
+
+        def start_response(status, response_headers, exc_info = None):
+            if exc_info is not None:
+                try:
+                    # too late to change the status once the body has begun
+                    if started.get('sent'):
+                        raise exc_info[0], exc_info[1], exc_info[2]
+                finally:
+                    exc_info = None
+            started['status'] = status
+            started['headers'] = response_headers
+            return output.append
+
+        result = self.app(environ, start_response)
+        try:
+            for chunk in result:
+                if chunk:
+                    started['sent'] = True
+                    output.append(chunk)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        if not 'status' in started:
+            raise Exception('WSGI app returned without calling start_response().')
+        return WSGIResponse(started['status'], started['headers'], ''.join(output))
+
+
+def _dechunk(data):
+    body = []
+    pos = 0
+    while True:
+        end = data.index('\r\n', pos)
+        size = int(data[pos:end].split(';', 1)[0], 16)
+        if not size:
+            return ''.join(body)
+        body.append(data[end + 2:end + 2 + size])
+        pos = end + 2 + size + 2
+
+
+class WSGITransport(Transport):
+    """Sends requests straight to a WSGI app in this process, with no sockets at all.
+
+    Good for integration tests, for benchmarking the client without the
+    network, and for embedding a service in a batch job. 'environ' adds
+    to (or overrides) what each request's WSGI environ would have. The app
+    runs in the calling thread, so exceptions it raises reach the caller
+    as they are."""
+
+    name = 'wsgi'
+
+    def __init__(self, app, environ = None):
+        self.app = app
+        self.environ = environ
+        self._lock = threading.Lock()
+        self._stats = {'requests': 0}
+
+    def get(self, scheme, host, port):
+        self._lock.acquire()
+        try:
+            self._stats['requests'] += 1
+        finally:
+            self._lock.release()
+        return WSGIConnection(self.app, scheme, host, port, self.environ)
+
+    def stats(self):
+        self._lock.acquire()
+        try:
+            return dict(self._stats)
+        finally:
+            self._lock.release()
@@ -31,12 +31,13 @@ def pyv(version):
 		i += 1
 	return True
 
+_slashes = re.compile(r'/+')
+
 def pretty_path(path, absolute = False):
     path = path.rstrip('/')
     if absolute:
         path = '/' + path
-    regex = re.compile(r'/+')
-    path = regex.sub('/', path)
+    path = _slashes.sub('/', path)
     return path
 
 def is_number(s):
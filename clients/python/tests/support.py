@@ -0,0 +1,274 @@
+#!/usr/bin/python -tt
+
+# omega - python client
+# https://github.com/jfillmore/Omega-API-Engine
+#
+# Copyright 2011, Jonathon Fillmore
+# Licensed under the MIT license. See LICENSE file.
+# http://www.opensource.org/licenses/mit-license.php
+
+
+"""What the tests share: a scriptable stand-in for an Omega service, clients wired to it and a real HTTP server for it."""
+
+import cgi
+import sys
+import json
+import time
+import socket
+import urlparse
+import threading
+import unittest
+import BaseHTTPServer
+import SocketServer
+from cStringIO import StringIO
+
+from omega import compression
+from omega.client import OmegaClient
+from omega.cookies import CookieJar
+from omega.transport import WSGITransport
+
+
+def reply(data = None, status = '200 OK', headers = (), result = True, reason = None):
+    '''Returns a handler's answer: an Omega envelope around 'data', sent with the status and any extra headers.'''
+    envelope = {'result': result}
+    if data is not None:
+        envelope['data'] = data
+    if reason is not None:
+        envelope['reason'] = reason
+    return (status, [('Content-Type', 'application/json')] + list(headers), json.dumps(envelope))
+
+
+def failure(reason, status = '200 OK', headers = ()):
+    '''Returns a handler's answer for an API that failed.'''
+    return reply(None, status, headers, False, reason)
+
+
+def echo(request):
+    '''The default handler: answers with what was asked for.'''
+    return reply({
+        'method': request.method,
+        'path': request.path,
+        'params': request.params,
+        'cookie': request.headers.get('cookie')
+    })
+
+
+class Request:
+    """A request as the service saw it; bodies are decompressed and params decoded, whether form, JSON or query string."""
+
+    def __init__(self, environ):
+        self.method = environ['REQUEST_METHOD']
+        self.path = environ['PATH_INFO']
+        self.query = environ.get('QUERY_STRING', '')
+        self.headers = {}
+        for (name, value) in environ.iteritems():
+            if name.startswith('HTTP_'):
+                self.headers[name[5:].replace('_', '-').lower()] = value
+        self.content_type = environ.get('CONTENT_TYPE', '')
+        self.wire_body = environ['wsgi.input'].read()
+        self.body = compression.inflate(self.headers.get('content-encoding'), self.wire_body)
+        self.params = {}
+        if self.content_type.startswith('multipart/form-data'):
+            form = cgi.FieldStorage(StringIO(self.body), environ = {
+                'REQUEST_METHOD': 'POST',
+                'CONTENT_TYPE': self.content_type,
+                'CONTENT_LENGTH': str(len(self.body))
+            })
+            self.params = dict([(name, form.getfirst(name)) for name in form.keys()])
+            if 'OMEGA_API_PARAMS' in self.params:
+                self.params = json.loads(self.params['OMEGA_API_PARAMS'])
+        elif self.body:
+            self.params = json.loads(self.body)
+        elif self.query:
+            self.params = dict(urlparse.parse_qsl(self.query))
+
+
+class App:
+    """A WSGI app standing in for an Omega service.
+
+    Requests go to the handler added for their path with route() (echo()
+    otherwise), which returns the (status, headers, body) to answer with,
+    e.g. from reply(). Every request is kept in 'requests', and the most
+    handled at once in 'max_active'."""
+
+    def __init__(self):
+        self.routes = {}
+        self.requests = []
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+
+    def route(self, path, handler):
+        self.routes[path] = handler
+
+    def count(self, path = None):
+        '''Returns how many requests (for the path, if given) have come in.'''
+        return len([request for request in self.requests if path is None or request.path == path])
+
+    def __call__(self, environ, start_response):
+        request = Request(environ)
+        self._lock.acquire()
+        try:
+            self.requests.append(request)
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        finally:
+            self._lock.release()
+        try:
+            (status, headers, body) = self.routes.get(request.path, echo)(request)
+        finally:
+            self._lock.acquire()
+            try:
+                self.active -= 1
+            finally:
+                self._lock.release()
+        start_response(status, headers + [('Content-Length', str(len(body)))])
+        return [body]
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.count_connection()
+
+    def _read_body(self):
+        if self.headers.getheader('transfer-encoding', '').lower() != 'chunked':
+            return self.rfile.read(int(self.headers.getheader('content-length') or 0))
+        body = []
+        while True:
+            size = int(self.rfile.readline().split(';', 1)[0], 16)
+            if not size:
+                self.rfile.readline()
+                return ''.join(body)
+            body.append(self.rfile.read(size))
+            self.rfile.readline()
+
+    def _serve(self):
+        body = self._read_body()
+        (path, query) = (self.path.split('?', 1) + [''])[0:2]
+        environ = {
+            'REQUEST_METHOD': self.command,
+            'PATH_INFO': path,
+            'QUERY_STRING': query,
+            'CONTENT_TYPE': self.headers.getheader('content-type', ''),
+            'wsgi.input': StringIO(body)
+        }
+        for (name, value) in self.headers.items():
+            environ['HTTP_' + name.upper().replace('-', '_')] = value
+        answer = {}
+
+        def start_response(status, headers, exc_info = None):
+            answer['status'] = status
+            answer['headers'] = headers
+
+        body = ''.join(self.server.app(environ, start_response))
+        (code, message) = answer['status'].split(' ', 1)
+        self.send_response(int(code), message)
+        for (name, value) in answer['headers']:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        if self.server.hang_up:
+            # without saying so, as servers timing out idle connections do
+            self.close_connection = 1
+
+    do_GET = do_POST = do_PUT = do_DELETE = _serve
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Serves an App over HTTP/1.1 with keep-alive on 127.0.0.1, counting the connections made to it.
+
+    While 'hang_up' is set, connections are closed after each response."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, app):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), _Handler)
+        self.app = app
+        self.port = self.server_address[1]
+        self.connections = 0
+        self.hang_up = False
+        self._lock = threading.Lock()
+        thread = threading.Thread(target = self.serve_forever, kwargs = {'poll_interval': 0.05})
+        thread.daemon = True
+        thread.start()
+
+    def count_connection(self):
+        self._lock.acquire()
+        try:
+            self.connections += 1
+        finally:
+            self._lock.release()
+
+    def handle_error(self, request, client_address):
+        # clients hanging up mid-response (e.g. a cancelled hedge) are part of the tests
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
+def make_client(url = 'localhost/api', **opts):
+    '''Returns a client with its own in-memory cookie jar, so tests never touch ~/.omega_cookie.'''
+    opts.setdefault('cookie_jar', CookieJar(None))
+    return OmegaClient(url, use_https = False, **opts)
+
+
+class ClientTestCase(unittest.TestCase):
+    """Gives each test an App, as 'app', and a client sending requests straight to it, as 'client'."""
+
+    def setUp(self):
+        self.app = App()
+        self.client = make_client()
+        self.client.set_transport(WSGITransport(self.app))
+
+    def serve(self, **opts):
+        '''Serves the app over HTTP for the rest of the test; returns the server and a client for it.'''
+        server = Server(self.app)
+        self.addCleanup(server.close)
+        client = make_client('127.0.0.1/api', port = server.port, **opts)
+        self.addCleanup(client.get_transport().close)
+        return (server, client)
+
+    def slow(self, delay, data = None):
+        '''Returns a handler that takes 'delay' seconds to answer.'''
+        def handler(request):
+            time.sleep(delay)
+            return reply(data)
+        return handler
+
+    def concurrently(self, func, count):
+        '''Calls 'func' from 'count' threads at once, returning what each call returned (or raised).'''
+        results = [None] * count
+        start = threading.Event()
+
+        def run(index):
+            start.wait()
+            try:
+                results[index] = func()
+            except Exception, e:
+                results[index] = e
+
+        threads = [threading.Thread(target = run, args = (i,)) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def wait_for(self, check, timeout = 5):
+        '''Waits for 'check()' to come true, returning whether it did.'''
+        deadline = time.time() + timeout
+        while not check() and time.time() < deadline:
+            time.sleep(0.01)
+        return check()
@@ -0,0 +1,111 @@
+#!/usr/bin/python -tt
+
+# omega - python client
+# https://github.com/jfillmore/Omega-API-Engine
+#
+# Copyright 2011, Jonathon Fillmore
+# Licensed under the MIT license. See LICENSE file.
+# http://www.opensource.org/licenses/mit-license.php
+
+
+"""Tests for async_client.AsyncOmegaClient, against a local HTTP server."""
+
+import unittest
+
+from omega.async_client import AsyncOmegaClient
+from omega.cookies import CookieJar
+from omega.error import Exception
+from omega.retry import RetryPolicy
+
+from support import ClientTestCase, reply, failure
+
+
+class AsyncClientTest(ClientTestCase):
+
+    def setUp(self):
+        ClientTestCase.setUp(self)
+        (self.server, client) = self.serve()
+        self.async_client = AsyncOmegaClient('127.0.0.1/api', port = self.server.port, use_https = False, max_connections = 2)
+        self.async_client.set_cookie_jar(CookieJar(None))
+        self.addCleanup(self.async_client.close)
+        self.tries = []
+        finish = self.async_client._finish
+
+        def counting_finish(request, response):
+            self.tries.append(request.attempt.tries)
+            finish(request, response)
+
+        self.async_client._finish = counting_finish
+
+    def test_requests(self):
+        self.app.route('/api/fail', lambda request: failure('nope'))
+        futures = [self.async_client.get('thing', {'i': i}) for i in range(10)]
+        self.assertEqual([r['params'] for r in self.async_client.wait(futures)], [{'i': str(i)} for i in range(10)])
+        self.assertEqual(self.async_client.wait(self.async_client.post('thing', {'x': 1}))['params'], {'x': 1})
+        failed = self.async_client.get('fail')
+        self.async_client.loop.run_until_complete([failed])
+        self.assertTrue('nope' in str(failed.exception()))
+
+    def test_request_many(self):
+        self.app.route('/api/fail', lambda request: failure('nope'))
+        self.app.route('/api/slow', self.slow(0.01, 'slow'))
+        calls = [('GET', i == 3 and 'fail' or 'slow', {}) for i in range(10)]
+        results = list(self.async_client.request_many(calls, concurrency = 4))
+        self.assertEqual([r['index'] for r in results], range(10))
+        self.assertEqual([r['result'] for r in results], [i != 3 for i in range(10)])
+        self.assertEqual(results[0]['data'], 'slow')
+        self.assertTrue('nope' in str(results[3]['error']))
+        self.assertEqual(self.app.max_active, 2)
+        unordered = list(self.async_client.request_many(calls, ordered = False))
+        self.assertEqual(sorted([r['index'] for r in unordered]), range(10))
+
+    def test_prepare(self):
+        prepared = self.async_client.prepare('GET', 'thing')
+        self.assertEqual([r['params'] for r in self.async_client.wait([prepared({'i': 1}), prepared({'i': 2})])],
+            [{'i': '1'}, {'i': '2'}])
+
+    def test_blocking_calls_refuse(self):
+        for name in ('run', 'run_many', 'stream', 'iter_data', 'preconnect'):
+            self.assertRaisesRegexp(Exception, 'blocks', getattr(self.async_client, name), 'thing')
+
+    def test_queued_requests_count_one_try(self):
+        self.async_client.wait([self.async_client.get('thing') for i in range(10)])
+        self.assertEqual(self.server.connections, 2)
+        self.assertEqual(self.tries, [1] * 10)
+
+    def test_retries_follow_the_policy(self):
+        self.async_client.set_retry_policy(RetryPolicy(backoff = 0.01))
+
+        def flaky(request):
+            if self.app.count(request.path) < 3:
+                return failure('busy', '503 Busy')
+            return reply('ok')
+        self.app.route('/api/flaky', flaky)
+        self.assertEqual(self.async_client.wait(self.async_client.get('flaky')), 'ok')
+        self.assertEqual(self.tries, [1, 2, 3])
+        # a POST may have done something already, so isn't sent again
+        self.app.route('/api/busy', lambda request: failure('busy', '503 Busy'))
+        self.assertRaisesRegexp(Exception, '503', self.async_client.wait, self.async_client.post('busy'))
+        self.assertEqual(self.app.count('/api/busy'), 1)
+
+    def test_unsent_requests_are_retried(self):
+        policy = RetryPolicy(backoff = 0.01, breaker_threshold = 3)
+        self.async_client.set_retry_policy(policy)
+        self.server.close()
+        failed = self.async_client.post('thing')
+        self.async_client.loop.run_until_complete([failed])
+        self.assertTrue('failed after 3 tries' in str(failed.exception()))
+        # which opened the circuit
+        failed = self.async_client.get('thing')
+        self.assertTrue('Circuit open' in str(failed.exception()))
+        self.assertEqual(policy.stats()['retries'], 2)
+
+    def test_lookups_are_cached(self):
+        self.async_client.wait([self.async_client.get('thing') for i in range(10)])
+        stats = self.async_client.resolver.stats()
+        # one per connection, only the first of which asked the system
+        self.assertEqual((stats['lookups'], stats['cache_hits']), (2, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
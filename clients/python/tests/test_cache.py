@@ -0,0 +1,182 @@
+#!/usr/bin/python -tt
+
+# omega - python client
+# https://github.com/jfillmore/Omega-API-Engine
+#
+# Copyright 2011, Jonathon Fillmore
+# Licensed under the MIT license. See LICENSE file.
+# http://www.opensource.org/licenses/mit-license.php
+
+
+"""Tests for cache.ResponseCache and cache.PersistentCache."""
+
+import os
+import time
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from omega.cache import CacheEntry, ResponseCache, PersistentCache
+
+from support import ClientTestCase, reply
+
+
+class ResponseCacheTest(ClientTestCase):
+
+    def setUp(self):
+        ClientTestCase.setUp(self)
+        self.cache = self.make_cache()
+        self.client.set_cache(self.cache)
+
+    def make_cache(self):
+        return ResponseCache()
+
+    def versioned(self, cache_control, etag = None):
+        '''Returns a handler answering with how many requests it's had, honouring If-None-Match.'''
+        def handler(request):
+            if etag is not None and request.headers.get('if-none-match') == etag:
+                return ('304 Not Modified', [('Cache-Control', cache_control)], '')
+            headers = [('Cache-Control', cache_control)]
+            if etag is not None:
+                headers.append(('ETag', etag))
+            return reply({'version': self.app.count(request.path)}, headers = headers)
+        return handler
+
+    def test_fresh_hits(self):
+        self.app.route('/api/data', self.versioned('max-age=60'))
+        self.assertEqual(self.client.request('GET', 'data'), {'version': 1})
+        result = self.client.request('GET', 'data')
+        self.assertEqual(result, {'version': 1})
+        self.assertEqual(self.app.count(), 1)
+        # callers get their own copy
+        result['version'] = 5
+        self.assertEqual(self.client.request('GET', 'data'), {'version': 1})
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['stores']), (2, 1, 1))
+
+    def test_revalidation(self):
+        self.app.route('/api/data', self.versioned('no-cache', '"v1"'))
+        self.client.request('GET', 'data')
+        self.assertEqual(self.client.request('GET', 'data'), {'version': 1})
+        self.assertEqual(self.app.count(), 2)
+        self.assertEqual(self.app.requests[1].headers['if-none-match'], '"v1"')
+        self.assertEqual(self.cache.stats()['revalidations'], 1)
+
+    def test_no_store(self):
+        self.app.route('/api/data', self.versioned('no-store'))
+        self.client.request('GET', 'data')
+        self.assertEqual(self.client.request('GET', 'data'), {'version': 2})
+
+    def test_ttls(self):
+        self.cache.ttls = {'data': 60}
+        self.app.route('/api/data', self.versioned('no-cache'))
+        self.client.request('GET', 'data')
+        self.assertEqual(self.client.request('GET', 'data'), {'version': 1})
+        self.assertEqual(self.cache.policy('/data/x'), (60, 0))
+        self.assertEqual(self.cache.policy('other'), (None, 0))
+
+    def test_stale_while_revalidate(self):
+        self.cache.ttls = {'data': (0, 60)}
+        self.app.route('/api/data', self.versioned('no-cache'))
+        self.client.request('GET', 'data')
+        # served stale straight away, while it's refreshed in the background
+        self.assertEqual(self.client.request('GET', 'data'), {'version': 1})
+        self.assertTrue(self.wait_for(lambda: self.cache.stats()['stores'] == 2))
+        self.assertEqual(self.client.request('GET', 'data'), {'version': 2})
+        self.assertEqual(self.cache.stats()['stale_hits'], 2)
+
+    def test_headers_are_part_of_the_key(self):
+        self.app.route('/api/data', self.versioned('max-age=60'))
+        self.client.request('GET', 'data', headers = {'X-User': 'a'})
+        self.assertEqual(self.client.request('GET', 'data', headers = {'X-User': 'b'}), {'version': 2})
+
+    def test_posts_are_not_cached(self):
+        self.app.route('/api/data', self.versioned('max-age=60'))
+        self.client.request('POST', 'data')
+        self.assertEqual(self.client.request('POST', 'data'), {'version': 2})
+
+    def test_cookies_are_part_of_the_key(self):
+        self.app.route('/api/data', self.versioned('max-age=60'))
+        self.app.route('/api/login', lambda request: reply('hi', headers = [('Set-Cookie', 'sid=abc; Path=/')]))
+        self.client.request('GET', 'data')
+        self.client.request('POST', 'login')
+        self.assertEqual(self.client.request('GET', 'data'), {'version': 2})
+        self.assertEqual(self.client.request('GET', 'data'), {'version': 2})
+
+    def test_oversized_entries_drop_the_old_one(self):
+        key = self.cache.key('http', 'localhost', 5800, '/api/data', {})
+        self.cache.put(key, CacheEntry(200, 'OK', 'application/json', '{}', {}))
+        self.assertTrue(self.cache.get(key) is not None)
+        self.cache.max_bytes = 500
+        self.cache.put(key, CacheEntry(200, 'OK', 'application/json', '"%s"' % ('x' * 1000), 'x' * 1000))
+        self.assertEqual(self.cache.get(key), None)
+
+
+class PersistentCacheTest(ResponseCacheTest):
+
+    def make_cache(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        return PersistentCache(os.path.join(self.dir, 'cache'))
+
+    def test_shared_between_caches(self):
+        self.app.route('/api/data', self.versioned('max-age=60'))
+        self.client.request('GET', 'data')
+        self.client.set_cache(PersistentCache(self.cache.path))
+        self.assertEqual(self.client.request('GET', 'data'), {'version': 1})
+        self.assertEqual(self.client.get_cache_stats()['entries'], 1)
+        self.assertEqual(os.stat(self.cache.path).st_mode & 0777, 0600)
+
+    def test_eviction(self):
+        self.cache.max_bytes = 300
+        self.app.route('/api/data', lambda request: reply('x' * 100, headers = [('Cache-Control', 'max-age=60')]))
+        for i in range(5):
+            self.client.request('GET', 'data', {'i': i})
+        stats = self.cache.stats()
+        self.assertTrue(stats['bytes'] <= 300)
+        self.assertEqual(stats['evictions'], 5 - stats['entries'])
+
+    def test_unusable_database(self):
+        cache = PersistentCache(os.path.join(self.dir, 'missing', 'cache'))
+        entry = CacheEntry(200, 'OK', 'application/json', '{}', {})
+        entry.expires = time.time() + 60
+        self.assertEqual(cache.get('key'), None)
+        cache.put('key', entry)
+        cache.remove('key')
+        cache.clear()
+        stats = cache.stats()
+        self.assertEqual((stats['errors'], stats['entries'], stats['stores']), (5, None, 0))
+        # requests just go uncached
+        self.client.set_cache(cache)
+        self.app.route('/api/data', self.versioned('max-age=60'))
+        self.client.request('GET', 'data')
+        self.assertEqual(self.client.request('GET', 'data'), {'version': 2})
+
+    def test_undecodable_entries(self):
+        self.app.route('/api/data', self.versioned('max-age=60'))
+        self.client.request('GET', 'data')
+        self.cache._db().execute('UPDATE responses SET decoded = ?', (sqlite3.Binary('\xff'),))
+        self.assertEqual(self.client.request('GET', 'data'), {'version': 2})
+        stats = self.cache.stats()
+        self.assertEqual(stats['errors'], 1)
+        # the bad row was dropped, and replaced
+        self.assertEqual(self.client.request('GET', 'data'), {'version': 2})
+
+
+class CacheEntryTest(unittest.TestCase):
+
+    def test_update(self):
+        headers = {'Cache-Control': 'max-age=10', 'ETag': '"a"'}
+        entry = CacheEntry(200, 'OK', 'application/json', '{}', {})
+        self.assertTrue(entry.update(headers.get, 1000))
+        self.assertEqual((entry.expires, entry.etag), (1010, '"a"'))
+        self.assertTrue(entry.is_fresh(1005))
+        self.assertFalse(entry.is_fresh(1010))
+        self.assertEqual(entry.validators(), {'If-None-Match': '"a"'})
+        # nothing to go on: not worth keeping
+        self.assertFalse(CacheEntry(200, 'OK', '', '', '').update({}.get, 1000))
+
+
+if __name__ == '__main__':
+    unittest.main()
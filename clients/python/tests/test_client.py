@@ -0,0 +1,207 @@
+#!/usr/bin/python -tt
+
+# omega - python client
+# https://github.com/jfillmore/Omega-API-Engine
+#
+# Copyright 2011, Jonathon Fillmore
+# Licensed under the MIT license. See LICENSE file.
+# http://www.opensource.org/licenses/mit-license.php
+
+
+"""Tests for OmegaClient's ways of calling APIs."""
+
+import json
+import unittest
+from cStringIO import StringIO
+
+from omega import compression
+from omega.cache import ResponseCache
+from omega.error import Exception
+
+from support import ClientTestCase, reply, failure
+
+
+class RequestTest(ClientTestCase):
+
+    def test_get(self):
+        result = self.client.request('GET', 'thing', {'x': 1})
+        self.assertEqual(result['method'], 'GET')
+        self.assertEqual(result['path'], '/api/thing')
+        self.assertEqual(result['params'], {'x': '1'})
+
+    def test_post(self):
+        result = self.client.request('POST', 'thing', {'x': [1, 2]})
+        self.assertEqual((result['method'], result['params']), ('POST', {'x': [1, 2]}))
+        self.assertEqual(self.app.requests[0].content_type, 'application/json')
+
+    def test_failed_api(self):
+        self.app.route('/api/fail', lambda request: failure('nope'))
+        self.assertRaisesRegexp(Exception, 'nope', self.client.request, 'GET', 'fail')
+
+    def test_http_error(self):
+        self.app.route('/api/error', lambda request: failure('boom', '500 Oops'))
+        self.assertRaisesRegexp(Exception, r'500 Oops\)\nboom', self.client.request, 'POST', 'error')
+
+    def test_full_and_raw_responses(self):
+        self.app.route('/api/data', lambda request: reply([1, 2]))
+        self.assertEqual(self.client.request('GET', 'data', full_response = True), {'result': True, 'data': [1, 2]})
+        self.assertEqual(json.loads(self.client.request('GET', 'data', raw_response = True)), [1, 2])
+
+    def test_prepare(self):
+        prepared = self.client.prepare('GET', 'thing')
+        self.assertEqual(prepared({'y': 2})['params'], {'y': '2'})
+        self.assertEqual(prepared({'y': 3})['params'], {'y': '3'})
+
+    def test_timing(self):
+        self.client.request('GET', 'thing')
+        timing = self.client.last_timing()
+        self.assertEqual((timing.transport, timing.method, timing.tries), ('wsgi', 'GET', 1))
+
+
+class RunTest(ClientTestCase):
+
+    def test_run(self):
+        self.assertEqual(self.client.run('thing', {'a': 1})['params'], {'a': 1})
+        self.assertEqual(self.app.requests[0].method, 'POST')
+
+    def test_run_output(self):
+        self.app.route('/api/data', lambda request: reply([1, 2]))
+        output = StringIO()
+        size = self.client.run('data', output = output)
+        self.assertEqual(size, len(output.getvalue()))
+        self.assertEqual(json.loads(output.getvalue()), {'result': True, 'data': [1, 2]})
+        self.assertEqual(self.client.last_timing().transport, 'wsgi')
+
+    def test_run_output_over_curl(self):
+        self.app.route('/api/list', lambda request: reply(range(1000)))
+        (server, client) = self.serve()
+        client.set_spool_size(100)
+        output = StringIO()
+        self.assertEqual(client.run('list', output = output), len(output.getvalue()))
+        self.assertEqual(json.loads(output.getvalue())['data'], range(1000))
+
+    def test_run_output_error(self):
+        self.app.route('/api/error', lambda request: failure('boom', '500 Oops'))
+        output = StringIO()
+        self.assertRaisesRegexp(Exception, 'boom', self.client.run, 'error', output = output)
+        self.assertEqual(output.getvalue(), '')
+
+    def test_run_many(self):
+        self.app.route('/api/fail', lambda request: failure('nope'))
+        calls = [('thing', {'i': 0}), ('fail', {}), ('thing', {'i': 2})]
+        results = list(self.client.run_many(calls))
+        self.assertEqual([r['index'] for r in results], [0, 1, 2])
+        self.assertEqual(results[0]['data']['params'], {'i': 0})
+        self.assertEqual(results[1]['result'], False)
+        self.assertTrue('nope' in str(results[1]['error']))
+        self.assertEqual(results[2]['data']['params'], {'i': 2})
+
+    def test_run_many_over_curl(self):
+        (server, client) = self.serve()
+        calls = [('thing', {'i': i}) for i in range(20)]
+        results = list(client.run_many(calls, concurrency = 4))
+        self.assertEqual([r['data']['params'] for r in results], [{'i': i} for i in range(20)])
+        # curl keeps its connections alive too
+        self.assertTrue(server.connections <= 4)
+
+
+class RequestManyTest(ClientTestCase):
+
+    def test_ordered(self):
+        self.app.route('/api/fail', lambda request: failure('nope'))
+        calls = [('GET', 'fail' if i == 3 else 'thing', {'i': i}) for i in range(10)]
+        results = list(self.client.request_many(calls, concurrency = 4))
+        self.assertEqual([r['index'] for r in results], range(10))
+        self.assertEqual([r['result'] for r in results], [i != 3 for i in range(10)])
+        self.assertEqual(results[5]['data']['params'], {'i': '5'})
+
+    def test_concurrent(self):
+        self.app.route('/api/slow', self.slow(0.05))
+        results = list(self.client.request_many([('GET', 'slow', {})] * 8, concurrency = 4, ordered = False))
+        self.assertEqual(len(results), 8)
+        self.assertEqual(self.app.max_active, 4)
+
+
+class StreamTest(ClientTestCase):
+
+    def setUp(self):
+        ClientTestCase.setUp(self)
+        self.app.route('/api/list', lambda request: reply(range(1000)))
+
+    def test_stream(self):
+        body = ''.join(self.client.stream('GET', 'list', chunk_size = 100))
+        self.assertEqual(json.loads(body)['data'], range(1000))
+
+    def test_stream_to_output(self):
+        output = StringIO()
+        size = self.client.stream('GET', 'list', output = output)
+        self.assertEqual(size, len(output.getvalue()))
+        self.assertEqual(json.loads(output.getvalue())['data'], range(1000))
+
+    def test_stream_upload(self):
+        result = self.client.request('PUT', 'thing', body = iter(['{"a"', ': 1}']))
+        self.assertEqual(result['params'], {'a': 1})
+
+    def test_stream_error(self):
+        self.app.route('/api/error', lambda request: failure('boom', '503 Busy'))
+        self.assertRaisesRegexp(Exception, 'boom', self.client.stream, 'POST', 'error')
+
+    def test_iter_data(self):
+        self.assertEqual(list(self.client.iter_data('GET', 'list', chunk_size = 7)), range(1000))
+
+    def test_iter_data_failure(self):
+        self.app.route('/api/fail', lambda request: failure('nope'))
+        self.assertRaisesRegexp(Exception, 'nope', list, self.client.iter_data('GET', 'fail'))
+
+
+class CompressionTest(ClientTestCase):
+
+    def test_request_bodies(self):
+        self.client.set_compression(threshold = 100)
+        self.client.request('POST', 'thing', {'small': 1})
+        self.client.request('POST', 'thing', {'big': 'x' * 1000})
+        (small, big) = self.app.requests
+        self.assertFalse('content-encoding' in small.headers)
+        self.assertEqual(big.headers['content-encoding'], 'gzip')
+        self.assertEqual(big.params, {'big': 'x' * 1000})
+        self.assertTrue(len(big.wire_body) < 100)
+        transfer = self.client.last_transfer()
+        self.assertTrue(transfer['request_wire_bytes'] < transfer['request_bytes'])
+
+    def test_responses(self):
+        def handler(request):
+            (status, headers, body) = reply(range(1000))
+            self.assertTrue('gzip' in request.headers['accept-encoding'])
+            return (status, headers + [('Content-Encoding', 'gzip')], compression.gzip(body))
+        self.app.route('/api/list', handler)
+        self.assertEqual(self.client.request('GET', 'list'), range(1000))
+        self.assertEqual(list(self.client.iter_data('GET', 'list')), range(1000))
+        transfer = self.client.last_transfer()
+        self.assertTrue(transfer['response_wire_bytes'] < transfer['response_bytes'])
+
+
+class UnixSocketTest(ClientTestCase):
+
+    def test_keys(self):
+        self.client.set_url('unix:///tmp/omega.sock:/api')
+        self.assertEqual(self.client._get_pool_key(), ('unix', '/tmp/omega.sock', 0))
+        self.assertEqual(self.client.request('GET', 'thing')['path'], '/api/thing')
+
+    def test_sockets_keep_their_own_cache_and_cookies(self):
+        self.app.route('/api/data', lambda request: reply(self.app.count('/api/data'), headers = [('Cache-Control', 'max-age=60')]))
+        self.app.route('/api/login', lambda request: reply('hi', headers = [('Set-Cookie', 'sid=abc; Path=/')]))
+        self.client.set_cache(ResponseCache())
+        results = []
+        for url in ('unix:///tmp/a.sock:/api', 'unix:///tmp/b.sock:/api', 'localhost/api'):
+            self.client.set_url(url)
+            cookie = self.client.request('GET', 'thing')['cookie']
+            self.client.request('POST', 'login')
+            results.append((self.client.request('GET', 'data'), cookie))
+        # nothing from one socket was served to (or sent to) another, or to localhost
+        self.assertEqual(results, [(1, None), (2, None), (3, None)])
+        self.client.set_url('unix:///tmp/a.sock:/api')
+        self.assertEqual((self.client.request('GET', 'data'), self.client.request('GET', 'thing')['cookie']), (1, 'sid=abc'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+#!/usr/bin/python -tt
+
+# omega - python client
+# https://github.com/jfillmore/Omega-API-Engine
+#
+# Copyright 2011, Jonathon Fillmore
+# Licensed under the MIT license. See LICENSE file.
+# http://www.opensource.org/licenses/mit-license.php
+
+
+"""Tests for coalesce.Coalescer."""
+
+import time
+import unittest
+
+from omega.error import Exception
+from omega.coalesce import Coalescer
+
+from support import ClientTestCase, failure
+
+
+class CoalesceTest(ClientTestCase):
+
+    def setUp(self):
+        ClientTestCase.setUp(self)
+        self.coalescer = Coalescer()
+        self.client.set_coalescing(self.coalescer)
+        self.app.route('/api/slow', self.slow(0.2, {'items': [1, 2]}))
+
+    def test_identical_gets_share_a_request(self):
+        results = self.concurrently(lambda: self.client.request('GET', 'slow'), 5)
+        self.assertEqual(results, [{'items': [1, 2]}] * 5)
+        self.assertEqual(self.app.count(), 1)
+        self.assertEqual(self.coalescer.stats(), {'requests': 5, 'sent': 1, 'coalesced': 4})
+        # everyone got their own copy
+        results[0]['items'].append(3)
+        self.assertEqual(results[1]['items'], [1, 2])
+
+    def test_different_requests_are_not_shared(self):
+        self.concurrently(lambda: self.client.request('GET', 'slow', {'x': 1}), 2)
+        self.concurrently(lambda: self.client.request('GET', 'slow', headers = {'X-Token': 'a'}), 2)
+        self.concurrently(lambda: self.client.request('POST', 'slow'), 2)
+        self.assertEqual(self.app.count(), 4)
+
+    def test_errors_are_shared(self):
+        def handler(request):
+            time.sleep(0.2)
+            return failure('nope', '500 Oops')
+        self.app.route('/api/fail', handler)
+        results = self.concurrently(lambda: self.client.request('GET', 'fail'), 3)
+        self.assertEqual(self.app.count(), 1)
+        for result in results:
+            self.assertTrue(isinstance(result, Exception))
+            self.assertTrue('nope' in str(result))
+
+
+if __name__ == '__main__':
+    unittest.main()
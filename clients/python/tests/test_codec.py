@@ -0,0 +1,47 @@
+#!/usr/bin/python -tt
+
+# omega - python client
+# https://github.com/jfillmore/Omega-API-Engine
+#
+# Copyright 2011, Jonathon Fillmore
+# Licensed under the MIT license. See LICENSE file.
+# http://www.opensource.org/licenses/mit-license.php
+
+
+"""Tests for codec, the JSON backends."""
+
+import unittest
+
+from omega import codec
+from omega.error import Exception
+
+from support import ClientTestCase, reply
+
+FLOATS = [0.1 + 0.2, 1e-300, 123456789.12345678, -2.5e17]
+
+
+class CodecTest(ClientTestCase):
+
+    def test_default_is_exact(self):
+        self.assertFalse(codec.get_default_backend() in codec._lossy)
+        default = codec.get_codec()
+        self.assertEqual(default.name, codec.get_default_backend())
+        self.assertEqual(default.decode(default.encode(FLOATS)), FLOATS)
+
+    def test_backends(self):
+        for backend in codec.get_backends():
+            json = codec.Codec(backend)
+            self.assertEqual(json.decode(json.encode({'a': [1, 'b', None, True]})), {'a': [1, 'b', None, True]})
+            self.assertEqual(json.decode(repr(FLOATS)), FLOATS)
+            self.assertTrue(json.format({'b': 1, 'a': 2}, False).startswith('{"a"'))
+            self.assertEqual(json.raw_decode('[1] x'), ([1], 3))
+        self.assertRaisesRegexp(Exception, 'not available', codec.Codec, 'nope')
+
+    def test_client_floats(self):
+        self.app.route('/api/floats', lambda request: reply(FLOATS))
+        self.assertEqual(self.client.request('GET', 'floats'), FLOATS)
+        self.assertEqual(self.client.request('POST', 'thing', {'f': FLOATS})['params'], {'f': FLOATS})
+
+
+if __name__ == '__main__':
+    unittest.main()
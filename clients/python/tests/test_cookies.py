@@ -0,0 +1,105 @@
+#!/usr/bin/python -tt
+
+# omega - python client
+# https://github.com/jfillmore/Omega-API-Engine
+#
+# Copyright 2011, Jonathon Fillmore
+# Licensed under the MIT license. See LICENSE file.
+# http://www.opensource.org/licenses/mit-license.php
+
+
+"""Tests for cookies.CookieJar."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from omega import cookies
+from omega.client import OmegaClient
+from omega.cookies import CookieJar, shared_jar
+
+from support import ClientTestCase, reply
+
+
+class CookieJarTest(ClientTestCase):
+
+    def setUp(self):
+        ClientTestCase.setUp(self)
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, 'cookies')
+        self.app.route('/api/login', lambda request: reply('hi', headers = [('Set-Cookie', 'sid=abc; Path=/')]))
+
+    def test_sessions(self):
+        self.assertEqual(self.client.request('GET', 'thing')['cookie'], None)
+        self.client.request('POST', 'login')
+        self.assertEqual(self.client.request('GET', 'thing')['cookie'], 'sid=abc')
+        self.client.get_cookie_jar().clear()
+        self.assertEqual(self.client.request('GET', 'thing')['cookie'], None)
+
+    def test_cookies_stay_with_their_host(self):
+        self.client.request('POST', 'login')
+        self.client.set_url('elsewhere/api')
+        self.assertEqual(self.client.request('GET', 'thing')['cookie'], None)
+
+    def test_save_and_load(self):
+        jar = CookieJar(self.path)
+        self.client.set_cookie_jar(jar)
+        self.client.request('POST', 'login')
+        jar.stop()
+        self.assertEqual(os.stat(self.path).st_mode & 0777, 0600)
+        self.assertEqual([cookie.name for cookie in CookieJar(self.path)], ['sid'])
+
+    def test_saves_merge(self):
+        first = CookieJar(self.path)
+        second = CookieJar(self.path)
+        first.extract('http://localhost:5800/api/', ['a=1; Path=/'])
+        second.extract('http://localhost:5800/api/', ['b=2; Path=/'])
+        first.save()
+        second.save()
+        self.assertEqual(sorted([cookie.name for cookie in CookieJar(self.path)]), ['a', 'b'])
+
+    def test_unchanged_jars_are_not_saved(self):
+        CookieJar(self.path).save()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_one_jar_per_file(self):
+        other = os.path.join(self.dir, 'other')
+        for path in (self.path, other):
+            self.addCleanup(cookies._shared.pop, (path, None))
+        jar = shared_jar(self.path)
+        self.assertTrue(shared_jar(os.path.join(self.dir, '.', 'cookies')) is jar)
+        self.assertTrue(shared_jar(other) is not jar)
+
+    def test_one_jar_per_credentials(self):
+        self.addCleanup(cookies._shared.clear)
+        alice = {'username': 'alice', 'password': 'secret'}
+        jar = shared_jar(self.path, alice)
+        self.assertTrue(shared_jar(self.path, dict(alice)) is jar)
+        self.assertTrue(shared_jar(self.path, {'username': 'bob', 'password': 'secret'}) is not jar)
+        self.assertTrue(shared_jar(self.path) is not jar)
+        # a client's default jar follows its credentials
+        client = OmegaClient('localhost/api', use_https = False)
+        client._cookie_file = self.path
+        client.set_credentials(alice)
+        self.assertTrue(client.get_cookie_jar() is jar)
+        client.set_credentials(None)
+        self.assertTrue(client.get_cookie_jar() is not jar)
+
+    def test_saved_at_exit(self):
+        jar = CookieJar(self.path)
+        jar.extract('http://localhost:5800/api/', ['a=1; Path=/'])
+        cookies._save_all()
+        self.assertEqual([cookie.name for cookie in CookieJar(self.path)], ['a'])
+
+    def test_saved_when_dropped(self):
+        jar = CookieJar(self.path)
+        jar.extract('http://localhost:5800/api/', ['a=1; Path=/'])
+        self.assertTrue(jar in cookies._jars)
+        del jar
+        self.assertEqual([cookie.name for cookie in CookieJar(self.path)], ['a'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+#!/usr/bin/python -tt
+
+# omega - python client
+# https://github.com/jfillmore/Omega-API-Engine
+#
+# Copyright 2011, Jonathon Fillmore
+# Licensed under the MIT license. See LICENSE file.
+# http://www.opensource.org/licenses/mit-license.php
+
+
+"""Tests for hedge.Hedger."""
+
+import time
+import threading
+import unittest
+
+from omega.error import Exception
+from omega.hedge import Hedger
+
+from support import ClientTestCase, reply, failure
+
+
+class HedgeTest(ClientTestCase):
+
+    def setUp(self):
+        ClientTestCase.setUp(self)
+        self.hedger = Hedger(initial_delay = 0.05, budget = 1)
+        self.client.set_hedging(self.hedger)
+
+    def slow_first(self, delay):
+        '''Returns a handler that's slow to answer only the first request.'''
+        def handler(request):
+            if self.app.count(request.path) == 1:
+                time.sleep(delay)
+                return reply('primary')
+            return reply('hedge')
+        return handler
+
+    def test_fast_requests_are_not_hedged(self):
+        self.assertEqual(self.client.request('GET', 'thing')['method'], 'GET')
+        time.sleep(0.1)
+        self.assertEqual(self.app.count(), 1)
+        self.assertEqual(self.hedger.stats()['hedges'], 0)
+
+    def test_one_scheduler_thread(self):
+        self.hedger.initial_delay = self.hedger._delay = 1
+        before = set(threading.enumerate())
+        for i in range(20):
+            self.client.request('GET', 'thing')
+        # rather than a thread per request, sleeping until its hedge would be due
+        started = [thread.name for thread in set(threading.enumerate()) - before]
+        self.assertEqual(started, ['omega-hedger'])
+        self.assertEqual(self.app.count(), 20)
+
+    def test_hedge_wins(self):
+        self.app.route('/api/slow', self.slow_first(0.5))
+        # a WSGI app can't be interrupted, so cancelling the primary needs a socket to shut down
+        (server, client) = self.serve()
+        client.set_hedging(self.hedger)
+        started = time.time()
+        self.assertEqual(client.request('GET', 'slow'), 'hedge')
+        self.assertTrue(time.time() - started < 0.4)
+        stats = self.hedger.stats()
+        self.assertEqual((stats['requests'], stats['hedges'], stats['hedges_won']), (1, 1, 1))
+
+    def test_primary_wins(self):
+        # the hedge is slower still
+        def handler(request):
+            if self.app.count(request.path) == 1:
+                time.sleep(0.1)
+                return reply('primary')
+            time.sleep(0.3)
+            return reply('hedge')
+        self.app.route('/api/slow', handler)
+        self.assertEqual(self.client.request('GET', 'slow'), 'primary')
+        stats = self.hedger.stats()
+        self.assertEqual((stats['hedges'], stats['hedges_won']), (1, 0))
+
+    def test_budget(self):
+        self.hedger.budget = 0.01
+        self.hedger._tokens = 0
+        self.app.route('/api/slow', self.slow_first(0.1))
+        self.assertEqual(self.client.request('GET', 'slow'), 'primary')
+        self.assertEqual(self.app.count(), 1)
+        self.assertEqual(self.hedger.stats()['hedges_denied'], 1)
+
+    def test_only_gets_are_hedged(self):
+        self.app.route('/api/slow', self.slow_first(0.1))
+        self.assertEqual(self.client.request('POST', 'slow'), 'primary')
+        self.assertEqual(self.app.count(), 1)
+        self.assertEqual(self.hedger.stats()['requests'], 0)
+
+    def test_failures(self):
+        self.app.route('/api/fail', lambda request: failure('nope', '500 Oops'))
+        self.assertRaisesRegexp(Exception, 'nope', self.client.request, 'GET', 'fail')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,325 @@
+#!/usr/bin/python -tt
+
+# omega - python client
+# https://github.com/jfillmore/Omega-API-Engine
+#
+# Copyright 2011, Jonathon Fillmore
+# Licensed under the MIT license. See LICENSE file.
+# http://www.opensource.org/licenses/mit-license.php
+
+
+"""Tests for http2.HTTP2Transport, against a small HTTP/2 server run in the test process."""
+
+import os
+import sys
+import ssl
+import json
+import time
+import socket
+import threading
+import unittest
+from cStringIO import StringIO
+
+try:
+    import h2.config
+    import h2.connection
+    import h2.errors
+    import h2.events
+    import h2.exceptions
+except ImportError:
+    h2 = None
+
+from omega.client import OmegaClient
+from omega.cookies import CookieJar
+from omega.retry import RetryPolicy
+
+# a self-signed certificate (and its key) for localhost and 127.0.0.1
+CERTIFICATE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'localhost.pem')
+
+
+class H2Server:
+    """Serves HTTP/2 on 127.0.0.1: as h2c, or over TLS offering 'alpn' (anything but h2 gets HTTP/1.1).
+
+    Every path answers with what was asked for, except /api/slow, which
+    answers after a second (unless reset first), and /api/goaway, after
+    which the server sends a GOAWAY and hangs up."""
+
+    def __init__(self, tls = False, alpn = ('h2',)):
+        self.context = None
+        if tls:
+            self.context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+            self.context.load_cert_chain(CERTIFICATE)
+            self.context.set_alpn_protocols(list(alpn))
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.streams = 0
+        self.resets = []
+        self.listener = socket.socket()
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(16)
+        self.port = self.listener.getsockname()[1]
+        self._socks = []
+        self._timers = []
+        thread = threading.Thread(target = self._accept)
+        thread.daemon = True
+        thread.start()
+
+    def _accept(self):
+        while True:
+            try:
+                (sock, address) = self.listener.accept()
+            except socket.error:
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._socks.append(sock)
+            thread = threading.Thread(target = self._serve, args = (sock,))
+            thread.daemon = True
+            thread.start()
+
+    def close(self):
+        self.listener.close()
+        for timer in self._timers:
+            timer.cancel()
+        for sock in self._socks:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            sock.close()
+
+    def _serve(self, sock):
+        self.lock.acquire()
+        try:
+            self.connections += 1
+        finally:
+            self.lock.release()
+        try:
+            if self.context is not None:
+                sock = self.context.wrap_socket(sock, server_side = True)
+                if sock.selected_alpn_protocol() != 'h2':
+                    return self._serve_http1(sock)
+            self._serve_h2(sock)
+        except (socket.error, ssl.SSLError, h2.exceptions.ProtocolError):
+            pass
+        finally:
+            sock.close()
+
+    def _serve_h2(self, sock):
+        conn = h2.connection.H2Connection(config = h2.config.H2Configuration(client_side = False))
+        conn.initiate_connection()
+        sock.sendall(conn.data_to_send())
+        requests = {}
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                return
+            self.lock.acquire()
+            try:
+                events = conn.receive_data(data)
+                for event in events:
+                    if isinstance(event, h2.events.RequestReceived):
+                        self.streams += 1
+                        requests[event.stream_id] = (dict(event.headers), [])
+                    elif isinstance(event, h2.events.DataReceived):
+                        requests[event.stream_id][1].append(event.data)
+                        conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+                    elif isinstance(event, h2.events.StreamEnded):
+                        (headers, body) = requests.pop(event.stream_id)
+                        self._answer(sock, conn, event.stream_id, headers, ''.join(body))
+                    elif isinstance(event, h2.events.StreamReset):
+                        self.resets.append((event.stream_id, event.error_code))
+                sock.sendall(conn.data_to_send())
+            finally:
+                self.lock.release()
+
+    def _answer(self, sock, conn, stream_id, headers, body):
+        '''Answers a request; the lock must be held.'''
+        path = headers[':path']
+        if path.startswith('/api/slow'):
+            def answer():
+                self.lock.acquire()
+                try:
+                    try:
+                        self._respond(conn, stream_id, path, headers, body)
+                    except h2.exceptions.StreamClosedError:
+                        # reset by the client already
+                        return
+                    sock.sendall(conn.data_to_send())
+                except socket.error:
+                    pass
+                finally:
+                    self.lock.release()
+            timer = threading.Timer(1, answer)
+            timer.daemon = True
+            timer.start()
+            self._timers.append(timer)
+            return
+        self._respond(conn, stream_id, path, headers, body)
+        if path.startswith('/api/goaway'):
+            conn.close_connection(last_stream_id = stream_id)
+            sock.sendall(conn.data_to_send())
+            sock.shutdown(socket.SHUT_RDWR)
+
+    def _respond(self, conn, stream_id, path, headers, body):
+        out = json.dumps({'result': True, 'data': {
+            'protocol': 'h2',
+            'method': headers[':method'],
+            'path': path,
+            'body': body
+        }})
+        conn.send_headers(stream_id, [
+            (':status', '200'),
+            ('content-type', 'application/json'),
+            ('content-length', str(len(out)))
+        ])
+        conn.send_data(stream_id, out, end_stream = True)
+
+    def _serve_http1(self, sock):
+        stream = sock.makefile('rb')
+        while True:
+            line = stream.readline()
+            if not line:
+                return
+            headers = {}
+            while True:
+                header = stream.readline()
+                if header in ('\r\n', ''):
+                    break
+                (name, value) = header.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+            body = stream.read(int(headers.get('content-length', 0)))
+            (method, path) = line.split()[0:2]
+            out = json.dumps({'result': True, 'data': {
+                'protocol': 'http/1.1',
+                'method': method,
+                'path': path,
+                'body': body
+            }})
+            sock.sendall(
+                'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n%s' %
+                (len(out), out)
+            )
+
+
+if h2 is not None:
+    from omega.http2 import HTTP2Transport
+
+
+@unittest.skipIf(h2 is None, "the 'h2' package isn't installed")
+class HTTP2TransportTest(unittest.TestCase):
+
+    def start(self, tls = False, alpn = ('h2',), timeout = 5):
+        self.server = H2Server(tls, alpn)
+        self.addCleanup(self.server.close)
+        if tls:
+            context = ssl.create_default_context(cafile = CERTIFICATE)
+            self.transport = HTTP2Transport(timeout = timeout, ssl_context = context)
+        else:
+            self.transport = HTTP2Transport(timeout = timeout, prior_knowledge = True)
+        self.addCleanup(self.transport.close)
+        self.client = OmegaClient('localhost/api', port = self.server.port, use_https = tls,
+            cookie_jar = CookieJar(None), retry_policy = RetryPolicy(max_tries = 1))
+        self.client.set_transport(self.transport)
+        return self.client
+
+    def call(self, func, *args):
+        '''Runs a call in another thread so a hang fails the test instead of the test run.'''
+        outcome = []
+
+        def run():
+            try:
+                outcome.append((True, func(*args)))
+            except:
+                outcome.append((False, sys.exc_info()[1]))
+
+        thread = threading.Thread(target = run)
+        thread.daemon = True
+        thread.start()
+        thread.join(10)
+        self.assertTrue(outcome, 'call hung')
+        return outcome[0]
+
+    def wait_for(self, check, timeout = 5):
+        deadline = time.time() + timeout
+        while not check() and time.time() < deadline:
+            time.sleep(0.01)
+        return check()
+
+    def test_h2c(self):
+        client = self.start()
+        self.assertEqual(client.request('GET', 'thing')['protocol'], 'h2')
+        result = client.request('POST', 'thing', {'x': 1})
+        self.assertEqual(result['method'], 'POST')
+        self.assertEqual(json.loads(result['body']), {'x': 1})
+        results = list(client.request_many([('GET', 'many/%d' % i, {}) for i in range(20)], concurrency = 10))
+        self.assertEqual([r['data']['path'] for r in results], ['/api/many/%d?' % i for i in range(20)])
+        # every stream went over the one connection
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(self.server.streams, 22)
+        stats = self.transport.stats()
+        self.assertEqual((stats['connections'], stats['streams'], stats['fallbacks']), (1, 22, 0))
+
+    def test_tls_alpn_h2(self):
+        client = self.start(tls = True)
+        self.assertEqual(client.request('GET', 'thing')['protocol'], 'h2')
+        self.assertEqual(self.transport.stats()['connections'], 1)
+
+    def test_alpn_fallback_to_http1(self):
+        client = self.start(tls = True, alpn = ('http/1.1',))
+        for i in range(3):
+            self.assertEqual(client.request('GET', 'thing')['protocol'], 'http/1.1')
+        stats = self.transport.stats()
+        self.assertEqual(stats['connections'], 0)
+        self.assertTrue(stats['fallbacks'] >= 3)
+        # the socket from the ALPN handshake was used, then kept alive
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(stats['http1']['reused'], 2)
+
+    def test_cancel_resets_only_the_stream(self):
+        client = self.start(timeout = 0.3)
+        client.request('GET', 'thing')
+        started = time.time()
+        (ok, error) = self.call(client.request, 'GET', 'slow')
+        self.assertFalse(ok)
+        self.assertTrue(time.time() - started < 1)
+        self.assertTrue(self.wait_for(lambda: self.server.resets))
+        self.assertEqual(self.server.resets[0][1], h2.errors.ErrorCodes.CANCEL)
+        # the connection carries on for everyone else
+        self.assertEqual(client.request('GET', 'after')['path'], '/api/after?')
+        stats = self.transport.stats()
+        self.assertEqual((stats['connections'], stats['cancelled']), (1, 1))
+        self.assertEqual(self.server.connections, 1)
+
+    def test_goaway(self):
+        client = self.start()
+        self.assertEqual(client.request('GET', 'goaway')['path'], '/api/goaway?')
+        self.assertTrue(self.wait_for(lambda: not self.transport.stats()['open']))
+        self.assertEqual(client.request('GET', 'after')['path'], '/api/after?')
+        self.assertEqual(self.server.connections, 2)
+        self.assertEqual(self.transport.stats()['connections'], 2)
+
+    def test_io_thread_failure_fails_streams(self):
+        # no timeout: only the I/O thread failing the stream keeps this from hanging
+        client = self.start(timeout = None)
+        client.request('GET', 'thing')
+        connection = self.transport._conns.values()[0]
+
+        def broken(events):
+            raise ValueError('broken')
+
+        connection._handle = broken
+        stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            (ok, error) = self.call(client.request, 'GET', 'thing')
+            connection._thread.join(5)
+        finally:
+            sys.stderr = stderr
+        self.assertFalse(ok)
+        self.assertTrue('broken' in str(error))
+        self.assertEqual(connection.state, 'closed')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+#!/usr/bin/python -tt
+
+# omega - python client
+# https://github.com/jfillmore/Omega-API-Engine
+#
+# Copyright 2011, Jonathon Fillmore
+# Licensed under the MIT license. See LICENSE file.
+# http://www.opensource.org/licenses/mit-license.php
+
+
+"""Tests for jsonstream, the incremental envelope decoder."""
+
+import json
+import unittest
+
+from omega import jsonstream
+from omega.error import Exception
+
+
+def split(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+class EnvelopeDecoderTest(unittest.TestCase):
+
+    def test_any_chunking(self):
+        data = [1, 'two', {'three': [3, '"]}']}, None, 4.5]
+        text = json.dumps({'result': True, 'data': data, 'extra': {'a': 1}})
+        for size in (1, 2, 3, 7, len(text)):
+            decoder = jsonstream.EnvelopeDecoder()
+            self.assertEqual(list(decoder.decode(split(text, size))), data)
+            self.assertEqual(decoder.envelope, {'result': True, 'extra': {'a': 1}})
+
+    def test_data_before_result(self):
+        text = '{"data": [1, 2], "result": true}'
+        self.assertEqual(list(jsonstream.iter_data(split(text, 4))), [1, 2])
+
+    def test_non_list_data(self):
+        self.assertEqual(list(jsonstream.iter_data(['{"result": true, "data": {"a": 1}}'])), [{'a': 1}])
+        self.assertEqual(list(jsonstream.iter_data(['{"result": true}'])), [])
+
+    def test_failure(self):
+        chunks = split('{"data": [1, 2], "result": false, "reason": "nope"}', 5)
+        items = []
+        try:
+            for item in jsonstream.iter_data(chunks):
+                items.append(item)
+        except Exception, e:
+            self.assertTrue('nope' in str(e))
+        else:
+            self.fail('no exception raised')
+        # whatever came before the failure still got through
+        self.assertEqual(items, [1, 2])
+
+    def test_truncated(self):
+        self.assertRaisesRegexp(Exception, 'ended early', list, jsonstream.iter_data(['{"result": true, "data": [1, 2']))
+
+    def test_encode_array(self):
+        records = ({'i': i} for i in range(1000))
+        chunks = list(jsonstream.encode_array(records, chunk_size = 100))
+        self.assertTrue(len(chunks) > 10)
+        self.assertEqual(json.loads(''.join(chunks)), [{'i': i} for i in range(1000)])
+        self.assertEqual(''.join(jsonstream.encode_array([])), '[]')
+
+
+if __name__ == '__main__':
+    unittest.main()
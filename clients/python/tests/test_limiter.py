@@ -0,0 +1,118 @@
+#!/usr/bin/python -tt
+
+# omega - python client
+# https://github.com/jfillmore/Omega-API-Engine
+#
+# Copyright 2011, Jonathon Fillmore
+# Licensed under the MIT license. See LICENSE file.
+# http://www.opensource.org/licenses/mit-license.php
+
+
+"""Tests for limiter.RateLimiter."""
+
+import time
+import unittest
+
+from omega.error import Exception
+from omega.limiter import RateLimiter, AdaptiveLimit, TokenBucket
+from omega.retry import RetryPolicy
+
+from support import ClientTestCase, reply, failure
+
+
+class RateLimiterTest(ClientTestCase):
+
+    def setUp(self):
+        ClientTestCase.setUp(self)
+        self.limiter = RateLimiter()
+        self.client.set_limiter(self.limiter)
+        self.app.route('/api/slow', self.slow(0.05))
+
+    def test_concurrency(self):
+        self.limiter.add('slow', adaptive = True, initial = 2, min_limit = 2, max_limit = 2)
+        results = list(self.client.request_many([('GET', 'slow', {})] * 8, concurrency = 8))
+        self.assertTrue(all([r['result'] for r in results]))
+        self.assertEqual(self.app.max_active, 2)
+        stats = self.limiter.stats()
+        self.assertEqual(stats['requests'], 8)
+        self.assertEqual(stats['limits']['http://localhost:5800 slow']['in_flight'], 0)
+
+    def test_run_many_over_curl(self):
+        self.limiter.add('slow', adaptive = True, initial = 2, min_limit = 2, max_limit = 2)
+        (server, client) = self.serve()
+        client.set_limiter(self.limiter)
+        results = list(client.run_many([('slow', {})] * 8, concurrency = 8))
+        self.assertTrue(all([r['result'] for r in results]))
+        self.assertEqual(self.app.max_active, 2)
+        stats = self.limiter.stats()
+        self.assertEqual(stats['requests'], 8)
+        limit = stats['limits']['http://127.0.0.1:%s slow' % server.port]
+        self.assertEqual((limit['in_flight'], limit['backoffs']), (0, 0))
+
+    def test_rate(self):
+        self.limiter.add(rate = 20, burst = 1)
+        started = time.time()
+        for i in range(5):
+            self.client.request('GET', 'thing')
+        self.assertTrue(time.time() - started >= 0.19)
+        self.assertEqual(self.limiter.stats()['waits'], 4)
+
+    def test_most_specific_rule_wins(self):
+        self.limiter.add(rate = 1000)
+        self.limiter.add('thing', rate = 1, burst = 1)
+        self.limiter.timeout = 0.1
+        self.client.request('GET', 'thing')
+        self.assertRaisesRegexp(Exception, 'Timed out', self.client.request, 'GET', 'thing')
+        self.client.request('GET', 'other')
+        self.assertEqual(self.app.count(), 2)
+        self.assertEqual(self.limiter.stats()['timeouts'], 1)
+
+    def test_backs_off_when_overloaded(self):
+        self.limiter.add(adaptive = True, initial = 8)
+        self.app.route('/api/busy', lambda request: failure('busy', '429 Slow Down'))
+        self.client.set_retry_policy(RetryPolicy(max_tries = 1))
+        self.assertRaises(Exception, self.client.request, 'GET', 'busy')
+        limit = self.limiter.stats()['limits']['http://localhost:5800 *']
+        self.assertEqual((limit['limit'], limit['backoffs']), (4, 1))
+
+    def test_permits_are_held_until_the_body_is_in(self):
+        self.limiter.add(adaptive = True, initial = 1, min_limit = 1, max_limit = 1)
+        self.app.route('/api/list', lambda request: reply(range(1000)))
+        in_flight = lambda: self.limiter.stats()['limits']['http://localhost:5800 *']['in_flight']
+        chunks = self.client.stream('GET', 'list', chunk_size = 100)
+        chunks.next()
+        self.assertEqual(in_flight(), 1)
+        ''.join(chunks)
+        self.assertEqual(in_flight(), 0)
+        # as are those of bodies that couldn't be read in full
+        chunks = self.client.stream('GET', 'list', chunk_size = 100)
+        chunks.next()
+        chunks.close()
+        self.assertEqual(in_flight(), 0)
+
+
+class AdaptiveLimitTest(unittest.TestCase):
+
+    def test_grows_while_latency_holds(self):
+        limit = AdaptiveLimit(initial = 2, max_limit = 3)
+        for i in range(20):
+            limit.in_flight = 2
+            limit.finish(time.time(), 0.01)
+        self.assertEqual(limit.limit, 3)
+
+    def test_backs_off_once_per_round(self):
+        limit = AdaptiveLimit(initial = 8)
+        started = time.time()
+        for i in range(4):
+            limit.in_flight = 1
+            limit.finish(started, 0.01, overloaded = True)
+        self.assertEqual((limit.limit, limit.backoffs), (4, 1))
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(10, 2)
+        self.assertEqual((bucket.take(), bucket.take()), (0, 0))
+        self.assertTrue(0 < bucket.take() <= 0.1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+#!/usr/bin/python -tt
+
+# omega - python client
+# https://github.com/jfillmore/Omega-API-Engine
+#
+# Copyright 2011, Jonathon Fillmore
+# Licensed under the MIT license. See LICENSE file.
+# http://www.opensource.org/licenses/mit-license.php
+
+
+"""Tests for metrics.Histogram and metrics.Metrics."""
+
+import re
+import unittest
+
+from omega.metrics import Histogram, Metrics, template
+
+from support import ClientTestCase, reply, failure
+
+
+class HistogramTest(unittest.TestCase):
+
+    def test_buckets(self):
+        histogram = Histogram()
+        for value in (0, 0.001, 0.1, 1, 255):
+            histogram.record(value)
+        self.assertEqual((histogram.count, histogram.overflow), (5, 0))
+        for value in (0.001, 0.1, 1, 255):
+            index = [i for (i, count) in enumerate(histogram.counts) if count and histogram.bounds[i] > value][0]
+            self.assertTrue(index == 0 or histogram.bounds[index - 1] <= value)
+
+    def test_overflow(self):
+        histogram = Histogram()
+        histogram.record(1)
+        histogram.record(256)
+        histogram.record(1000)
+        self.assertEqual(sum(histogram.counts), 1)
+        self.assertEqual((histogram.overflow, histogram.count), (2, 3))
+        self.assertEqual(histogram.percentile(30), 1.25)
+        self.assertEqual(histogram.percentile(99), 1000)
+
+    def test_percentile(self):
+        histogram = Histogram()
+        self.assertEqual(histogram.percentile(50), None)
+        for i in range(100):
+            histogram.record(0.01)
+        histogram.record(3)
+        self.assertTrue(0.01 <= histogram.percentile(50) < 0.0125)
+        self.assertEqual(histogram.percentile(100), 3)
+
+
+class MetricsTest(unittest.TestCase):
+
+    def test_template(self):
+        self.assertEqual(template('users/12/posts/0123456789abcdef01234567?x=1'), 'users/:id/posts/:id')
+
+    def test_prometheus_overflow_only_in_inf(self):
+        metrics = Metrics()
+        for latency in (0.5, 300):
+            metrics.start_request()
+            metrics.finish_request('GET', 'slow', 200, latency)
+        text = metrics.prometheus()
+        buckets = re.findall(r'omega_client_request_duration_seconds_bucket\{.*le="([^"]+)"\} (\d+)', text)
+        self.assertEqual(buckets[-2], ('256', '1'))
+        self.assertEqual(buckets[-1], ('+Inf', '2'))
+        self.assertTrue('omega_client_request_duration_seconds_count{method="GET",api="slow"} 2' in text)
+        self.assertEqual(metrics.snapshot()['apis']['GET slow']['p99'], 300)
+
+    def test_prometheus_collectors_have_headers(self):
+        metrics = Metrics()
+        metrics.add_collector('pool', lambda: {'idle': 2, 'name': 'default'})
+        lines = metrics.prometheus().splitlines()
+        index = lines.index('omega_client_pool_idle 2')
+        self.assertEqual(lines[index - 2:index], ['# HELP omega_client_pool_idle The pool stat "idle".', '# TYPE omega_client_pool_idle untyped'])
+        self.assertFalse([line for line in lines if 'name' in line])
+
+
+class ClientMetricsTest(ClientTestCase):
+
+    def setUp(self):
+        ClientTestCase.setUp(self)
+        self.metrics = Metrics()
+        self.client.set_metrics(self.metrics)
+
+    def counts(self, metrics = None):
+        apis = (metrics or self.metrics).snapshot()['apis']
+        return dict([(name, stats['statuses']) for (name, stats) in apis.iteritems()])
+
+    def test_every_kind_of_call_is_counted(self):
+        self.app.route('/api/fail', lambda request: failure('nope'))
+        self.client.request('GET', 'thing')
+        self.client.run('thing')
+        list(self.client.run_many([('thing', {}), ('fail', {})]))
+        ''.join(self.client.stream('GET', 'list'))
+        self.assertEqual(self.counts(), {
+            'GET thing': {200: 1},
+            'POST thing': {200: 2},
+            'POST fail': {200: 1},
+            'GET list': {200: 1}
+        })
+        self.assertEqual(self.metrics.in_flight, 0)
+
+    def test_curl_calls_are_counted(self):
+        (server, client) = self.serve()
+        metrics = Metrics()
+        client.set_metrics(metrics)
+        client.run('thing')
+        list(client.run_many([('thing', {'i': i}) for i in range(3)]))
+        self.assertEqual(self.counts(metrics), {'POST thing': {200: 4}})
+        self.assertTrue(metrics.snapshot()['apis']['POST thing']['response_bytes'] > 0)
+        self.assertEqual(metrics.in_flight, 0)
+
+    def test_abandoned_streams_are_not_left_in_flight(self):
+        self.app.route('/api/list', lambda request: reply(range(1000)))
+        chunks = self.client.stream('GET', 'list', chunk_size = 100)
+        chunks.next()
+        chunks.close()
+        self.assertEqual(self.counts(), {'GET list': {'error': 1}})
+        self.assertEqual(self.metrics.in_flight, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
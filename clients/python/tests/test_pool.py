@@ -0,0 +1,126 @@
+#!/usr/bin/python -tt
+
+# omega - python client
+# https://github.com/jfillmore/Omega-API-Engine
+#
+# Copyright 2011, Jonathon Fillmore
+# Licensed under the MIT license. See LICENSE file.
+# http://www.opensource.org/licenses/mit-license.php
+
+
+"""Tests for pool.ConnectionPool, against a local HTTP server."""
+
+import time
+import unittest
+
+from omega.error import Exception
+from omega.pool import ConnectionPool
+
+from support import ClientTestCase
+
+
+class ConnectionPoolTest(ClientTestCase):
+
+    def setUp(self):
+        ClientTestCase.setUp(self)
+        self.pool = ConnectionPool(max_size = 2, max_idle = 60, timeout = 0.2)
+        (self.server, self.client) = self.serve(pool = self.pool)
+        self.key = ('http', '127.0.0.1', self.server.port)
+
+    def test_reuse(self):
+        for i in range(5):
+            self.client.request('GET', 'thing')
+        stats = self.pool.stats()
+        self.assertEqual((stats['checkouts'], stats['new_connections'], stats['reused']), (5, 1, 4))
+        self.assertEqual((stats['idle'], stats['open']), (1, 1))
+        self.assertEqual(self.server.connections, 1)
+        self.assertTrue(self.client.last_timing().reused)
+
+    def test_checkout_limit(self):
+        first = self.pool.get(*self.key)
+        second = self.pool.get(*self.key)
+        started = time.time()
+        self.assertRaisesRegexp(Exception, 'Timed out waiting', self.pool.get, *self.key)
+        self.assertTrue(time.time() - started >= 0.2)
+        self.pool.discard(second)
+        # the slot freed up
+        third = self.pool.get(*self.key)
+        self.assertEqual(self.pool.stats()['waits'], 1)
+        for conn in (first, third):
+            self.pool.discard(conn)
+
+    def test_concurrent_checkouts_share_connections(self):
+        self.app.route('/api/slow', self.slow(0.05))
+        results = list(self.client.request_many([('GET', 'slow', {})] * 6, concurrency = 6))
+        self.assertTrue(all([r['result'] for r in results]))
+        self.assertEqual(self.app.max_active, 2)
+        self.assertEqual(self.pool.stats()['new_connections'], 2)
+
+    def test_reaping(self):
+        self.client.request('GET', 'thing')
+        self.pool.max_idle = 0.05
+        time.sleep(0.1)
+        self.pool.reap()
+        stats = self.pool.stats()
+        self.assertEqual((stats['reaped'], stats['idle'], stats['open']), (1, 0, 0))
+        self.client.request('GET', 'thing')
+        self.assertEqual(self.server.connections, 2)
+
+    def test_reaper_stops_when_nothing_is_idle(self):
+        self.pool.reap_interval = 0.05
+        self.client.request('GET', 'thing')
+        self.assertTrue(self.pool._reaper is not None)
+        self.pool.close()
+        self.assertTrue(self.wait_for(lambda: self.pool._reaper is None))
+        # and starts again once there's something to reap
+        self.client.request('GET', 'thing')
+        self.assertTrue(self.pool._reaper is not None)
+
+    def test_closed_connections_are_dropped(self):
+        self.server.hang_up = True
+        self.client.request('GET', 'thing')
+        self.server.hang_up = False
+        (conn, last_used) = self.pool._idle[self.key][0]
+        self.assertTrue(self.wait_for(lambda: not self.pool._is_healthy(conn)))
+        self.client.request('GET', 'thing')
+        stats = self.pool.stats()
+        self.assertEqual((stats['unhealthy'], stats['reused'], stats['open']), (1, 0, 1))
+        self.assertEqual(self.server.connections, 2)
+
+    def test_preconnect(self):
+        self.assertEqual(self.client.preconnect(2), 2)
+        self.assertEqual(self.client.preconnect(2), 0)
+        # the server counts them once its threads get to them
+        self.assertTrue(self.wait_for(lambda: self.server.connections == 2))
+        self.client.request('GET', 'thing')
+        stats = self.pool.stats()
+        self.assertEqual((stats['preconnected'], stats['reused']), (2, 1))
+
+    def test_failed_preconnects_give_back_their_slots(self):
+        def broken(conn, timing = None):
+            raise ValueError('broken')
+        self.pool.connect = broken
+        self.assertRaisesRegexp(Exception, 'broken', self.client.preconnect, 2)
+        self.assertEqual(self.pool.stats()['open'], 0)
+
+    def test_close(self):
+        self.client.request('GET', 'thing')
+        self.pool.close()
+        self.assertEqual(self.pool.stats()['open'], 0)
+        self.client.request('GET', 'thing')
+        self.assertEqual(self.server.connections, 2)
+
+    def test_close_with_connections_checked_out(self):
+        conn = self.pool.get(*self.key)
+        self.pool.connect(conn)
+        self.pool.close()
+        self.pool.put(conn)
+        self.assertEqual(conn.sock, None)
+        stats = self.pool.stats()
+        self.assertEqual((stats['idle'], stats['open']), (0, 0))
+        self.client.request('GET', 'thing')
+        self.assertEqual(self.pool.stats()['idle'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+#!/usr/bin/python -tt
+
+# omega - python client
+# https://github.com/jfillmore/Omega-API-Engine
+#
+# Copyright 2011, Jonathon Fillmore
+# Licensed under the MIT license. See LICENSE file.
+# http://www.opensource.org/licenses/mit-license.php
+
+
+"""Tests for resolver.Resolver."""
+
+import socket
+import unittest
+
+from omega import resolver
+from omega.resolver import Resolver
+
+from support import ClientTestCase
+
+V6 = [(socket.AF_INET6, socket.SOCK_STREAM, 6, '', ('::%d' % i, 80, 0, 0)) for i in (1, 2)]
+V4 = [(socket.AF_INET, socket.SOCK_STREAM, 6, '', ('10.0.0.%d' % i, 80)) for i in (1, 2)]
+
+
+class ResolverTest(ClientTestCase):
+
+    def setUp(self):
+        ClientTestCase.setUp(self)
+        self.answers = V6 + V4
+        self.lookups = []
+        getaddrinfo = socket.getaddrinfo
+        self.addCleanup(setattr, resolver.socket, 'getaddrinfo', getaddrinfo)
+        resolver.socket.getaddrinfo = self.getaddrinfo
+
+    def getaddrinfo(self, host, port, family = 0, socktype = 0):
+        self.lookups.append((host, port))
+        if self.answers is None:
+            raise socket.gaierror(socket.EAI_NONAME, 'Name or service not known')
+        return self.answers
+
+    def addresses(self, entries):
+        return [entry[3][0] for entry in entries]
+
+    def test_families_alternate(self):
+        self.assertEqual(self.addresses(Resolver().resolve('example.com', 80)), ['::1', '10.0.0.1', '::2', '10.0.0.2'])
+
+    def test_cached(self):
+        cached = Resolver()
+        cached.resolve('example.com', 80)
+        cached.resolve('example.com', 80)
+        cached.resolve('example.com', 443)
+        self.assertEqual(self.lookups, [('example.com', 80), ('example.com', 443)])
+        stats = cached.stats()
+        self.assertEqual((stats['lookups'], stats['cache_hits'], stats['cached']), (3, 1, 2))
+
+    def test_stale_answers_beat_none(self):
+        stale = Resolver(ttl = 0)
+        stale.resolve('example.com', 80)
+        self.answers = None
+        self.assertEqual(len(stale.resolve('example.com', 80)), 4)
+        self.assertEqual(stale.stats()['stale_hits'], 1)
+        self.assertRaises(socket.gaierror, stale.resolve, 'example.org', 80)
+
+    def test_failed_addresses_go_last(self):
+        ordered = Resolver()
+        ordered.failed(('::1', 80, 0, 0))
+        ordered.failed(('10.0.0.1', 80))
+        self.assertEqual(self.addresses(ordered.resolve('example.com', 80)), ['::2', '10.0.0.2', '::1', '10.0.0.1'])
+        ordered.succeeded(('::1', 80, 0, 0))
+        self.assertEqual(self.addresses(ordered.resolve('example.com', 80)), ['::1', '::2', '10.0.0.2', '10.0.0.1'])
+        self.assertEqual(ordered.stats()['failing'], 1)
+
+    def test_connect_skips_refused_addresses(self):
+        (server, client) = self.serve()
+        closed = socket.socket()
+        closed.bind(('127.0.0.1', 0))
+        refused = closed.getsockname()
+        closed.close()
+        racer = Resolver()
+        addresses = [
+            (socket.AF_INET, socket.SOCK_STREAM, 6, refused),
+            (socket.AF_INET, socket.SOCK_STREAM, 6, ('127.0.0.1', server.port))
+        ]
+        sock = racer.connect(addresses, 1)
+        self.assertEqual(sock.getpeername(), ('127.0.0.1', server.port))
+        self.assertEqual(sock.gettimeout(), 1)
+        sock.close()
+        self.assertEqual(racer.stats()['failing'], 1)
+        self.assertRaises(socket.error, racer.connect, addresses[0:1], 1)
+        self.assertRaises(socket.error, racer.connect, [], 1)
+
+    def test_pool_lookups_are_cached(self):
+        (server, client) = self.serve()
+        self.answers = [(socket.AF_INET, socket.SOCK_STREAM, 6, '', ('127.0.0.1', server.port))]
+        client.set_url('db.example/api')
+        # so each request connects again
+        client.get_pool().max_idle = 0
+        for i in range(3):
+            client.request('GET', 'thing')
+        self.assertEqual(self.lookups, [('db.example', server.port)])
+        self.assertEqual(client.get_pool_stats()['resolver']['cache_hits'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
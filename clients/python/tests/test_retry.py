@@ -0,0 +1,126 @@
+#!/usr/bin/python -tt
+
+# omega - python client
+# https://github.com/jfillmore/Omega-API-Engine
+#
+# Copyright 2011, Jonathon Fillmore
+# Licensed under the MIT license. See LICENSE file.
+# http://www.opensource.org/licenses/mit-license.php
+
+
+"""Tests for retry.RetryPolicy and retry.CircuitBreaker."""
+
+import socket
+import time
+import unittest
+
+from omega.error import Exception
+from omega.retry import RetryPolicy, CircuitBreaker, parse_retry_after
+
+from support import ClientTestCase, reply, failure
+
+
+class RetryTest(ClientTestCase):
+
+    def setUp(self):
+        ClientTestCase.setUp(self)
+        self.policy = RetryPolicy(max_tries = 3, backoff = 0.001, breaker_threshold = 3, breaker_timeout = 60)
+        self.client.set_retry_policy(self.policy)
+
+    def flaky(self, failures, status = '503 Busy', headers = ()):
+        '''Returns a handler failing the first 'failures' requests with 'status'.'''
+        def handler(request):
+            if self.app.count(request.path) <= failures:
+                return failure('busy', status, headers)
+            return reply('ok')
+        return handler
+
+    def test_retries_until_success(self):
+        self.app.route('/api/flaky', self.flaky(2, headers = [('Retry-After', '0')]))
+        self.assertEqual(self.client.request('GET', 'flaky'), 'ok')
+        self.assertEqual(self.app.count(), 3)
+        self.assertEqual(self.client.last_timing().tries, 3)
+        self.assertEqual(self.policy.stats()['retries'], 2)
+
+    def test_gives_up(self):
+        self.app.route('/api/flaky', self.flaky(5))
+        self.assertRaisesRegexp(Exception, '503 Busy', self.client.request, 'GET', 'flaky')
+        self.assertEqual(self.app.count(), 3)
+        self.assertEqual(self.policy.stats()['giveups'], 1)
+
+    def test_unsafe_methods_are_not_retried(self):
+        self.app.route('/api/flaky', self.flaky(1))
+        self.assertRaises(Exception, self.client.request, 'POST', 'flaky')
+        self.assertEqual(self.app.count(), 1)
+
+    def test_other_errors_are_not_retried(self):
+        self.app.route('/api/broken', self.flaky(1, '500 Oops'))
+        self.assertRaises(Exception, self.client.request, 'GET', 'broken')
+        self.assertEqual(self.app.count(), 1)
+
+    def test_breaker_opens(self):
+        self.app.route('/api/flaky', self.flaky(100))
+        self.assertRaises(Exception, self.client.request, 'GET', 'flaky')
+        # the third failure tripped the breaker, so nothing more is sent
+        self.assertRaisesRegexp(Exception, 'Circuit open', self.client.request, 'GET', 'flaky')
+        self.assertEqual(self.app.count(), 3)
+        stats = self.policy.stats()
+        self.assertEqual((stats['breaker_trips'], stats['breaker_rejections']), (1, 1))
+        self.assertEqual(stats['hosts']['http://localhost:5800']['state'], 'open')
+
+    def test_open_breakers_fail_over_to_other_endpoints(self):
+        (server, client) = self.serve()
+        policy = RetryPolicy(backoff = 0.001, breaker_threshold = 1, breaker_timeout = 60)
+        client.set_retry_policy(policy)
+        # a port nothing listens on
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        dead = sock.getsockname()[1]
+        sock.close()
+        client.set_endpoints(['127.0.0.1:%d' % dead, '127.0.0.1:%d' % server.port], eject_after = 100)
+        self.addCleanup(client.set_endpoints, None)
+        self.app.route('/api/ok', lambda request: reply('ok'))
+        for i in range(4):
+            self.assertEqual(client.request('GET', 'ok'), 'ok')
+        hosts = policy.stats()['hosts']
+        self.assertEqual(hosts['http://127.0.0.1:%d' % dead]['state'], 'open')
+        self.assertEqual(self.app.count(), 4)
+        # with every circuit open there's nowhere left to go
+        server.close()
+        client.get_transport().close()
+        self.assertRaisesRegexp(Exception, 'Circuit open', client.request, 'GET', 'ok')
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def test_half_open(self):
+        breaker = CircuitBreaker(threshold = 2, reset_timeout = 0.05)
+        self.assertFalse(breaker.failure())
+        self.assertTrue(breaker.failure())
+        self.assertFalse(breaker.allow())
+        time.sleep(0.06)
+        # one trial request at a time
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        self.assertTrue(breaker.failure())
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow())
+        breaker.success()
+        self.assertEqual((breaker.state, breaker.failures), (CircuitBreaker.CLOSED, 0))
+        self.assertTrue(breaker.allow())
+
+    def test_parse_retry_after(self):
+        self.assertEqual(parse_retry_after(' 120 '), 120)
+        self.assertEqual(parse_retry_after('Thu, 01 Jan 1970 00:00:00 GMT'), 0)
+        self.assertEqual(parse_retry_after('soon'), None)
+
+    def test_delay(self):
+        policy = RetryPolicy(backoff = 1, max_backoff = 3)
+        self.assertEqual(policy.delay(1, '7'), 7)
+        for tries in range(1, 10):
+            self.assertTrue(0 <= policy.delay(tries) <= 3)
+
+
+if __name__ == '__main__':
+    unittest.main()